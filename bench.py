@@ -0,0 +1,151 @@
+"""
+Benchmarks the MCP251x hot paths against mcp251x_sim, no Pi needed.
+
+    python bench.py [iterations]
+
+For every operation it prints SPI transactions, bytes clocked and Python
+CPU time per frame (or per call for reset/setBitrate). The CPU time includes
+the simulator's own work, so compare runs with each other rather than
+reading it as the cost on a Pi.
+"""
+import sys
+import time
+
+import mcp251x
+from mcp251x_sim import SimulatedSpiDev
+
+ITERATIONS = 2000
+
+
+def setup(**kwargs):
+    sim = SimulatedSpiDev()
+    can = mcp251x.MCP251x(0, 0, spi=sim, **kwargs)
+    can.reset()
+    can.setBitrate(mcp251x.CAN_1000KBPS, mcp251x.MCP_16MHZ)
+    can.setNormalMode()
+    sim.resetCounters()
+    return sim, can
+
+
+class Result():
+
+    def __init__(self, name, unit):
+        self.name = name
+        self.unit = unit
+        self.count = 0
+        self.cpu = 0.0
+        self.transactions = 0
+        self.bytes = 0
+
+    def row(self):
+        n = max(self.count, 1)
+        return "%-34s %8d %10.2f %10.1f %12.2f" % (
+            self.name + " /" + self.unit, self.count,
+            self.transactions / n, self.bytes / n, self.cpu / n * 1e6)
+
+
+def timed(result, sim, fn):
+    """
+    runs fn() and adds its CPU time and SPI traffic to result, so that
+    injecting frames into the simulator stays out of the numbers
+    """
+    transactions = sim.transactions
+    clocked = sim.bytes_clocked
+    start = time.process_time()
+    n = fn()
+    result.cpu += time.process_time() - start
+    result.transactions += sim.transactions - transactions
+    result.bytes += sim.bytes_clocked - clocked
+    result.count += n
+
+
+def benchReadMessage(iterations, fast_rx):
+    sim, can = setup(fast_rx=fast_rx)
+    name = "readMessage" + (" fast_rx" if fast_rx else "")
+    result = Result(name, "frame")
+    payload = b"\x11\x22\x33\x44\x55\x66\x77\x88"
+
+    def read():
+        rc, frame = can.readMessage()
+        return 1 if rc == mcp251x.ERROR_OK else 0
+
+    for i in range(iterations):
+        sim.injectFrame(0x100 + (i & 0xFF), payload)
+        timed(result, sim, read)
+    return result
+
+
+def benchReadMessages(iterations):
+    sim, can = setup()
+    result = Result("readMessages both buffers", "frame")
+    payload = b"\x11\x22\x33\x44"
+
+    def read():
+        rc, frames = can.readMessages()
+        return len(frames)
+
+    for i in range(iterations // 2):
+        sim.injectFrame(0x100, payload)
+        sim.injectFrame(0x101, payload)
+        timed(result, sim, read)
+    return result
+
+
+def benchSendMessages(iterations, batch):
+    sim, can = setup()
+    result = Result("sendMessages x%d" % batch, "frame")
+    frames = [mcp251x.CanFrame(0x200 + i, b"\x01\x02\x03\x04\x05\x06\x07\x08")
+              for i in range(batch)]
+
+    def send():
+        if can.sendMessages(frames) != mcp251x.ERROR_OK:
+            return 0
+        # the simulator completes frames at RTS, this retires the buffers
+        can.serviceTx()
+        return batch
+
+    for i in range(iterations // batch):
+        timed(result, sim, send)
+    return result
+
+
+def benchReset(iterations):
+    sim, can = setup()
+    result = Result("reset", "call")
+    for i in range(iterations):
+        timed(result, sim, lambda: can.reset() == mcp251x.ERROR_OK)
+    return result
+
+
+def benchSetBitrate(iterations):
+    sim, can = setup()
+    result = Result("setBitrate", "call")
+    speeds = [mcp251x.CAN_500KBPS, mcp251x.CAN_1000KBPS]
+    for i in range(iterations):
+        speed = speeds[i & 1]
+        timed(result, sim, lambda: can.setBitrate(speed, mcp251x.MCP_16MHZ) == mcp251x.ERROR_OK)
+    return result
+
+
+def main():
+    iterations = ITERATIONS
+    if len(sys.argv) > 1:
+        iterations = int(sys.argv[1])
+
+    results = [
+        benchReadMessage(iterations, False),
+        benchReadMessage(iterations, True),
+        benchReadMessages(iterations),
+        benchSendMessages(iterations, 1),
+        benchSendMessages(iterations, 3),
+        benchReset(iterations // 10),
+        benchSetBitrate(iterations // 10),
+    ]
+
+    print("%-34s %8s %10s %10s %12s" % ("operation", "count", "xfers", "bytes", "cpu us"))
+    for result in results:
+        print(result.row())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""
+Loopback self-test and throughput benchmark.
+
+    python loopback.py                    # against mcp251x_sim
+    python loopback.py --hardware --bus 0 --device 0
+
+Puts the MCP251x in loopback mode, where every transmitted frame comes
+straight back through the RX path without touching the bus, and for every
+SPI clock, standard and extended ids and DLC 0 to 8 sends --frames frames,
+--window at a time, reading each back. Prints frames/s, the p50/p99 round
+trip from sendMessages() to the frame coming out of readMessages(), and
+frames that never came back or came back wrong.
+
+On the simulator nothing takes real time on the wire, so the elapsed time
+is the Python time plus the SPI time the simulator models at the clock
+(SimulatedSpiDev.spi_time) plus the frames' time on the CAN bit clock.
+Those numbers do not predict a Pi but are stable enough to compare runs of
+the driver, which is what --json is for.
+"""
+import argparse
+import json
+import time
+
+import mcp251x
+
+BITRATE = mcp251x.CAN_1000KBPS
+BITRATE_BPS = 1000000
+CRYSTAL = mcp251x.MCP_16MHZ
+
+SPI_CLOCKS = [1000000, 4000000, 8000000, 10000000]
+
+# how long a frame may take to come back before it counts as dropped
+RECEIVE_TIMEOUT = 0.01
+
+
+def frameBits(ext, dlc):
+    """
+    bits of a data frame on the wire with worst case stuffing, plus the
+    interframe space
+    """
+    bits = (64 if ext else 44) + 8 * dlc
+    return bits + (bits - 13) // 4 + 3
+
+
+def percentile(ordered, p):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100.0))]
+
+
+def setup(args):
+    if args.hardware:
+        can = mcp251x.MCP251x(args.bus, args.device, fast_rx=True)
+        sim = None
+    else:
+        from mcp251x_sim import SimulatedSpiDev
+
+        sim = SimulatedSpiDev()
+        can = mcp251x.MCP251x(0, 0, spi=sim, fast_rx=True)
+    if can.reset() != mcp251x.ERROR_OK:
+        raise SystemExit("reset failed")
+    if can.setBitrate(BITRATE, CRYSTAL) != mcp251x.ERROR_OK:
+        raise SystemExit("setBitrate failed")
+    if can.setLoopbackMode() != mcp251x.ERROR_OK:
+        raise SystemExit("the chip did not enter loopback mode")
+    return sim, can
+
+
+def run(can, sim, clock, ext, dlc, frames, window):
+    can.setSpiClock(clock)
+    base = 0x12345600 if ext else 0x600
+    flag = mcp251x.CAN_EFF_FLAG if ext else 0
+    payload = bytes(range(0x11, 0x11 + dlc))
+
+    # the simulator loops frames back instantly, add their time on the wire
+    frameTime = frameBits(ext, dlc) / float(BITRATE_BPS) if sim is not None else 0.0
+    rtts = []
+    dropped = 0
+    wrong = 0
+    spiTime = sim.spi_time if sim is not None else 0.0
+    start = time.perf_counter()
+    sent = 0
+    while sent < frames:
+        n = min(window, frames - sent)
+        batch = [mcp251x.CanFrame((base + ((sent + i) & 0xFF)) | flag, payload)
+                 for i in range(n)]
+        expected = {frame.can_id: frame for frame in batch}
+        t0 = time.perf_counter()
+        spi0 = sim.spi_time if sim is not None else 0.0
+        back = 0
+        if can.sendMessages(batch) != mcp251x.ERROR_OK:
+            dropped += n
+            sent += n
+            continue
+        deadline = t0 + RECEIVE_TIMEOUT
+        while expected and time.perf_counter() < deadline:
+            rc, received = can.readMessages()
+            rtt = time.perf_counter() - t0
+            if sim is not None:
+                rtt += sim.spi_time - spi0
+            for frame in received:
+                want = expected.pop(frame.can_id, None)
+                if want is None or frame.data != want.data:
+                    wrong += 1
+                    continue
+                back += 1
+                rtts.append(rtt + back * frameTime)
+        dropped += len(expected)
+        sent += n
+    elapsed = time.perf_counter() - start
+    can.serviceTx()
+
+    if sim is not None:
+        elapsed += sim.spi_time - spiTime + frames * frameTime
+
+    rtts.sort()
+    return {
+        "spi_hz": clock,
+        "ext": ext,
+        "dlc": dlc,
+        "frames": frames,
+        "frames_per_s": (frames - dropped) / elapsed if elapsed else 0.0,
+        "p50_us": percentile(rtts, 50) * 1e6,
+        "p99_us": percentile(rtts, 99) * 1e6,
+        "dropped": dropped,
+        "wrong": wrong,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--hardware", action="store_true",
+                        help="use /dev/spidev instead of the simulator")
+    parser.add_argument("--bus", type=int, default=0)
+    parser.add_argument("--device", type=int, default=0)
+    parser.add_argument("--frames", type=int, default=1000, help="frames per combination")
+    parser.add_argument("--window", type=int, default=2,
+                        help="frames in flight, more than 2 can overrun the RX buffers")
+    parser.add_argument("--clocks", default=",".join(str(c) for c in SPI_CLOCKS),
+                        help="comma separated SPI clocks in Hz")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    sim, can = setup(args)
+    results = []
+    print("%8s %4s %4s %8s %10s %9s %9s %8s" % (
+        "spi MHz", "id", "dlc", "frames", "frames/s", "p50 us", "p99 us", "dropped"))
+    for clock in [int(c) for c in args.clocks.split(",")]:
+        for ext in (False, True):
+            for dlc in range(mcp251x.CAN_MAX_DLEN + 1):
+                result = run(can, sim, clock, ext, dlc, args.frames, args.window)
+                results.append(result)
+                print("%8.1f %4s %4d %8d %10.0f %9.1f %9.1f %8d" % (
+                    clock / 1e6, "ext" if ext else "std", dlc, result["frames"],
+                    result["frames_per_s"], result["p50_us"], result["p99_us"],
+                    result["dropped"] + result["wrong"]))
+    can.setNormalMode()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"simulated": sim is not None, "results": results}, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
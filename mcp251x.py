@@ -1,77 +1,1524 @@
+import array
+import contextlib
+import heapq
+import threading
 import time
-import spidev
+
+class GpioInterrupt():
+    """
+    INT line of the chip on a Linux GPIO character device, needs the libgpiod
+    v2 python bindings. Anything with the same asserted()/wait()/close()
+    methods can be handed to MCP251x instead.
+    """
+
+    def __init__(self, line, chip="/dev/gpiochip0"):
+        import gpiod
+        from gpiod.line import Bias, Direction, Edge
+
+        self.line = line
+        # INT is active low, with active_low set the kernel reports the
+        # falling edge as a rising one and get_value() as ACTIVE while low
+        self.request = gpiod.request_lines(chip, consumer="mcp251x", config={
+            line: gpiod.LineSettings(direction=Direction.INPUT,
+                                     edge_detection=Edge.RISING,
+                                     bias=Bias.PULL_UP,
+                                     active_low=True)
+        })
+        self._active = gpiod.line.Value.ACTIVE
+        self._edge = None
+        # time.monotonic_ns() of the last edgeTimestamp(), edges before it
+        # belong to frames already read
+        self._lastService = None
+
+    def asserted(self):
+        return self.request.get_value(self.line) == self._active
+
+    def wait(self, timeout=None):
+        """
+        Block until INT is asserted, returns False on timeout
+        """
+        if self.request.wait_edge_events(timeout):
+            self._readEdges()
+            return True
+        return self.asserted()
+
+    def _readEdges(self):
+        # edges pile up in the kernel while INT is serviced without wait(),
+        # take all of them and keep the newest. The kernel stamps edges with
+        # CLOCK_MONOTONIC
+        while self.request.wait_edge_events(0):
+            events = self.request.read_edge_events()
+            if not events:
+                break
+            self._edge = events[-1].timestamp_ns
+
+    def edgeTimestamp(self):
+        """
+        time.monotonic_ns() of the newest edge, once. None when there was
+        none since the previous call, so the caller uses the time of its
+        status read instead.
+        """
+        self._readEdges()
+        edge = self._edge
+        self._edge = None
+        last = self._lastService
+        self._lastService = time.monotonic_ns()
+        if edge is None or (last is not None and edge < last):
+            return None
+        return edge
+
+    def fileno(self):
+        """
+        readable when an edge is queued, for select() over several lines
+        """
+        return self.request.fd
+
+    def close(self):
+        self.request.release()
+
+
+class CanFrame():
+    """
+    One CAN frame. can_id carries CAN_EFF_FLAG/CAN_RTR_FLAG like the Linux
+    struct can_frame, data is bytes. Received frames carry the
+    time.monotonic_ns() of their INT edge or status read in timestamp, and
+    frames from readMessages() the acceptance filter (0 to 5) that took them
+    in filter when RX STATUS tells, else None.
+    """
+    __slots__ = ("can_id", "can_dlc", "data", "timestamp", "filter")
+
+    def __init__(self, can_id, data=b"", can_dlc=None, timestamp=0, filter=None):
+        self.can_id = can_id
+        self.data = data
+        if can_dlc is None:
+            can_dlc = len(data)
+        self.can_dlc = can_dlc
+        self.timestamp = timestamp
+        self.filter = filter
+
+    @property
+    def arbitration_id(self):
+        if self.can_id & CAN_EFF_FLAG:
+            return self.can_id & CAN_EFF_MASK
+        return self.can_id & CAN_SFF_MASK
+
+    @property
+    def is_extended(self):
+        return (self.can_id & CAN_EFF_FLAG) != 0
+
+    @property
+    def is_remote(self):
+        return (self.can_id & CAN_RTR_FLAG) != 0
+
+    def asDict(self):
+        return {"can_id": self.can_id, "can_dlc": self.can_dlc, "data": list(self.data),
+                "timestamp": self.timestamp, "filter": self.filter}
+
+    def __eq__(self, other):
+        if not isinstance(other, CanFrame):
+            return NotImplemented
+        return (self.can_id == other.can_id and self.can_dlc == other.can_dlc
+                and bytes(self.data) == bytes(other.data))
+
+    def __repr__(self):
+        return "CanFrame(0x%X, %r, %d)" % (self.can_id, bytes(self.data), self.can_dlc)
+
+
+class FrameBatch():
+    """
+    Many frames in one contiguous preallocated buffer: ids, dlcs, stamps and
+    a capacity * 8 byte data block. Reuse one with clear() to keep batch reads
+    free of per-frame objects.
+    """
+
+    def __init__(self, capacity=256):
+        self.capacity = capacity
+        self.ids = array.array("I", bytes(4 * capacity))
+        self.dlcs = bytearray(capacity)
+        self.stamps = array.array("Q", bytes(8 * capacity))
+        self.data = bytearray(capacity * CAN_MAX_DLEN)
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def clear(self):
+        self.count = 0
+
+    def append(self, can_id, dlc, src, offset=0, timestamp=0):
+        """
+        copies dlc bytes from src[offset:], returns False if the batch is full
+        """
+        if self.count >= self.capacity:
+            return False
+        i = self.count
+        self.ids[i] = can_id
+        self.dlcs[i] = dlc
+        self.stamps[i] = timestamp
+        base = i * CAN_MAX_DLEN
+        self.data[base:base + dlc] = src[offset:offset + dlc]
+        self.count = i + 1
+        return True
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.count
+        if i < 0 or i >= self.count:
+            raise IndexError(i)
+        base = i * CAN_MAX_DLEN
+        dlc = self.dlcs[i]
+        return CanFrame(self.ids[i], bytes(self.data[base:base + dlc]), dlc, self.stamps[i])
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self[i]
+
+    def payload(self, i):
+        """
+        zero-copy view of frame i's data
+        """
+        base = i * CAN_MAX_DLEN
+        return memoryview(self.data)[base:base + self.dlcs[i]]
+
+    def to_numpy(self):
+        """
+        Returns (ids, dlcs, data) as NumPy views on the batch's buffers,
+        data is count x 8 with bytes past each dlc left over from earlier
+        frames. Needs numpy.
+        """
+        import numpy
+
+        n = self.count
+        ids = numpy.frombuffer(self.ids, dtype=numpy.uint32, count=n)
+        dlcs = numpy.frombuffer(self.dlcs, dtype=numpy.uint8, count=n)
+        data = numpy.frombuffer(self.data, dtype=numpy.uint8, count=n * CAN_MAX_DLEN)
+        return ids, dlcs, data.reshape(n, CAN_MAX_DLEN)
+
+
+class FrameRing():
+    """
+    Fixed capacity ring of received frames between one producer (the reader
+    thread) and one consumer. Storage is preallocated, put() allocates
+    nothing and a full ring drops the new frame and counts it in overflows.
+    """
+
+    def __init__(self, capacity=1024, dict_frames=False):
+        self.capacity = capacity
+        self.dict_frames = dict_frames
+        self.ids = array.array("I", bytes(4 * capacity))
+        self.dlcs = bytearray(capacity)
+        self.stamps = array.array("Q", bytes(8 * capacity))
+        self.data = bytearray(capacity * CAN_MAX_DLEN)
+        # mcp251x_stats.LatencyTrace fed as frames are taken, see
+        # MCP251x.enableLatencyTrace()
+        self.latency = None
+        # free running counters, head only moves in put() and tail only in
+        # get()/get_batch() so no lock is needed between the two sides
+        self.head = 0
+        self.tail = 0
+        self.overflows = 0
+        # set by the producer after a batch of put()s, see wait()
+        self._ready = threading.Event()
+
+    def __len__(self):
+        return self.head - self.tail
+
+    def put(self, can_id, dlc, src, offset, timestamp=0):
+        """
+        copies dlc data bytes from src[offset:], returns False if full
+        """
+        if self.head - self.tail >= self.capacity:
+            self.overflows += 1
+            return False
+        slot = self.head % self.capacity
+        self.ids[slot] = can_id
+        self.dlcs[slot] = dlc
+        self.stamps[slot] = timestamp
+        base = slot * CAN_MAX_DLEN
+        self.data[base:base + dlc] = src[offset:offset + dlc]
+        self.head += 1
+        return True
+
+    def notify(self):
+        """
+        wakes a consumer blocked in wait(), called once per batch of put()s
+        """
+        self._ready.set()
+
+    def wait(self, timeout=None):
+        """
+        blocks until the ring holds a frame or timeout seconds pass, returns
+        whether it does
+        """
+        if self.head != self.tail:
+            return True
+        self._ready.clear()
+        # a batch may have landed between the check and clear()
+        if self.head != self.tail:
+            return True
+        self._ready.wait(timeout)
+        return self.head != self.tail
+
+    def get(self):
+        """
+        returns the oldest frame or None if the ring is empty, never blocks
+        """
+        if self.tail == self.head:
+            return None
+        slot = self.tail % self.capacity
+        frame = self._frame(slot)
+        if self.latency is not None:
+            self.latency.add(time.monotonic_ns() - self.stamps[slot])
+        self.tail += 1
+        return frame
+
+    def get_batch(self, n):
+        """
+        returns up to n of the oldest frames, never blocks
+        """
+        count = min(n, self.head - self.tail)
+        frames = []
+        for i in range(count):
+            frames.append(self._frame((self.tail + i) % self.capacity))
+        if self.latency is not None and count:
+            self._trace(count)
+        self.tail += count
+        return frames
+
+    def get_into(self, batch, n):
+        """
+        moves up to n of the oldest frames into a FrameBatch without creating
+        frame objects, returns how many were moved
+        """
+        count = min(n, self.head - self.tail, batch.capacity - batch.count)
+        for i in range(count):
+            slot = (self.tail + i) % self.capacity
+            base = slot * CAN_MAX_DLEN
+            batch.append(self.ids[slot], self.dlcs[slot], self.data, base, self.stamps[slot])
+        if self.latency is not None and count:
+            self._trace(count)
+        self.tail += count
+        return count
+
+    def _trace(self, count):
+        now = time.monotonic_ns()
+        for i in range(count):
+            self.latency.add(now - self.stamps[(self.tail + i) % self.capacity])
+
+    def _frame(self, slot):
+        dlc = self.dlcs[slot]
+        base = slot * CAN_MAX_DLEN
+        if self.dict_frames:
+            frame = {}
+            frame["can_id"] = self.ids[slot]
+            frame["can_dlc"] = dlc
+            frame["data"] = list(self.data[base:base + dlc])
+            frame["timestamp"] = self.stamps[slot]
+            frame["filter"] = None
+            return frame
+        return CanFrame(self.ids[slot], bytes(self.data[base:base + dlc]), dlc, self.stamps[slot])
+
+
+class PollScheduler():
+    """
+    Picks the time between polls for boards without INT. It polls about as
+    often as frames arrive, halves the interval whenever both RX buffers were
+    found full, backs off on empty polls, and never lets polling take more
+    than cpu_budget of a core. Intervals stay within
+    min_interval..max_interval seconds.
+    """
+
+    def __init__(self, min_interval=0.0002, max_interval=0.01, cpu_budget=0.05):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.cpu_budget = cpu_budget
+        self.interval = max_interval
+        # moving averages of frames and seconds between polls, their ratio
+        # is the arrival rate, and of seconds per poll
+        self.rate = 0.0
+        self._frames = 0.0
+        self._period = 0.0
+        self.cost = 0.0
+        self.polls = 0
+        self.empty_polls = 0
+        # polls that found both RX buffers full, a third frame in that time
+        # would have been lost
+        self.both_full = 0
+        self.frames = 0
+        self._last = None
+
+    def update(self, frames, full, cost):
+        """
+        frames read by the poll, full RX buffers it found (0-2) and the
+        seconds it took, returns the seconds to sleep before the next one
+        """
+        now = time.monotonic()
+        if self._last is not None:
+            self._frames += POLL_AVERAGE_WEIGHT * (frames - self._frames)
+            self._period += POLL_AVERAGE_WEIGHT * (now - self._last - self._period)
+            if self._period > 0:
+                self.rate = self._frames / self._period
+        self._last = now
+        self.cost += POLL_AVERAGE_WEIGHT * (cost - self.cost)
+        self.polls += 1
+        self.frames += frames
+
+        interval = self.interval
+        if full >= 2:
+            self.both_full += 1
+            interval /= 2
+        elif frames == 0:
+            self.empty_polls += 1
+            interval *= POLL_BACKOFF
+        if frames and self.rate > 0:
+            # arrivals are bursty, aiming at half a frame per poll keeps
+            # two arrivals between polls rare
+            interval = min(interval, POLL_FRAMES_TARGET / self.rate)
+
+        floor = self.min_interval
+        if self.cpu_budget:
+            floor = max(floor, self.cost / self.cpu_budget - self.cost)
+        self.interval = min(self.max_interval, max(floor, interval))
+        return self.interval
+
+    def snapshot(self):
+        return {
+            "interval_us": self.interval * 1e6,
+            "rate": self.rate,
+            "poll_cost_us": self.cost * 1e6,
+            "polls": self.polls,
+            "empty_polls": self.empty_polls,
+            "both_full": self.both_full,
+            "frames": self.frames,
+        }
+
+
+class ErrorCounters():
+    """
+    What MCP251x.serviceErrors() has seen. An RX overflow is counted once
+    per service, the chip does not say how many frames it lost.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.rx_overflows = [0, 0]
+        self.message_errors = 0
+        self.error_interrupts = 0
+        self.bus_offs = 0
+        self.recoveries = 0
+        self.state = ERROR_STATE_ACTIVE
+        self.tec = 0
+        self.rec = 0
+        self.tec_peak = 0
+        self.rec_peak = 0
+        # change since the previous service, > 0 while errors pile up
+        self.tec_trend = 0
+        self.rec_trend = 0
+
+    def update(self, tec, rec):
+        self.tec_trend = tec - self.tec
+        self.rec_trend = rec - self.rec
+        self.tec = tec
+        self.rec = rec
+        if tec > self.tec_peak:
+            self.tec_peak = tec
+        if rec > self.rec_peak:
+            self.rec_peak = rec
+
+    def snapshot(self):
+        return {
+            "rx0_overflows": self.rx_overflows[RXB0],
+            "rx1_overflows": self.rx_overflows[RXB1],
+            "message_errors": self.message_errors,
+            "error_interrupts": self.error_interrupts,
+            "bus_offs": self.bus_offs,
+            "recoveries": self.recoveries,
+            "state": ERROR_STATE_NAMES[self.state],
+            "tec": self.tec,
+            "rec": self.rec,
+            "tec_peak": self.tec_peak,
+            "rec_peak": self.rec_peak,
+            "tec_trend": self.tec_trend,
+            "rec_trend": self.rec_trend,
+        }
+
+
+class LinkCounters():
+    """
+    What MCP251x.calibrateSpi() and checkLink() found out about the SPI link
+    """
+
+    def __init__(self, clock):
+        self.clock = clock
+        # {clock: mismatching bytes} of the last calibration
+        self.calibration = {}
+        self.checks = 0
+        self.mismatches = 0
+        self.clock_drops = 0
+        self.repairs = 0
+
+    def snapshot(self):
+        return {
+            "spi_hz": self.clock,
+            "calibration": dict(self.calibration),
+            "checks": self.checks,
+            "mismatches": self.mismatches,
+            "clock_drops": self.clock_drops,
+            "repairs": self.repairs,
+        }
+
+
+def errorState(eflg):
+    if eflg & EFLG_TXBO:
+        return ERROR_STATE_BUS_OFF
+    if eflg & (EFLG_TXEP | EFLG_RXEP):
+        return ERROR_STATE_PASSIVE
+    if eflg & EFLG_EWARN:
+        return ERROR_STATE_WARNING
+    return ERROR_STATE_ACTIVE
+
 
 class MCP251x():
 
-    def __init__(self, bus, device, spi_bitrate=10000000):
-        self.spi = spidev.SpiDev()
-        self.spi.open(bus, device)
+    def __init__(self, bus, device, spi_bitrate=10000000, fast_rx=False,
+                 tx_queue_size=256, int_gpio=None, dict_frames=False, spi=None,
+                 mode_timeout=10, busoff_recovery=True):
+        # spi can be any object with spidev.SpiDev's xfer2(), such as
+        # mcp251x_sim.SimulatedSpiDev, in which case spidev is not needed
+        if spi is None:
+            import spidev
+            spi = spidev.SpiDev()
+            spi.open(bus, device)
+        self.spi = spi
         self.spi.max_speed_hz = spi_bitrate
         self.spi.mode = 0
+        # write-only commands go out with writebytes2(), which takes any
+        # buffer, when the SPI object has it
+        self._writeBuffer = hasattr(spi, "writebytes2")
+
+        # command buffers reused by every transaction, guarded by self.lock.
+        # spidev's xfer2() writes the response back into a list argument and
+        # returns that same list, so a reused list costs no allocation but
+        # its command bytes have to be set again before each transfer
+        self._statusCommand = [INSTRUCTION_READ_STATUS, 0x00]
+        self._rxStatusCommand = [INSTRUCTION_RX_STATUS, 0x00]
+        self._readCommand = [INSTRUCTION_READ, 0x00, 0x00]
+        self._readCommands = {}
+        self._readRxCommand = [0x00] * (1 + RX_BUFFER_LEN)
+        self._bitmodCommand = bytearray([INSTRUCTION_BITMOD, 0, 0, 0])
+        self._writeCommand = bytearray(2 + 0x80)
+        self._writeCommand[0] = INSTRUCTION_WRITE
+        self._writeViews = [memoryview(self._writeCommand)[:n] for n in range(len(self._writeCommand) + 1)]
+        # LOAD TX BUFFER per buffer with a view for every length
+        self._loadTxCommands = []
+        self._loadTxViews = []
+        for txbn in (TXB0, TXB1, TXB2):
+            command = bytearray(1 + RX_BUFFER_LEN)
+            command[0] = LOAD_TX[txbn]
+            self._loadTxCommands.append(command)
+            self._loadTxViews.append([memoryview(command)[:n] for n in range(len(command) + 1)])
+        # fast_rx reads frames with READ RX BUFFER: one transaction per frame
+        # after the status read instead of four
+        self.fast_rx = fast_rx
+        # frames come back as CanFrame, dict_frames keeps the old
+        # {"can_id", "can_dlc", "data"} dicts for existing callers
+        self.dict_frames = dict_frames
+
+        # software TX queue behind the three hardware buffers, a heap of
+        # [arbitration key, sequence, buffer bytes, callback] so the lowest id
+        # goes first
+        self.tx_queue_size = tx_queue_size
+        self._txQueue = []
+        self._txSeq = 0
+        self._txInflight = [None, None, None]
+        self._txPriority = [0, 0, 0]
+        self._txNext = TXB0
+
+        # optional INT line, see GpioInterrupt and waitMessages()
+        self.int_gpio = int_gpio
+
+        # serialises RX and TX sequences between the reader thread and callers
+        self.lock = threading.RLock()
+        # RX STATUS buffer bits from the last look, see rxOrder()
+        self._rxLastFull = 0
+        # RX buffers full at the start of the last readMessages() or
+        # drainToRing(), see PollScheduler
+        self.lastRxFull = 0
+
+        # see enableInstrumentation()
+        self._instrumentation = None
+        # see enableLatencyTrace()
+        self.latency = None
+
+        # see serviceErrors(). onError is called as onError(event, value)
+        # with one of the ERROR_EVENT_* events, outside the driver lock
+        self.errors = ErrorCounters()
+        self.onError = None
+        self.busoff_recovery = busoff_recovery
+        self._lastRecovery = None
+
+        # see calibrateSpi() and checkLink(). spi_clocks are the clocks
+        # checkLink() may step down through
+        self.link = LinkCounters(spi_bitrate)
+        self.spi_clocks = SPI_CLOCKS
+        self.link_check_interval = None
+        self._nextLinkCheck = 0.0
+
+        # operation mode last confirmed by CANSTAT, None when unknown, see
+        # setMode()
+        self.mode_timeout = mode_timeout
+        self._mode = None
+
+        # driver side copy of the configuration registers, see writeConfig().
+        # Nothing is known until reset()
+        self._shadow = bytearray(0x80)
+        self._shadowValid = bytearray(0x80)
+
+        # software post-filter behind the acceptance filters, anything with
+        # __contains__ for can_id & RX_ACCEPT_KEY, see setAcceptanceFilters()
+        self.rxAccept = None
+
+        self.ring = None
+        self.poller = None
+        self._reader = None
+        self._readerStop = threading.Event()
+        # called from the reader thread after it put frames into the ring
+        self.onReceive = None
+
+
+    def enableInstrumentation(self, methods=None):
+        """
+        Count SPI transactions and bytes per instruction and keep latency
+        histograms for the public methods named in methods (default
+        mcp251x_stats.TIMED_METHODS). Costs nothing until enabled.
+        """
+        import mcp251x_stats
 
+        if self._instrumentation is not None:
+            return
+        self._instrumentation = mcp251x_stats.Instrumentation(self, methods)
+        self._instrumentation.install()
+
+    def disableInstrumentation(self):
+        if self._instrumentation is None:
+            return
+        self._instrumentation.uninstall()
+        self._instrumentation = None
+
+    def getStats(self):
+        """
+        returns {"spi": {instruction: {"transactions", "bytes"}},
+                 "methods": {name: {"count", "mean_us", "p50_us", ...}}}
+        or None if instrumentation is off
+        """
+        if self._instrumentation is None:
+            return None
+        return self._instrumentation.snapshot()
+
+    def resetStats(self):
+        if self._instrumentation is not None:
+            self._instrumentation.reset()
+
+    def writeCommand(self, command):
+        """
+        sends a write-only command held in a bytes-like object
+        """
+        if self._writeBuffer:
+            self.spi.writebytes2(command)
+        else:
+            self.spi.xfer2(list(command))
 
     def getStatus(self):
-        return self.spi.xfer2([INSTRUCTION_READ_STATUS, 0x00])[1]
+        with self.lock:
+            return self._getStatus()
+
+    def _getStatus(self):
+        command = self._statusCommand
+        command[0] = INSTRUCTION_READ_STATUS
+        return self.spi.xfer2(command)[1]
 
     def modifyRegister(self, reg, mask, data):
-        command = [INSTRUCTION_BITMOD, reg, mask, data]
-        self.spi.xfer2(command)
+        with self.lock:
+            command = self._bitmodCommand
+            command[1] = reg
+            command[2] = mask
+            command[3] = data & 0xFF
+            self.writeCommand(command)
+
+            if reg in SHADOW_REGISTERS:
+                # BIT MODIFY on a register that does not support it is a write
+                if reg not in BITMOD_REGISTERS:
+                    mask = 0xFF
+                self._shadow[reg] = (self._shadow[reg] & ~mask | data & mask) & 0xFF
+                if mask == 0xFF:
+                    self._shadowValid[reg] = 1
 
     def readRegister(self, reg):
-        return self.spi.xfer2([INSTRUCTION_READ, reg, 0x00])[2]
+        if self._shadowValid[reg] and reg not in SHADOW_VOLATILE:
+            return self._shadow[reg]
+        with self.lock:
+            command = self._readCommand
+            command[0] = INSTRUCTION_READ
+            command[1] = reg
+            return self.spi.xfer2(command)[2]
 
     def readRegisters(self, reg, n):
-        command = [INSTRUCTION_READ, reg]
-        # mcp2515 has auto-increment of address-pointer
-        for i in range(n):
-            command.append(0x00)
-        data = self.spi.xfer2(command)[2:]
-        return data
+        if self.isShadowed(reg, n):
+            return list(self._shadow[reg:reg + n])
+        return self._readRegisters(reg, n)
+
+    def _readRegisters(self, reg, n):
+        # always from the chip, never from the shadow
+        with self.lock:
+            command = self._readCommands.get(n)
+            if command is None:
+                # mcp2515 has auto-increment of address-pointer, what is
+                # clocked out after the address does not matter
+                command = self._readCommands[n] = [0x00] * (2 + n)
+            command[0] = INSTRUCTION_READ
+            command[1] = reg
+            return self.spi.xfer2(command)[2:]
 
 
     def readMessage(self):
-        stat = self.getStatus()
-        if ( stat & STAT_RX0IF ):
-            rc, frame = self.readMessage_rxbn(RXB0)
-        elif ( stat & STAT_RX1IF ):
-            rc, frame = self.readMessage_rxbn(RXB1)
-        else:
-            rc, frame = ERROR_NOMSG, None
+        with self.lock:
+            timestamp = time.monotonic_ns()
+            stat = self._getStatus()
+            # what is left full after this read decides the order later
+            self._rxLastFull = (RXSTATUS_RXB0 if stat & STAT_RX0IF else 0) | \
+                (RXSTATUS_RXB1 if stat & STAT_RX1IF else 0)
+            if ( stat & STAT_RX0IF ):
+                rxbn = RXB0
+            elif ( stat & STAT_RX1IF ):
+                rxbn = RXB1
+            else:
+                return ERROR_NOMSG, None
+
+            if self.fast_rx:
+                rc, frame = self.readMessage_rxbn_fast(rxbn, timestamp)
+            else:
+                rc, frame = self.readMessage_rxbn(rxbn, timestamp)
+        if self.latency is not None and rc == ERROR_OK:
+            self.latency.add(time.monotonic_ns() - timestamp)
         return rc, frame
 
-    def readMessage_rxbn(self, rxbn):
-        frame = {}
+    def readMessages(self, max_frames=16, timestamp=None):
+        """
+        Drains every full RX buffer, oldest first, using RX STATUS to find
+        them: one transaction for the status and one READ RX BUFFER per frame.
+        Returns rc and a list of up to max_frames frames. timestamp is when
+        the frames were detected, e.g. the INT edge, else the status read.
+        RX STATUS names the filter of the lowest numbered full buffer only,
+        with both full the frame from RXB1 gets filter None.
+        """
+        frames = []
+        with self.lock:
+            while len(frames) < max_frames:
+                if timestamp is None:
+                    timestamp = time.monotonic_ns()
+                rxstat = self._getRxStatus()
+                order = self.rxOrder(rxstat)
+                if not frames:
+                    self.lastRxFull = len(order)
+                hitBuffer = RXB0 if rxstat & RXSTATUS_RXB0 else RXB1
+                hit = RXSTATUS_FILTER[rxstat & RXSTATUS_FILHIT]
+                for rxbn in order:
+                    if len(frames) >= max_frames:
+                        break
+                    rc, frame = self.readMessage_rxbn_fast(rxbn, timestamp)
+                    if rc == ERROR_OK:
+                        if rxbn == hitBuffer:
+                            if self.dict_frames:
+                                frame["filter"] = hit
+                            else:
+                                frame.filter = hit
+                        frames.append(frame)
+                # only when both buffers were full is it likely another frame
+                # came in meanwhile, otherwise save the extra status read
+                if len(order) < 2:
+                    break
+                timestamp = None
+
+        if self.latency is not None and frames:
+            self.traceFrames(frames)
+        if frames:
+            return ERROR_OK, frames
+        return ERROR_NOMSG, frames
+
+    def traceFrames(self, frames):
+        now = time.monotonic_ns()
+        if self.dict_frames:
+            for frame in frames:
+                self.latency.add(now - frame["timestamp"])
+        else:
+            for frame in frames:
+                self.latency.add(now - frame.timestamp)
 
-        tbufdata = self.readRegisters(RXB[rxbn][SIDH], 5)
+    def enableLatencyTrace(self, capacity=65536):
+        """
+        Records, for every received frame, the time from its timestamp until
+        readMessage()/readMessages() return it or it is taken off the reader's
+        ring. Returns the mcp251x_stats.LatencyTrace, see getLatency().
+        """
+        import mcp251x_stats
+        self.latency = mcp251x_stats.LatencyTrace(capacity)
+        if self.ring is not None:
+            self.ring.latency = self.latency
+        return self.latency
+
+    def disableLatencyTrace(self):
+        self.latency = None
+        if self.ring is not None:
+            self.ring.latency = None
+
+    def getLatency(self, percentiles=None):
+        """
+        receive latency percentiles in us, None unless enableLatencyTrace()
+        """
+        if self.latency is None:
+            return None
+        return self.latency.snapshot(percentiles)
 
-        id = (tbufdata[MCP_SIDH]<<3) + (tbufdata[MCP_SIDL]>>5)
+    def getRxStatus(self):
+        with self.lock:
+            return self._getRxStatus()
 
-        if ( (tbufdata[MCP_SIDL] & TXB_EXIDE_MASK) ==  TXB_EXIDE_MASK ):
-            id = (id<<2) + (tbufdata[MCP_SIDL] & 0x03)
-            id = (id<<8) + tbufdata[MCP_EID8]
-            id = (id<<8) + tbufdata[MCP_EID0]
-            id |= CAN_EFF_FLAG
+    def _getRxStatus(self):
+        command = self._rxStatusCommand
+        command[0] = INSTRUCTION_RX_STATUS
+        return self.spi.xfer2(command)[1]
+
+    def rxOrder(self, rxstat):
+        """
+        returns the full RX buffers from an RX STATUS byte in arrival order
+        """
+        full = rxstat & RXSTATUS_RXB_MASK
+        last = self._rxLastFull
+        # every buffer read takes its bit out again, see _rxTaken()
+        self._rxLastFull = full
+        if full == RXSTATUS_RXB_MASK:
+            # with BUKT a frame only rolls over into RXB1 while RXB0 is full,
+            # so RXB0 is older unless RXB1 was already waiting on its own
+            # when we last looked or read
+            if last == RXSTATUS_RXB1:
+                return RX_ORDER_1_0
+            return RX_ORDER_0_1
+        if full == RXSTATUS_RXB0:
+            return RX_ORDER_0
+        if full == RXSTATUS_RXB1:
+            return RX_ORDER_1
+        return ()
+
+    def waitMessages(self, timeout=None):
+        """
+        Needs int_gpio. Blocks until the chip asserts INT, or timeout seconds
+        pass, then drains every full RX buffer. Returns rc and a list of frames.
+        """
+        if self.int_gpio is None:
+            return ERROR_FAIL, []
+
+        # INT is level triggered on the chip, if it is already low there will
+        # be no new edge to wait for
+        if not self.int_gpio.asserted():
+            if not self.int_gpio.wait(timeout):
+                return ERROR_NOMSG, []
+
+        rc, frames = self.readMessages(timestamp=self.interruptTimestamp())
+
+        if self.int_gpio.asserted():
+            self.serviceTx()
+        if self.int_gpio.asserted():
+            self.serviceErrors()
+            self.clearInterruptFlags()
+
+        if frames:
+            return ERROR_OK, frames
+        return ERROR_NOMSG, frames
+
+    def serviceErrors(self):
+        """
+        Handles ERRIF and MERRF: counts RX overflows per buffer and message
+        errors, follows TEC/REC and the error state, clears the flags and,
+        with busoff_recovery, brings the controller back from bus-off.
+        Costs one transaction when nothing is wrong. Returns EFLG.
+        """
+        events = []
+        with self.lock:
+            intf, eflg = self.readRegisters(MCP_CANINTF, 2)
+            flags = intf & (CANINTF_ERRIF | CANINTF_MERRF)
+            counters = self.errors
+            if flags or eflg or counters.state != ERROR_STATE_ACTIVE:
+                tec, rec = self.readRegisters(MCP_TEC, 2)
+                counters.update(tec, rec)
+
+                overflow = eflg & (EFLG_RX0OVR | EFLG_RX1OVR)
+                if eflg & EFLG_RX0OVR:
+                    counters.rx_overflows[RXB0] += 1
+                    events.append((ERROR_EVENT_RX_OVERFLOW, RXB0))
+                if eflg & EFLG_RX1OVR:
+                    counters.rx_overflows[RXB1] += 1
+                    events.append((ERROR_EVENT_RX_OVERFLOW, RXB1))
+                if intf & CANINTF_MERRF:
+                    counters.message_errors += 1
+                    events.append((ERROR_EVENT_MESSAGE_ERROR, None))
+                if intf & CANINTF_ERRIF:
+                    counters.error_interrupts += 1
+
+                # only the overflow bits of EFLG are writable
+                if overflow:
+                    self.modifyRegister(MCP_EFLG, overflow, 0)
+                if flags:
+                    self.modifyRegister(MCP_CANINTF, flags, 0)
+
+                state = errorState(eflg)
+                if state != counters.state:
+                    counters.state = state
+                    events.append((ERROR_EVENT_STATE, state))
+                    if state == ERROR_STATE_BUS_OFF:
+                        counters.bus_offs += 1
+                if state == ERROR_STATE_BUS_OFF and self.busoff_recovery:
+                    if self._recoverBusOff():
+                        events.append((ERROR_EVENT_RECOVERED, None))
+
+        if self.onError is not None:
+            for event, value in events:
+                self.onError(event, value)
+        return eflg
+
+    def _recoverBusOff(self):
+        # the chip leaves bus-off by itself after 128 x 11 recessive bits,
+        # passing through configuration mode clears TEC/REC at once. Not more
+        # often than every BUSOFF_RECOVERY_INTERVAL on a bus that keeps failing
+        now = time.monotonic()
+        if self._lastRecovery is not None and now - self._lastRecovery < BUSOFF_RECOVERY_INTERVAL:
+            return False
+        self._lastRecovery = now
+        mode = self._mode
+        if self.setConfigMode() != ERROR_OK:
+            return False
+        if mode is not None and mode != CANCTRL_REQOP_CONFIG:
+            if self.setMode(mode) != ERROR_OK:
+                return False
+        self.errors.recoveries += 1
+        self.errors.update(0, 0)
+        self.errors.state = ERROR_STATE_ACTIVE
+        self._serviceTx()
+        return True
+
+    def getErrorCounters(self):
+        return self.errors.snapshot()
+
+    def setSpiClock(self, hz):
+        with self.lock:
+            self.spi.max_speed_hz = hz
+            self.link.clock = hz
+
+    def calibrateSpi(self, clocks=None, rounds=None):
+        """
+        Finds the fastest SPI clock the wiring carries without corruption.
+        In configuration mode, writes test patterns to every filter and mask
+        register and reads them back rounds times per clock (default
+        SPI_CALIBRATION_ROUNDS), from the slowest of clocks (default
+        spi_clocks) up, stopping at the first clock that corrupts a byte.
+        The fastest clean clock is kept and becomes the top of spi_clocks,
+        the registers get their values back and the previous mode is
+        restored. Returns (rc, clock), ERROR_FAIL with the clock unchanged
+        if not even the slowest one is clean.
+
+        Frames arriving meanwhile are not received, call it before going to
+        normal mode.
+        """
+        if clocks is None:
+            clocks = self.spi_clocks
+        if rounds is None:
+            rounds = SPI_CALIBRATION_ROUNDS
+        clocks = sorted(set(clocks))
+        with self.lock:
+            previous = self.spi.max_speed_hz
+            with self.configure() as rc:
+                if rc != ERROR_OK:
+                    return rc, previous
+
+                # filters are undefined after reset, what the shadow does not
+                # know is read at the slowest clock to be put back
+                self.setSpiClock(clocks[0])
+                saved = []
+                for start, n in SPI_CALIBRATION_RANGES:
+                    data = self._readRegisters(start, n)
+                    for i in range(n):
+                        if self._shadowValid[start + i]:
+                            data[i] = self._shadow[start + i]
+                    saved.append((start, data))
+
+                self.link.calibration = {}
+                best = None
+                for clock in clocks:
+                    self.setSpiClock(clock)
+                    errors = self._testClock(rounds)
+                    self.link.calibration[clock] = errors
+                    if errors:
+                        break
+                    best = clock
+
+                self.setSpiClock(clocks[0] if best is None else best)
+                for start, data in saved:
+                    self.setRegisters(start, data)
+
+            if best is None:
+                self.setSpiClock(previous)
+                return ERROR_FAIL, previous
+            self.spi_clocks = [clock for clock in reversed(clocks) if clock <= best]
+            return rc, best
+
+    def _testClock(self, rounds):
+        # mismatching bytes over rounds of test patterns, in configuration
+        # mode with the lock held
+        errors = 0
+        patterns = SPI_TEST_PATTERNS
+        for r in range(rounds):
+            for start, n in SPI_CALIBRATION_RANGES:
+                values = [patterns[(i + r) % len(patterns)] for i in range(n)]
+                self.setRegisters(start, values)
+                data = self._readRegisters(start, n)
+                for i in range(n):
+                    if (data[i] ^ values[i]) & ~UNIMPLEMENTED_BITS.get(start + i, 0) & 0xFF:
+                        errors += 1
+        return errors
+
+    def lowerSpiClock(self):
+        """
+        steps down to the next slower of spi_clocks, returns it or None if
+        already at the slowest
+        """
+        with self.lock:
+            clock = self._slowerClock()
+            if clock is not None:
+                self.setSpiClock(clock)
+                self.link.clock_drops += 1
+            return clock
+
+    def _slowerClock(self):
+        current = self.spi.max_speed_hz
+        slower = [clock for clock in self.spi_clocks if clock < current]
+        if not slower:
+            return None
+        return max(slower)
+
+    def checkLink(self):
+        """
+        Reads the masks, CNF3..CNF1 and CANINTE back in one transaction and
+        compares them with the shadow. A mismatch lowers the SPI clock with
+        lowerSpiClock() and reads again. Registers that still differ took a
+        corrupted write and are rewritten from the shadow, which passes
+        through configuration mode; if they read exactly as before the
+        clock was not to blame and goes back up. Events go to onError as
+        with serviceErrors(). Returns the number of registers that differed.
+        """
+        events = []
+        with self.lock:
+            self.link.checks += 1
+            bad = self._linkMismatches()
+            if bad:
+                self.link.mismatches += 1
+                previous = self.spi.max_speed_hz
+                clock = self._slowerClock()
+                if clock is not None:
+                    self.setSpiClock(clock)
+                wrong = self._linkMismatches()
+                if clock is not None:
+                    if wrong == bad:
+                        self.setSpiClock(previous)
+                    else:
+                        self.link.clock_drops += 1
+                        events.append((ERROR_EVENT_SPI_CLOCK, clock))
+                if wrong:
+                    with self.configure() as rc:
+                        if rc == ERROR_OK:
+                            for reg, _ in wrong:
+                                self.setRegister(reg, self._shadow[reg])
+                            self.link.repairs += len(wrong)
+                            events.append((ERROR_EVENT_REPAIRED, len(wrong)))
+
+        if self.onError is not None:
+            for event, value in events:
+                self.onError(event, value)
+        return len(bad)
+
+    def _linkMismatches(self):
+        # (register, value read) where the chip disagrees with the shadow
+        data = self._readRegisters(LINK_CHECK_START, LINK_CHECK_LEN)
+        bad = []
+        for i in range(LINK_CHECK_LEN):
+            reg = LINK_CHECK_START + i
+            if self._shadowValid[reg] and \
+                    (data[i] ^ self._shadow[reg]) & ~UNIMPLEMENTED_BITS.get(reg, 0) & 0xFF:
+                bad.append((reg, data[i]))
+        return bad
+
+    def enableLinkCheck(self, interval=None):
+        """
+        has the reader thread, or a ControllerGroup's, call checkLink()
+        every interval seconds, default LINK_CHECK_INTERVAL
+        """
+        if interval is None:
+            interval = LINK_CHECK_INTERVAL
+        self.link_check_interval = interval
+        self._nextLinkCheck = time.monotonic() + interval
+
+    def disableLinkCheck(self):
+        self.link_check_interval = None
+
+    def serviceLink(self, now):
+        # checkLink() once link_check_interval has passed
+        if self.link_check_interval is None or now < self._nextLinkCheck:
+            return
+        self._nextLinkCheck = now + self.link_check_interval
+        self.checkLink()
+
+    def getLinkStats(self):
+        return self.link.snapshot()
+
+    def interruptTimestamp(self):
+        """
+        time.monotonic_ns() of the INT edge if int_gpio reports one, else now
+        """
+        edgeTimestamp = getattr(self.int_gpio, "edgeTimestamp", None)
+        if edgeTimestamp is not None:
+            edge = edgeTimestamp()
+            if edge is not None:
+                return edge
+        return time.monotonic_ns()
+
+    def clearInterruptFlags(self):
+        # anything other than RXnIF or the TXnIF of a buffer still owned by
+        # serviceTx() holding INT low (ERRIF, MERRF, WAKIF) has to be cleared
+        # or every following wait returns at once
+        with self.lock:
+            keep = CANINTF_RX0IF | CANINTF_RX1IF
+            for txbn in (TXB0, TXB1, TXB2):
+                if self._txInflight[txbn] is not None:
+                    keep |= TX_CANINTF[txbn]
+            intf = self.readRegister(MCP_CANINTF)
+            others = intf & ~keep & 0xFF
+            if others:
+                self.modifyRegister(MCP_CANINTF, others, 0)
+
+    def startReader(self, capacity=1024, poll_interval=None, poller=None):
+        """
+        Start a thread that drains both RX buffers into a FrameRing as soon as
+        frames arrive, waiting on int_gpio if there is one and polling
+        otherwise: on a PollScheduler, poller if given, or every
+        poll_interval seconds. Returns the ring.
+        """
+        if self._reader is not None:
+            return self.ring
+        if poller is None:
+            if poll_interval is not None:
+                poller = PollScheduler(poll_interval, poll_interval, 0)
+            else:
+                poller = PollScheduler()
+        self.poller = poller
+        self.ring = FrameRing(capacity, self.dict_frames)
+        self.ring.latency = self.latency
+        self._readerStop.clear()
+        self._reader = threading.Thread(target=self._readerLoop,
+                                        name="mcp251x-reader", daemon=True)
+        self._reader.start()
+        return self.ring
+
+    def stopReader(self):
+        if self._reader is None:
+            return
+        self._readerStop.set()
+        self._reader.join()
+        self._reader = None
+
+    def getPollStats(self):
+        """
+        the reader's PollScheduler.snapshot(), None before startReader()
+        """
+        if self.poller is None:
+            return None
+        return self.poller.snapshot()
+
+    def _readerLoop(self):
+        # ERRIF wakes an INT waiter, but without INT, and for a bus-off that
+        # outlasts one recovery attempt, errors are looked at periodically
+        nextErrorCheck = time.monotonic()
+        while not self._readerStop.is_set():
+            now = time.monotonic()
+            if now >= nextErrorCheck:
+                self.serviceErrors()
+                self.serviceLink(now)
+                nextErrorCheck = now + ERROR_CHECK_INTERVAL
+            timestamp = None
+            if self.int_gpio is not None:
+                # bounded wait so stopReader() is noticed
+                if not self.int_gpio.asserted() and not self.int_gpio.wait(0.1):
+                    continue
+                timestamp = self.interruptTimestamp()
+            start = time.perf_counter()
+            n = self.drainToRing(self.ring, timestamp)
+            if n and self.onReceive is not None:
+                self.onReceive()
+            if self.int_gpio is None:
+                time.sleep(self.poller.update(n, self.lastRxFull, time.perf_counter() - start))
+            elif n == 0 and self.int_gpio.asserted():
+                self.serviceErrors()
+                self.clearInterruptFlags()
+
+    def drainToRing(self, ring, timestamp=None, max_frames=None):
+        """
+        Read every full RX buffer straight into ring, returns the number of
+        frames read. Also keeps the TX buffers fed from the software queue.
+        With max_frames it stops looking again once that many were read.
+        """
+        n = 0
+        first = True
+        with self.lock:
+            while True:
+                if timestamp is None:
+                    timestamp = time.monotonic_ns()
+                order = self.rxOrder(self._getRxStatus())
+                if first:
+                    self.lastRxFull = len(order)
+                    first = False
+                for rxbn in order:
+                    response = self.readRxResponse(rxbn)
+                    dlc = response[RX_RESPONSE_DLC] & DLC_MASK
+                    if dlc <= CAN_MAX_DLEN:
+                        id = self.parseRxHeader(response, RX_RESPONSE_BASE)
+                        if self.rxAccept is not None and (id & RX_ACCEPT_KEY) not in self.rxAccept:
+                            continue
+                        ring.put(id, dlc, response, RX_RESPONSE_DATA, timestamp)
+                        n += 1
+                if len(order) < 2 or (max_frames is not None and n >= max_frames):
+                    break
+                timestamp = None
+            self._serviceTx()
+        if n:
+            ring.notify()
+        return n
+
+    def _rxTaken(self, rxbn):
+        # rxbn is being read, a buffer still full was there before whatever
+        # lands in rxbn next
+        self._rxLastFull &= ~RXSTATUS_RXB[rxbn]
+
+    def readMessage_rxbn(self, rxbn, timestamp=0):
+        self._rxTaken(rxbn)
+        tbufdata = self.readRegisters(RXB[rxbn][SIDH], 5)
+
+        id = self.parseId(tbufdata)
 
         dlc = (tbufdata[MCP_DLC] & DLC_MASK)
         if (dlc > CAN_MAX_DLEN):
             return ERROR_FAIL, None
 
+        if self.rxAccept is not None and id not in self.rxAccept:
+            self.modifyRegister(MCP_CANINTF, RXB[rxbn][CANINTF_RXnIF], 0)
+            return ERROR_NOMSG, None
+
         ctrl = self.readRegister(RXB[rxbn][CTRL])
         if (ctrl & RXBnCTRL_RTR):
             id |= CAN_RTR_FLAG
 
-        frame["can_id"] = id
-        frame["can_dlc"] = dlc
-
-        frame["data"] = self.readRegisters(RXB[rxbn][DATA], dlc)
+        frame = self.makeFrame(id, dlc, self.readRegisters(RXB[rxbn][DATA], dlc), timestamp)
 
         self.modifyRegister(MCP_CANINTF, RXB[rxbn][CANINTF_RXnIF], 0)
 
         return ERROR_OK, frame
 
+    def readMessage_rxbn_fast(self, rxbn, timestamp=0):
+        response = self.readRxResponse(rxbn)
+
+        dlc = (response[RX_RESPONSE_DLC] & DLC_MASK)
+        if (dlc > CAN_MAX_DLEN):
+            return ERROR_FAIL, None
+
+        id = self.parseRxHeader(response, RX_RESPONSE_BASE)
+        if self.rxAccept is not None and (id & RX_ACCEPT_KEY) not in self.rxAccept:
+            return ERROR_NOMSG, None
+
+        frame = self.makeFrame(id, dlc, response[RX_RESPONSE_DATA:RX_RESPONSE_DATA + dlc], timestamp)
+
+        return ERROR_OK, frame
+
+    def makeFrame(self, id, dlc, data, timestamp=0):
+        if self.dict_frames:
+            frame = {}
+            frame["can_id"] = id
+            frame["can_dlc"] = dlc
+            frame["data"] = data
+            frame["timestamp"] = timestamp
+            # see CanFrame.filter, readMessages() fills it in when it can
+            frame["filter"] = None
+            return frame
+        return CanFrame(id, bytes(data), dlc, timestamp)
+
+    def readRxBuffer(self, rxbn):
+        """
+        returns SIDH..D7 of an RX buffer
+        """
+        return self.readRxResponse(rxbn)[RX_RESPONSE_BASE:]
+
+    def readRxResponse(self, rxbn):
+        """
+        READ RX BUFFER as clocked in, SIDH..D7 from RX_RESPONSE_BASE on. The
+        list is reused by the next read, with self.lock held
+        """
+        # READ RX BUFFER clocks out SIDH..D7 in one burst and the chip clears
+        # RXnIF itself when CS goes high, so no separate BITMOD is needed.
+        # The chip ignores what is clocked in after the instruction
+        self._rxTaken(rxbn)
+        command = self._readRxCommand
+        command[0] = READ_RX[rxbn]
+        return self.spi.xfer2(command)
+
+    def parseRxHeader(self, tbufdata, base=0):
+        id = self.parseId(tbufdata, base)
+
+        # RXBnCTRL.RXRTR is not part of the burst, take RTR from the header:
+        # SRR in SIDL for standard frames, RTR in DLC for extended frames
+        if (id & CAN_EFF_FLAG):
+            if (tbufdata[base + MCP_DLC] & RTR_MASK):
+                id |= CAN_RTR_FLAG
+        elif (tbufdata[base + MCP_SIDL] & SIDL_SRR):
+            id |= CAN_RTR_FLAG
+
+        return id
+
+    def parseId(self, tbufdata, base=0):
+        """
+        tbufdata is SIDH, SIDL, EID8, EID0 as laid out in the buffer
+        registers, starting at base
+        """
+        sidl = tbufdata[base + MCP_SIDL]
+        id = SIDH_ID[tbufdata[base + MCP_SIDH]] | (sidl >> 5)
+
+        if (sidl & TXB_EXIDE_MASK):
+            id = (id << 18) | ((sidl & 0x03) << 16) | \
+                (tbufdata[base + MCP_EID8] << 8) | tbufdata[base + MCP_EID0]
+            id |= CAN_EFF_FLAG
+
+        return id
+
+
+    def sendMessage(self, frame, callback=None):
+        return self.sendMessages([frame], callback)
+
+    def sendMessages(self, frames, callback=None):
+        """
+        frames is a list of CanFrame or {"can_id", "data"[, "can_dlc"]}
+        dicts. They are queued in arbitration order and as many as fit are
+        loaded into the TX buffers straight away, the rest go out on later
+        sendMessages()/serviceTx() calls.
+        """
+        with self.lock:
+            rc = self.queueMessages(frames, callback)
+            if rc == ERROR_OK:
+                self._serviceTx()
+        return rc
+
+    def queueMessages(self, frames, callback=None):
+        """
+        Like sendMessages() but only queues, no SPI traffic until the next
+        serviceTx(). callback, if given, is called with ERROR_OK once a frame's
+        TXnIF is seen or ERROR_FAILTX if its buffer was aborted.
+        """
+        txbufs = []
+        for frame in frames:
+            txbuf = self.prepareTxBuffer(frame)
+            if txbuf is None:
+                return ERROR_FAILTX
+            txbufs.append(txbuf)
+
+        return self.queueTxBuffers([(self.arbitrationKey(txbuf), txbuf, callback)
+                                    for txbuf in txbufs])
+
+    def queueTxBuffers(self, entries):
+        """
+        queues (arbitration key, txbuf, callback) entries built beforehand
+        with prepareTxBuffer() and arbitrationKey(), all of them or none.
+        The txbuf lists are not copied, they are read when loaded into a TX
+        buffer.
+        """
+        with self.lock:
+            if len(self._txQueue) + len(entries) > self.tx_queue_size:
+                return ERROR_ALLTXBUSY
+
+            for key, txbuf, callback in entries:
+                heapq.heappush(self._txQueue, [key, self._txSeq, txbuf, callback])
+                self._txSeq += 1
+        return ERROR_OK
+
+    def serviceTx(self):
+        """
+        Retire finished TX buffers, then load queued frames into every free
+        one and request transmission of all of them with a single RTS.
+        Returns the number of frames loaded.
+        """
+        with self.lock:
+            return self._serviceTx()
+
+    def _serviceTx(self):
+        if not self._txQueue and self._txInflight == [None, None, None]:
+            return 0
+
+        stat = self._getStatus()
+
+        pending = []
+        done = 0
+        for txbn in (TXB0, TXB1, TXB2):
+            entry = self._txInflight[txbn]
+            if stat & STAT_TXREQ[txbn]:
+                if entry is not None:
+                    pending.append((entry[0], entry[1], txbn))
+            elif entry is not None:
+                self._txInflight[txbn] = None
+                done |= TX_CANINTF[txbn]
+                if entry[3] is not None:
+                    entry[3](ERROR_OK if stat & STAT_TXIF[txbn] else ERROR_FAILTX)
+
+        # TXnIF has to be clear before the buffer is reused, otherwise the
+        # next frame in it would look finished straight away
+        if done:
+            self.modifyRegister(MCP_CANINTF, done, 0)
+
+        loaded = 0
+        rts = 0
+        for i in range(3):
+            txbn = (self._txNext + i) % 3
+            if self._txInflight[txbn] is not None:
+                continue
+            if not self._txQueue:
+                break
+
+            entry = heapq.heappop(self._txQueue)
+            self.prioritiseTx(pending, (entry[0], entry[1], txbn))
+
+            txbuf = entry[2]
+            n = len(txbuf)
+            self._loadTxCommands[txbn][1:1 + n] = txbuf
+            self.writeCommand(self._loadTxViews[txbn][1 + n])
+            self._txInflight[txbn] = entry
+            rts |= RTS_TX[txbn]
+            loaded += 1
+
+        if rts:
+            self.writeCommand(RTS_COMMANDS[rts])
+            self._txNext = (self._txNext + loaded) % 3
+
+        return loaded
+
+    def prioritiseTx(self, pending, new):
+        """
+        TXP breaks ties between pending buffers, and among equal TXP the chip
+        sends the highest buffer number first. Keeps the TXP of pending
+        buffers strictly in (arbitration key, queue order) so the chip's
+        order matches what arbitration on the bus would do and frames with
+        one id leave in the order they were queued. pending holds
+        (key, sequence, txbn) of buffers still waiting and gets new added.
+        """
+        pending.append(new)
+        pending.sort()
+        i = pending.index(new)
+        above = 4
+        for _, _, txbn in pending[:i]:
+            above = min(above, self._txPriority[txbn])
+        below = -1
+        for _, _, txbn in pending[i + 1:]:
+            below = max(below, self._txPriority[txbn])
+
+        if above - 1 > below:
+            # highest free level, leaves room for the next frame queued
+            # behind this one
+            levels = [(new[2], above - 1)]
+        else:
+            levels = [(txbn, 3 - n) for n, (_, _, txbn) in enumerate(pending)]
+        for txbn, priority in levels:
+            if priority != self._txPriority[txbn]:
+                self.modifyRegister(TXB[txbn][CTRL], TXBnCTRL_TXP, priority)
+                self._txPriority[txbn] = priority
+
+    def _abortTx(self):
+        # the chip forgets its TX buffers on reset: everything loaded or
+        # queued completes with ERROR_FAILTX so nobody waits for it forever
+        with self.lock:
+            entries = [entry for entry in self._txInflight if entry is not None]
+            entries.extend(sorted(self._txQueue))
+            self._txInflight = [None, None, None]
+            self._txPriority = [0, 0, 0]
+            self._txQueue = []
+            for entry in entries:
+                if entry[3] is not None:
+                    entry[3](ERROR_FAILTX)
+
+    def txQueued(self):
+        """
+        number of frames still waiting for a TX buffer in software
+        """
+        return len(self._txQueue)
+
+    def txPending(self):
+        """
+        number of frames queued in software or waiting in a TX buffer as of
+        the last serviceTx()
+        """
+        return len(self._txQueue) + 3 - self._txInflight.count(None)
+
+    def prepareTxBuffer(self, frame):
+        """
+        returns SIDH, SIDL, EID8, EID0, DLC and data as loaded by LOAD TX BUFFER
+        """
+        if isinstance(frame, dict):
+            id = frame["can_id"]
+            data = frame["data"]
+            dlc = frame.get("can_dlc", len(data))
+        else:
+            id = frame.can_id
+            data = frame.data
+            dlc = frame.can_dlc
+        if dlc > CAN_MAX_DLEN or len(data) > CAN_MAX_DLEN:
+            return None
+
+        ext = (id & CAN_EFF_FLAG) != 0
+        rtr = (id & CAN_RTR_FLAG) != 0
+
+        txbuf = bytearray(self.prepareId(ext, id & (CAN_EFF_MASK if ext else CAN_SFF_MASK)))
+        txbuf.append((dlc | RTR_MASK) if rtr else dlc)
+        if not rtr:
+            txbuf.extend(data[:dlc])
+            if dlc > len(data):
+                txbuf.extend(bytes(dlc - len(data)))
+
+        return txbuf
+
+    def arbitrationKey(self, txbuf):
+        """
+        orders frames the way bus arbitration does: base id, then IDE,
+        then extended id, then RTR
+        """
+        key = (txbuf[MCP_SIDH] << 3) | (txbuf[MCP_SIDL] >> 5)
+        key = (key << 1) | ((txbuf[MCP_SIDL] & TXB_EXIDE_MASK) >> 3)
+        key = (key << 2) | (txbuf[MCP_SIDL] & 0x03)
+        key = (key << 8) | txbuf[MCP_EID8]
+        key = (key << 8) | txbuf[MCP_EID0]
+        key = (key << 1) | ((txbuf[MCP_DLC] & RTR_MASK) >> 6)
+        return key
+
 
     def reset(self):
         self.spi.xfer2([INSTRUCTION_RESET])
+        self.resetShadow()
+        self.errors.state = ERROR_STATE_ACTIVE
+        self.errors.update(0, 0)
+        self.rxAccept = None
+        # the chip comes out of reset in configuration mode
+        self._mode = CANCTRL_REQOP_CONFIG
+        self._abortTx()
 
         time.sleep(0.010)
 
@@ -82,38 +1529,118 @@ class MCP251x():
         self.setRegisters(MCP_TXB1CTRL, zeros)
         self.setRegisters(MCP_TXB2CTRL, zeros)
 
-        self.setRegister(MCP_RXB0CTRL, 0)
-        self.setRegister(MCP_RXB1CTRL, 0)
+        config = {}
 
-        self.setRegister(MCP_CANINTE, CANINTF_RX0IF | CANINTF_RX1IF | CANINTF_ERRIF | CANINTF_MERRF)
+        caninte = CANINTF_RX0IF | CANINTF_RX1IF | CANINTF_ERRIF | CANINTF_MERRF
+        if self.int_gpio is not None:
+            # wake INT waiters when a TX buffer completes as well
+            caninte |= CANINTF_TX0IF | CANINTF_TX1IF | CANINTF_TX2IF
+        config[MCP_CANINTE] = caninte
 
         # receives all valid messages using either Standard or Extended Identifiers that
         # meet filter criteria. RXF0 is applied for RXB0, RXF1 is applied for RXB1
-        self.modifyRegister(MCP_RXB0CTRL,
-                       RXBnCTRL_RXM_MASK | RXB0CTRL_BUKT | RXB0CTRL_FILHIT_MASK,
-                       RXBnCTRL_RXM_STDEXT | RXB0CTRL_BUKT | RXB0CTRL_FILHIT)
-        self.modifyRegister(MCP_RXB1CTRL,
-                       RXBnCTRL_RXM_MASK | RXB1CTRL_FILHIT_MASK,
-                       RXBnCTRL_RXM_STDEXT | RXB1CTRL_FILHIT)
+        config[MCP_RXB0CTRL] = RXBnCTRL_RXM_STDEXT | RXB0CTRL_BUKT | RXB0CTRL_FILHIT
+        config[MCP_RXB1CTRL] = RXBnCTRL_RXM_STDEXT | RXB1CTRL_FILHIT
+
+        self.openFilterConfig(config)
+
+        # one burst per contiguous register range instead of one per filter
+        return self.writeConfig(config)
 
+    def openFilterConfig(self, config):
+        """
+        adds filters and masks passing every frame to a writeConfig() dict
+        """
         # clear filters and masks
         # do not filter any standard frames for RXF0 used by RXB0
         # do not filter any extended frames for RXF1 used by RXB1
-        filters = [RXF0, RXF1, RXF2, RXF3, RXF4, RXF5]
-        for i in range(len(filters)):
+        for i in range(len(FILTER_SIDH)):
             ext = (i == 1)
-            result = self.setFilter(filters[i], ext, 0)
-            if result != ERROR_OK:
-                return result
+            self.idConfig(config, FILTER_SIDH[i], ext, 0)
+
+        for reg in MASK_SIDH:
+            self.idConfig(config, reg, True, 0)
+        return config
+
+    def idConfig(self, config, reg, ext, id):
+        """
+        adds the four id registers starting at reg to a writeConfig() dict
+        """
+        buffer = self.prepareId(ext, id)
+        for i in range(4):
+            config[reg + i] = buffer[i]
+        return config
+
+
+    def resetShadow(self):
+        """
+        Forget the register shadow except for the values the chip has after
+        a reset. Filters and masks are undefined after reset so they are
+        read from the chip until written.
+        """
+        self._shadow = bytearray(0x80)
+        self._shadowValid = bytearray(0x80)
+        for reg in SHADOW_RESET_KNOWN:
+            self._shadowValid[reg] = 1
+        self._shadow[MCP_CANCTRL] = CANCTRL_RESET
+
+    def isShadowed(self, reg, n=1):
+        for r in range(reg, reg + n):
+            if not self._shadowValid[r] or r in SHADOW_VOLATILE:
+                return False
+        return True
+
+    def writeConfig(self, values):
+        """
+        values maps register addresses to values. Registers whose shadow
+        already holds the value are skipped, the rest go out as few
+        contiguous WRITE bursts as possible. Enters configuration mode first
+        if a filter, mask or CNFn register changes.
+        """
+        changed = []
+        for reg in sorted(values):
+            keep = ~SHADOW_VOLATILE.get(reg, 0)
+            if self._shadowValid[reg] and (self._shadow[reg] ^ values[reg]) & keep & 0xFF == 0:
+                continue
+            changed.append(reg)
+
+        if not changed:
+            return ERROR_OK
+
+        for reg in changed:
+            if reg in CONFIG_ONLY_REGISTERS:
+                res = self.setConfigMode()
+                if res != ERROR_OK:
+                    return res
+                break
+
+        # bridge short gaps with the shadow's own values, a couple of extra
+        # bytes are cheaper than another transaction
+        runs = []
+        for reg in changed:
+            if runs and reg - runs[-1][1] - 1 <= SHADOW_MERGE_GAP and \
+                    self.isBridgeable(runs[-1][1] + 1, reg):
+                runs[-1][1] = reg
+            else:
+                runs.append([reg, reg])
 
-        masks = [MASK0, MASK1]
-        for i in range(len(masks)):
-            result = self.setFilterMask(masks[i], True, 0)
-            if (result != ERROR_OK):
-                return result
+        for start, end in runs:
+            data = []
+            for reg in range(start, end + 1):
+                if reg in values:
+                    data.append(values[reg] & 0xFF)
+                else:
+                    data.append(self._shadow[reg])
+            self.setRegisters(start, data)
 
         return ERROR_OK
 
+    def isBridgeable(self, start, end):
+        for reg in range(start, end):
+            if reg == MCP_CANCTRL or not self._shadowValid[reg] or reg in SHADOW_VOLATILE:
+                return False
+        return True
+
 
     def setRegister(self, reg, value):
         self.setRegisters(reg, [value])
@@ -122,9 +1649,17 @@ class MCP251x():
         """
         values is an array/list
         """
-        command = [INSTRUCTION_WRITE, reg]
-        command += values
-        self.spi.xfer2(command)
+        n = len(values)
+        with self.lock:
+            command = self._writeCommand
+            command[1] = reg
+            command[2:2 + n] = bytes(values)
+            self.writeCommand(self._writeViews[2 + n])
+
+            for i in range(n):
+                if reg + i in SHADOW_REGISTERS:
+                    self._shadow[reg + i] = values[i] & 0xFF
+                    self._shadowValid[reg + i] = 1
 
     def setFilter(self, num, ext, ulData):
         res = self.setConfigMode()
@@ -146,10 +1681,8 @@ class MCP251x():
         else:
             return ERROR_FAIL
 
-        buffer = self.prepareId(ext, ulData)
-        self.setRegisters(reg, buffer)
-
-        return ERROR_OK
+        self.rxAccept = None
+        return self.writeConfig(self.idConfig({}, reg, ext, ulData))
 
     def setConfigMode(self):
         return self.setMode(CANCTRL_REQOP_CONFIG)
@@ -157,20 +1690,72 @@ class MCP251x():
     def setNormalMode(self):
         return self.setMode(CANCTRL_REQOP_NORMAL)
 
+    def setLoopbackMode(self):
+        """
+        transmitted frames are received back through the filters and
+        nothing reaches the bus, see loopback.py
+        """
+        return self.setMode(CANCTRL_REQOP_LOOPBACK)
+
+    def setListenOnlyMode(self):
+        """
+        receives without ever driving the bus, no ACKs or error frames
+        """
+        return self.setMode(CANCTRL_REQOP_LISTENONLY)
+
     def setMode(self, mode):
+        """
+        Requests an operation mode and waits up to mode_timeout seconds for
+        CANSTAT to report it. The mode reached is cached, so asking for the
+        current mode again costs no SPI at all.
+        """
+        if mode == self._mode:
+            return ERROR_OK
+        self._mode = None
         self.modifyRegister(MCP_CANCTRL, CANCTRL_REQOP, mode)
-        endTime = time.time() + 10
-        modeMatch = False
-        while time.time() < endTime:
+        # the chip only leaves normal mode after the frame on the bus, which
+        # takes up to a few ms at low bitrates, so poll with growing sleeps
+        # instead of spinning
+        endTime = time.monotonic() + self.mode_timeout
+        delay = MODE_POLL_MIN
+        while True:
             newmode = self.readRegister(MCP_CANSTAT)
             newmode &= CANSTAT_OPMOD
-            modeMatch = (newmode == mode)
-            if modeMatch:
-                break
-        if modeMatch:
-            return ERROR_OK
-        else:
-            return ERROR_FAIL
+            if newmode == mode:
+                self._mode = mode
+                return ERROR_OK
+            remaining = endTime - time.monotonic()
+            if remaining <= 0:
+                return ERROR_FAIL
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, MODE_POLL_MAX)
+
+    def getMode(self):
+        """
+        reads the operation mode from CANSTAT and refreshes the cached one
+        """
+        self._mode = self.readRegister(MCP_CANSTAT) & CANSTAT_OPMOD
+        return self._mode
+
+    @contextlib.contextmanager
+    def configure(self):
+        """
+        Enters configuration mode once for a group of changes and goes back
+        to the previous mode afterwards, yields the setConfigMode() result:
+
+            with can.configure() as rc:
+                can.setBitrate(CAN_500KBPS, MCP_16MHZ)
+                can.setFilterMask(MASK0, False, 0x7FF)
+                can.setFilter(RXF0, False, 0x123)
+        """
+        with self.lock:
+            previous = self._mode
+            rc = self.setConfigMode()
+            try:
+                yield rc
+            finally:
+                if rc == ERROR_OK and previous is not None:
+                    self.setMode(previous)
 
     def prepareId(self, ext, id):
         buffer = [0, 0, 0, 0]
@@ -199,8 +1784,6 @@ class MCP251x():
             return res
         
         
-        tbufdata = self.prepareId(ext, ulData)
-
         # REGISTER reg;
         if mask == MASK0:
             reg = MCP_RXM0SIDH
@@ -209,8 +1792,47 @@ class MCP251x():
         else:
             return ERROR_FAIL
 
-        self.setRegisters(reg, tbufdata)
-        return ERROR_OK
+        self.rxAccept = None
+        return self.writeConfig(self.idConfig({}, reg, ext, ulData))
+
+    def setAcceptanceFilters(self, std=(), ext=(), patterns=()):
+        """
+        Programs the masks and filters to pass the given standard and
+        extended ids, each either an id or an inclusive (first, last) range,
+        and (ext, id, mask) patterns, letting through as few others as
+        possible. Whatever still gets through unasked is dropped in software
+        by the read paths. Returns rc and the mcp251x_filters.FilterPlan,
+        whose false_accepts and falseAcceptIds() tell what the hardware lets
+        through.
+        """
+        import mcp251x_filters
+        plan = mcp251x_filters.compileFilters(std, ext, patterns)
+        return self.applyFilterPlan(plan), plan
+
+    def clearFilters(self):
+        """
+        opens the masks and filters again, as after reset()
+        """
+        with self.configure() as rc:
+            if rc == ERROR_OK:
+                rc = self.writeConfig(self.openFilterConfig({}))
+        if rc == ERROR_OK:
+            self.rxAccept = None
+        return rc
+
+    def applyFilterPlan(self, plan):
+        config = {}
+        for i, (ext, id) in enumerate(plan.filters):
+            self.idConfig(config, FILTER_SIDH[i], ext, id)
+        for i, mask in enumerate(plan.masks):
+            self.idConfig(config, MASK_SIDH[i], True, mask)
+
+        with self.configure() as rc:
+            if rc == ERROR_OK:
+                rc = self.writeConfig(config)
+        if rc == ERROR_OK:
+            self.rxAccept = plan.accept
+        return rc
 
 
     def setBitrate(self, canSpeed, canClock):
@@ -439,10 +2061,7 @@ class MCP251x():
             set = 0
 
         if (set):
-            self.setRegister(MCP_CNF1, cfg1)
-            self.setRegister(MCP_CNF2, cfg2)
-            self.setRegister(MCP_CNF3, cfg3)
-            return ERROR_OK
+            return self.writeConfig({MCP_CNF1: cfg1, MCP_CNF2: cfg2, MCP_CNF3: cfg3})
         else:
             return ERROR_FAIL
 
@@ -667,9 +2286,13 @@ CANSTAT_ICOD = 0x0E
 
 CNF3_SOF = 0x80
 
+TXBnCTRL_TXREQ = 0x08
+TXBnCTRL_TXP   = 0x03
+
 TXB_EXIDE_MASK = 0x08
 DLC_MASK       = 0x0F
 RTR_MASK       = 0x40
+SIDL_SRR       = 0x10
 
 RXBnCTRL_RXM_STD    = 0x20
 RXBnCTRL_RXM_EXT    = 0x40
@@ -696,8 +2319,61 @@ STAT_RX1IF = (1<<1)
 
 STAT_RXIF_MASK = STAT_RX0IF | STAT_RX1IF
 
+# RX STATUS instruction result
+RXSTATUS_RXB0     = (1<<6)
+RXSTATUS_RXB1     = (1<<7)
+RXSTATUS_RXB_MASK = RXSTATUS_RXB0 | RXSTATUS_RXB1
+RXSTATUS_RXB = [RXSTATUS_RXB0, RXSTATUS_RXB1]
+RXSTATUS_EXT      = (1<<4)
+RXSTATUS_RTR      = (1<<3)
+RXSTATUS_FILHIT   = 0x07
+
+# filter number for each RX STATUS filter hit code, 6 and 7 are RXF0 and
+# RXF1 with the frame rolled over into RXB1
+RXSTATUS_FILTER = [0, 1, 2, 3, 4, 5, 0, 1]
+
+STAT_TX0REQ = (1<<2)
+STAT_TX0IF  = (1<<3)
+STAT_TX1REQ = (1<<4)
+STAT_TX1IF  = (1<<5)
+STAT_TX2REQ = (1<<6)
+STAT_TX2IF  = (1<<7)
+
+STAT_TXREQ = [STAT_TX0REQ, STAT_TX1REQ, STAT_TX2REQ]
+STAT_TXIF = [STAT_TX0IF, STAT_TX1IF, STAT_TX2IF]
+TX_CANINTF = [CANINTF_TX0IF, CANINTF_TX1IF, CANINTF_TX2IF]
+
 EFLG_ERRORMASK = EFLG_RX1OVR | EFLG_RX0OVR | EFLG_TXBO | EFLG_TXEP | EFLG_RXEP
 
+# see MCP251x.serviceErrors()
+ERROR_STATE_ACTIVE  = 0
+ERROR_STATE_WARNING = 1
+ERROR_STATE_PASSIVE = 2
+ERROR_STATE_BUS_OFF = 3
+ERROR_STATE_NAMES = ["active", "warning", "passive", "bus-off"]
+
+ERROR_EVENT_RX_OVERFLOW   = 0 # value is RXB0 or RXB1
+ERROR_EVENT_MESSAGE_ERROR = 1
+ERROR_EVENT_STATE         = 2 # value is the new ERROR_STATE_*
+ERROR_EVENT_RECOVERED     = 3 # back to error active after bus-off
+ERROR_EVENT_SPI_CLOCK     = 4 # value is the lowered SPI clock in Hz
+ERROR_EVENT_REPAIRED      = 5 # value is the number of registers rewritten
+
+# PollScheduler: weight of a new sample in the moving averages, and the
+# factor an empty poll stretches the interval by
+POLL_AVERAGE_WEIGHT = 0.1
+POLL_BACKOFF = 1.5
+POLL_FRAMES_TARGET = 0.5
+
+# seconds between serviceErrors() calls of the reader thread, and at least
+# between two bus-off recoveries
+ERROR_CHECK_INTERVAL = 0.1
+BUSOFF_RECOVERY_INTERVAL = 0.1
+
+# seconds between checkLink() calls of the reader thread after
+# enableLinkCheck()
+LINK_CHECK_INTERVAL = 1.0
+
 
 # instructions
 INSTRUCTION_WRITE       = 0x02
@@ -710,12 +2386,32 @@ INSTRUCTION_RTS_TX0     = 0x81
 INSTRUCTION_RTS_TX1     = 0x82
 INSTRUCTION_RTS_TX2     = 0x84
 INSTRUCTION_RTS_ALL     = 0x87
+INSTRUCTION_RTS         = 0x80
 INSTRUCTION_READ_RX0    = 0x90
 INSTRUCTION_READ_RX1    = 0x94
 INSTRUCTION_READ_STATUS = 0xA0
 INSTRUCTION_RX_STATUS   = 0xB0
 INSTRUCTION_RESET       = 0xC0
 
+INSTRUCTION_NAMES = {
+    INSTRUCTION_WRITE: "WRITE",
+    INSTRUCTION_READ: "READ",
+    INSTRUCTION_BITMOD: "BITMOD",
+    INSTRUCTION_READ_STATUS: "READ_STATUS",
+    INSTRUCTION_RX_STATUS: "RX_STATUS",
+    INSTRUCTION_RESET: "RESET",
+}
+
+def instructionName(instruction):
+    # READ RX BUFFER, LOAD TX BUFFER and RTS carry arguments in the low bits
+    if instruction & 0xF9 == INSTRUCTION_READ_RX0:
+        return "READ_RX"
+    if instruction & 0xF8 == INSTRUCTION_LOAD_TX0:
+        return "LOAD_TX"
+    if instruction & 0xF8 == INSTRUCTION_RTS:
+        return "RTS"
+    return INSTRUCTION_NAMES.get(instruction, hex(instruction))
+
 # registers
 MCP_RXF0SIDH = 0x00
 MCP_RXF0SIDL = 0x01
@@ -795,6 +2491,83 @@ MCP_RXB1EID0 = 0x74
 MCP_RXB1DLC  = 0x75
 MCP_RXB1DATA = 0x76
 
+MCP_BFPCTRL   = 0x0C
+MCP_TXRTSCTRL = 0x0D
+
+CANCTRL_RESET = 0x87
+
+# registers that accept BIT MODIFY, on any other the mask is taken as 0xFF
+BITMOD_REGISTERS = frozenset([
+    MCP_BFPCTRL, MCP_TXRTSCTRL, MCP_CANCTRL,
+    MCP_CNF3, MCP_CNF2, MCP_CNF1,
+    MCP_CANINTE, MCP_CANINTF, MCP_EFLG,
+    MCP_TXB0CTRL, MCP_TXB1CTRL, MCP_TXB2CTRL,
+    MCP_RXB0CTRL, MCP_RXB1CTRL,
+])
+
+# the chip ignores writes to these outside configuration mode
+CONFIG_ONLY_REGISTERS = frozenset(
+    list(range(MCP_RXF0SIDH, MCP_RXF2EID0 + 1)) +
+    list(range(MCP_RXF3SIDH, MCP_RXF5EID0 + 1)) +
+    list(range(MCP_RXM0SIDH, MCP_CNF1 + 1))
+)
+
+# registers mirrored in the driver, see MCP251x.writeConfig()
+SHADOW_REGISTERS = CONFIG_ONLY_REGISTERS | frozenset([
+    MCP_CANINTE, MCP_CANCTRL, MCP_RXB0CTRL, MCP_RXB1CTRL,
+])
+
+# shadowed registers with a known value after reset
+SHADOW_RESET_KNOWN = [
+    MCP_CNF3, MCP_CNF2, MCP_CNF1, MCP_CANINTE, MCP_CANCTRL,
+    MCP_RXB0CTRL, MCP_RXB1CTRL,
+]
+
+# bits the chip changes by itself, never served from the shadow
+SHADOW_VOLATILE = {
+    MCP_RXB0CTRL: RXBnCTRL_RTR | RXB0CTRL_FILHIT_MASK,
+    MCP_RXB1CTRL: RXBnCTRL_RTR | RXB1CTRL_FILHIT_MASK,
+}
+
+# longest run of unchanged registers writeConfig() writes through to save
+# a transaction
+SHADOW_MERGE_GAP = 3
+
+# first and longest sleep in seconds while setMode() waits for CANSTAT
+MODE_POLL_MIN = 0.00005
+MODE_POLL_MAX = 0.005
+
+FILTER_SIDH = [MCP_RXF0SIDH, MCP_RXF1SIDH, MCP_RXF2SIDH, MCP_RXF3SIDH, MCP_RXF4SIDH, MCP_RXF5SIDH]
+MASK_SIDH = [MCP_RXM0SIDH, MCP_RXM1SIDH]
+
+# bits that read back as 0 whatever was written, see calibrateSpi()
+UNIMPLEMENTED_BITS = dict(
+    [(reg + MCP_SIDL, 0x14) for reg in FILTER_SIDH] +
+    [(reg + MCP_SIDL, 0x1C) for reg in MASK_SIDH] +
+    [(MCP_CNF3, 0x38)]
+)
+
+# SPI clocks calibrateSpi() tries and checkLink() steps down through, the
+# MCP2515 is specified up to 10MHz
+SPI_CLOCKS = [10000000, 8000000, 5000000, 4000000, 2000000, 1000000, 500000]
+
+# calibrateSpi() writes and reads back all filter and mask registers, in
+# three bursts, this many times per clock. Register i gets pattern
+# (i + round) % len(SPI_TEST_PATTERNS), so neighbours always differ and
+# every register sees every pattern
+SPI_CALIBRATION_RANGES = [
+    (MCP_RXF0SIDH, MCP_RXF2EID0 - MCP_RXF0SIDH + 1),
+    (MCP_RXF3SIDH, MCP_RXF5EID0 - MCP_RXF3SIDH + 1),
+    (MCP_RXM0SIDH, MCP_RXM1EID0 - MCP_RXM0SIDH + 1),
+]
+SPI_CALIBRATION_ROUNDS = 24
+SPI_TEST_PATTERNS = [0x55, 0xAA, 0x00, 0xFF, 0x01, 0x80, 0x33, 0xCC, 0x0F, 0xF0, 0x69, 0x96]
+
+# registers checkLink() reads back and compares with the shadow: the
+# masks, CNF3..CNF1 and CANINTE, which never change by themselves
+LINK_CHECK_START = MCP_RXM0SIDH
+LINK_CHECK_LEN = MCP_CANINTE - MCP_RXM0SIDH + 1
+
 CTRL = 0
 SIDH = 1
 DATA = 2
@@ -816,11 +2589,40 @@ RXB = [
     [MCP_RXB1CTRL, MCP_RXB1SIDH, MCP_RXB1DATA, CANINTF_RX1IF]
 ]
 
+READ_RX = [INSTRUCTION_READ_RX0, INSTRUCTION_READ_RX1]
+
+RX_ORDER_0 = (RXB0,)
+RX_ORDER_1 = (RXB1,)
+RX_ORDER_0_1 = (RXB0, RXB1)
+RX_ORDER_1_0 = (RXB1, RXB0)
+LOAD_TX = [INSTRUCTION_LOAD_TX0, INSTRUCTION_LOAD_TX1, INSTRUCTION_LOAD_TX2]
+# low bits of INSTRUCTION_RTS, or them together to start several buffers
+RTS_TX = [INSTRUCTION_RTS_TX0 & 0x07, INSTRUCTION_RTS_TX1 & 0x07, INSTRUCTION_RTS_TX2 & 0x07]
+
+# SIDH, SIDL, EID8, EID0, DLC and 8 data bytes
+RX_BUFFER_LEN = 13
+# where a READ RX BUFFER response holds the frame, after the instruction
+RX_RESPONSE_BASE = 1
+RX_RESPONSE_DLC = RX_RESPONSE_BASE + MCP_DLC
+RX_RESPONSE_DATA = RX_RESPONSE_BASE + MCP_DATA
+
+# RTS instruction for every combination of RTS_TX bits
+RTS_COMMANDS = [bytes([INSTRUCTION_RTS | bits]) for bits in range(8)]
+
+# SIDH << 3 for every SIDH, the upper standard id bits of a header
+SIDH_ID = [sidh << 3 for sidh in range(256)]
+
 CAN_EFF_FLAG = 0x80000000 # /* EFF/SFF is set in the MSB */
 CAN_RTR_FLAG = 0x40000000 # /* remote transmission request */
 CAN_ERR_FLAG = 0x20000000 # /* error message frame */
+CAN_SFF_MASK = 0x000007FF # /* standard frame format (SFF) */
+CAN_EFF_MASK = 0x1FFFFFFF # /* extended frame format (EFF) */
 CAN_MAX_DLEN = 8
 
+# bits of can_id the software post-filter looks at, RTR frames of an accepted
+# id are accepted too
+RX_ACCEPT_KEY = CAN_EFF_FLAG | CAN_EFF_MASK
+
 # /* CAN payload length and DLC definitions according to ISO 11898-1 */
 # #define CAN_MAX_DLC 8
 # #define CAN_MAX_RAW_DLC 15
@@ -0,0 +1,127 @@
+import asyncio
+
+import mcp251x
+
+
+class AsyncMCP251x():
+    """
+    asyncio front end for an MCP251x. Receiving runs on the driver's reader
+    thread and sends are handed to a worker thread in batches, so the event
+    loop itself never waits on SPI.
+
+        can = AsyncMCP251x(mcp251x.MCP251x(0, 0, int_gpio=...))
+        await can.start()
+        async for frame in can.frames():
+            ...
+    """
+
+    def __init__(self, can, capacity=1024):
+        self.can = can
+        self.capacity = capacity
+        self.ring = None
+        self._loop = None
+        self._rxReady = None
+        self._txKicked = False
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._rxReady = asyncio.Event()
+        self.can.onReceive = self._wake
+        self.ring = self.can.startReader(self.capacity)
+
+    async def stop(self):
+        self.can.onReceive = None
+        await self._loop.run_in_executor(None, self.can.stopReader)
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.stop()
+
+    def _wake(self):
+        # reader thread
+        self._loop.call_soon_threadsafe(self._rxReady.set)
+
+    async def recv(self, timeout=None):
+        """
+        returns the next frame, or None if none arrived within timeout seconds
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = self._loop.time() + timeout
+
+        while True:
+            frame = self.ring.get()
+            if frame is not None:
+                return frame
+
+            self._rxReady.clear()
+            # a frame may have landed between get() and clear()
+            frame = self.ring.get()
+            if frame is not None:
+                return frame
+
+            if deadline is None:
+                await self._rxReady.wait()
+                continue
+            remaining = deadline - self._loop.time()
+            if remaining <= 0:
+                return None
+            try:
+                await asyncio.wait_for(self._rxReady.wait(), remaining)
+            except asyncio.TimeoutError:
+                return None
+
+    async def frames(self, batch=64):
+        """
+        async iterator over received frames, takes them off the ring in
+        batches of up to batch frames per wakeup
+        """
+        while True:
+            frames = self.ring.get_batch(batch)
+            if not frames:
+                self._rxReady.clear()
+                frames = self.ring.get_batch(batch)
+                if not frames:
+                    await self._rxReady.wait()
+                    continue
+            for frame in frames:
+                yield frame
+
+    async def send(self, frame):
+        """
+        Resolves with ERROR_OK once the chip reports the frame transmitted,
+        ERROR_FAILTX if it was aborted, or ERROR_ALLTXBUSY if the driver's
+        TX queue is full.
+        """
+        future = self._loop.create_future()
+        loop = self._loop
+
+        def done(rc):
+            # reader or worker thread
+            loop.call_soon_threadsafe(_resolve, future, rc)
+
+        rc = self.can.queueMessages([frame], done)
+        if rc != mcp251x.ERROR_OK:
+            return rc
+        self._kickTx()
+        return await future
+
+    def _kickTx(self):
+        # any number of send() calls before the worker runs share one
+        # serviceTx(), which loads as many frames as there are free buffers
+        if self._txKicked:
+            return
+        self._txKicked = True
+        self._loop.run_in_executor(None, self._runTx)
+
+    def _runTx(self):
+        self._txKicked = False
+        self.can.serviceTx()
+
+
+def _resolve(future, rc):
+    if not future.done():
+        future.set_result(rc)
@@ -0,0 +1,172 @@
+"""
+python-can interface for MCP251x, so python-can's loggers, notifiers and
+cantools decoding work on top of this driver:
+
+    from mcp251x_bus import MCP251xBus
+    bus = MCP251xBus(channel=0, device=0, bitrate=500000)
+    for msg in bus:
+        ...
+
+Receiving runs on the driver's reader thread, recv() blocks on the frame
+ring until a frame arrives or the timeout passes. Filters set through
+python-can are compiled onto the hardware masks and filters with the exact
+remainder dropped by the driver, see MCP251x.setAcceptanceFilters().
+
+Pass spi=mcp251x_sim.SimulatedSpiDev() to run without hardware.
+"""
+import time
+
+import can
+
+import mcp251x
+
+BITRATES = {
+    5000: mcp251x.CAN_5KBPS,
+    10000: mcp251x.CAN_10KBPS,
+    20000: mcp251x.CAN_20KBPS,
+    31250: mcp251x.CAN_31K25BPS,
+    33333: mcp251x.CAN_33KBPS,
+    40000: mcp251x.CAN_40KBPS,
+    50000: mcp251x.CAN_50KBPS,
+    80000: mcp251x.CAN_80KBPS,
+    83333: mcp251x.CAN_83K3BPS,
+    95000: mcp251x.CAN_95KBPS,
+    100000: mcp251x.CAN_100KBPS,
+    125000: mcp251x.CAN_125KBPS,
+    200000: mcp251x.CAN_200KBPS,
+    250000: mcp251x.CAN_250KBPS,
+    500000: mcp251x.CAN_500KBPS,
+    1000000: mcp251x.CAN_1000KBPS,
+}
+
+CLOCKS = {
+    8000000: mcp251x.MCP_8MHZ,
+    16000000: mcp251x.MCP_16MHZ,
+    20000000: mcp251x.MCP_20MHZ,
+}
+
+# how often a send() with a full TX queue retries
+SEND_RETRY_INTERVAL = 0.001
+
+
+def filterPatterns(filters):
+    """
+    python-can filter dicts as (ext, id, mask) patterns, a filter without
+    "extended" applies to both frame formats. A format is left out when
+    can_id & can_mask has bits its ids do not have, python-can would never
+    match such a frame.
+    """
+    patterns = []
+    for f in filters:
+        ext = f.get("extended")
+        match = f["can_id"] & f["can_mask"]
+        if not ext and not match & ~mcp251x.CAN_SFF_MASK:
+            patterns.append((False, f["can_id"] & mcp251x.CAN_SFF_MASK,
+                             f["can_mask"] & mcp251x.CAN_SFF_MASK))
+        if (ext is None or ext) and not match & ~mcp251x.CAN_EFF_MASK:
+            patterns.append((True, f["can_id"] & mcp251x.CAN_EFF_MASK,
+                             f["can_mask"] & mcp251x.CAN_EFF_MASK))
+    return patterns
+
+
+class MCP251xBus(can.BusABC):
+    """
+    channel and device select /dev/spidev<channel>.<device>, clock is the
+    crystal on the MCP251x board in Hz. int_gpio, fast_rx and spi are handed
+    to MCP251x.
+    """
+
+    def __init__(self, channel=0, can_filters=None, device=0, bitrate=500000,
+                 clock=16000000, spi=None, int_gpio=None, fast_rx=True,
+                 capacity=1024, poll_interval=None, **kwargs):
+        if bitrate not in BITRATES:
+            raise ValueError("unsupported bitrate %r" % (bitrate,))
+        if clock not in CLOCKS:
+            raise ValueError("unsupported clock %r" % (clock,))
+
+        self.mcp = mcp251x.MCP251x(channel, device, fast_rx=fast_rx,
+                                   int_gpio=int_gpio, spi=spi)
+        self.channel = channel
+        self.channel_info = "MCP251x on SPI %s.%s" % (channel, device)
+        self._is_filtered = False
+        # frames are stamped with time.monotonic_ns(), messages get Unix time
+        self._epoch = time.time_ns() - time.monotonic_ns()
+
+        if self.mcp.reset() != mcp251x.ERROR_OK:
+            raise can.CanInitializationError("MCP251x reset failed")
+        if self.mcp.setBitrate(BITRATES[bitrate], CLOCKS[clock]) != mcp251x.ERROR_OK:
+            raise can.CanInitializationError("MCP251x bitrate setup failed")
+
+        # applies can_filters through _apply_filters() while still in
+        # configuration mode
+        super().__init__(channel, can_filters=can_filters, **kwargs)
+
+        if self.mcp.setNormalMode() != mcp251x.ERROR_OK:
+            raise can.CanInitializationError("MCP251x did not enter normal mode")
+        self.ring = self.mcp.startReader(capacity, poll_interval)
+
+    def _recv_internal(self, timeout):
+        frame = self.ring.get()
+        if frame is None:
+            if not self.ring.wait(timeout):
+                return None, self._is_filtered
+            frame = self.ring.get()
+        can_id = frame.can_id
+        msg = can.Message(
+            timestamp=(frame.timestamp + self._epoch) / 1e9,
+            arbitration_id=frame.arbitration_id,
+            is_extended_id=(can_id & mcp251x.CAN_EFF_FLAG) != 0,
+            is_remote_frame=(can_id & mcp251x.CAN_RTR_FLAG) != 0,
+            dlc=frame.can_dlc,
+            data=frame.data,
+            channel=self.channel,
+            check=False,
+        )
+        return msg, self._is_filtered
+
+    def send(self, msg, timeout=None):
+        can_id = msg.arbitration_id
+        if msg.is_extended_id:
+            can_id |= mcp251x.CAN_EFF_FLAG
+        if msg.is_remote_frame:
+            can_id |= mcp251x.CAN_RTR_FLAG
+        frame = mcp251x.CanFrame(can_id, bytes(msg.data), msg.dlc)
+
+        deadline = None
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+        while True:
+            rc = self.mcp.sendMessage(frame)
+            if rc == mcp251x.ERROR_OK:
+                return
+            if rc != mcp251x.ERROR_ALLTXBUSY:
+                raise can.CanOperationError("MCP251x send failed (%d)" % rc)
+            if deadline is not None and time.monotonic() >= deadline:
+                raise can.CanOperationError("MCP251x TX queue full")
+            time.sleep(SEND_RETRY_INTERVAL)
+            self.mcp.serviceTx()
+
+    def _apply_filters(self, filters):
+        if not filters:
+            self.mcp.clearFilters()
+            self._is_filtered = False
+            return
+        patterns = filterPatterns(filters)
+        if not patterns:
+            # no frame can match, python-can drops everything itself
+            self.mcp.clearFilters()
+            self._is_filtered = False
+            return
+        rc, plan = self.mcp.setAcceptanceFilters(patterns=patterns)
+        # the driver's post-filter makes whatever the hardware lets through
+        # exact, so python-can need not look again
+        self._is_filtered = (rc == mcp251x.ERROR_OK)
+        if not self._is_filtered:
+            self.mcp.clearFilters()
+
+    def shutdown(self):
+        super().shutdown()
+        self.mcp.stopReader()
+        close = getattr(self.mcp.spi, "close", None)
+        if close is not None:
+            close()
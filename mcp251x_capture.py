@@ -0,0 +1,324 @@
+"""
+Binary capture of received frames, written to disk by a writer thread.
+
+    capture = CaptureWriter("/var/log/can", max_bytes=64 << 20)
+    can.startReader()
+    capture.attach(can)
+    ...
+    capture.close()
+
+Files start with a 24 byte header (magic, version, record size and the
+offset from time.monotonic_ns() to Unix time in ns) followed by 24 byte
+records:
+
+    u64 timestamp, time.monotonic_ns() of the INT edge or status read
+    u32 can_id with CAN_EFF_FLAG/CAN_RTR_FLAG
+    u8  dlc, 3 bytes padding
+    8 data bytes, zero padded
+
+Records are packed into preallocated buffers by the caller and handed to the
+writer thread a whole buffer at a time, so the receive side never waits on
+the disk and the SD card sees few large writes. If the disk falls behind
+long enough that every buffer is full, frames are dropped and counted
+rather than blocking the caller. A failed write (a full disk, say) stops the
+capture: the exception is kept in CaptureWriter.error, later frames are
+dropped and counted, and close() raises it.
+"""
+import os
+import struct
+import threading
+import time
+
+import mcp251x
+
+MAGIC = b"MCP251xC"
+VERSION = 1
+HEADER = struct.Struct("<8sHHq4x")
+RECORD_HEAD = struct.Struct("<QIB3x")
+RECORD_SIZE = 24
+DATA_OFFSET = RECORD_HEAD.size
+
+# PAD[n] zero fills the last n data bytes of a record
+PAD = [bytes(n) for n in range(mcp251x.CAN_MAX_DLEN + 1)]
+
+
+class CaptureWriter():
+    """
+    Writes records to directory/<prefix>-<date>-<time>-<n>.bin, starting a
+    new file after max_bytes or max_seconds (either may be None). A partly
+    filled buffer goes to disk after flush_interval seconds.
+    """
+
+    def __init__(self, directory, prefix="capture", max_bytes=64 << 20,
+                 max_seconds=None, buffer_size=1 << 16, buffers=8,
+                 flush_interval=1.0):
+        self.directory = directory
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.flush_interval = flush_interval
+
+        self.records = 0
+        self.dropped = 0
+        self.files = []
+        # the exception that stopped the writer thread, see _writerLoop()
+        self.error = None
+
+        size = buffer_size - buffer_size % RECORD_SIZE
+        self._free = [bytearray(size) for _ in range(buffers - 1)]
+        self._full = []
+        self._buf = bytearray(size)
+        self._len = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = False
+
+        self._file = None
+        self._fileBytes = 0
+        self._fileOpened = 0
+        self._fileCount = 0
+        self._batch = None
+
+        self._writer = threading.Thread(target=self._writerLoop,
+                                        name="mcp251x-capture", daemon=True)
+        self._writer.start()
+
+    def record(self, frame, timestamp=None):
+        """
+        queues one CanFrame, never blocks on the disk. timestamp defaults to
+        the frame's own, or now for frames without one
+        """
+        if timestamp is None:
+            timestamp = frame.timestamp or time.monotonic_ns()
+        data = frame.data
+        dlc = frame.can_dlc
+        with self._lock:
+            buf = self._buf
+            if self.error is not None or (buf is None and not self._takeBuffer()):
+                self.dropped += 1
+                return
+            buf = self._buf
+            offset = self._len
+            RECORD_HEAD.pack_into(buf, offset, timestamp, frame.can_id, dlc)
+            start = offset + DATA_OFFSET
+            n = len(data)
+            buf[start:start + n] = data
+            buf[start + n:offset + RECORD_SIZE] = PAD[mcp251x.CAN_MAX_DLEN - n]
+            self._committed(offset)
+
+    def recordBatch(self, batch, timestamp=None):
+        """
+        queues the frames of a FrameBatch straight from its arrays, with the
+        batch's timestamps unless timestamp is given
+        """
+        ids = batch.ids
+        dlcs = batch.dlcs
+        stamps = batch.stamps
+        data = batch.data
+        with self._lock:
+            if self.error is not None:
+                self.dropped += batch.count
+                return
+            for i in range(batch.count):
+                if self._buf is None and not self._takeBuffer():
+                    self.dropped += batch.count - i
+                    return
+                buf = self._buf
+                offset = self._len
+                RECORD_HEAD.pack_into(buf, offset, timestamp or stamps[i], ids[i], dlcs[i])
+                base = i * mcp251x.CAN_MAX_DLEN
+                buf[offset + DATA_OFFSET:offset + RECORD_SIZE] = data[base:base + mcp251x.CAN_MAX_DLEN]
+                self._committed(offset)
+
+    def _committed(self, offset):
+        # with self._lock held
+        self.records += 1
+        self._len = offset + RECORD_SIZE
+        if self._len == len(self._buf):
+            self._handOver()
+
+    def _handOver(self):
+        # with self._lock held
+        self._full.append((self._buf, self._len))
+        self._buf = None
+        self._len = 0
+        self._takeBuffer()
+        self._wake.set()
+
+    def _takeBuffer(self):
+        # with self._lock held
+        if not self._free:
+            return False
+        self._buf = self._free.pop()
+        return True
+
+    def pump(self, ring):
+        """
+        records everything waiting in a FrameRing, returns the number of
+        frames
+        """
+        if self._batch is None:
+            self._batch = mcp251x.FrameBatch()
+        batch = self._batch
+        n = 0
+        while True:
+            batch.clear()
+            if not ring.get_into(batch, batch.capacity):
+                return n
+            self.recordBatch(batch)
+            n += batch.count
+
+    def attach(self, can):
+        """
+        records from can's reader thread, see MCP251x.startReader(). The
+        capture then owns the ring, use a Dispatcher with record() as a
+        subscribeClass() handler to capture next to other consumers.
+        """
+        can.onReceive = lambda: self.pump(can.ring)
+
+    def detach(self, can):
+        can.onReceive = None
+
+    def flush(self):
+        """
+        hands the partly filled buffer to the writer thread
+        """
+        with self._lock:
+            if self._len:
+                self._handOver()
+
+    def close(self):
+        """
+        writes what is left and closes the file, raises the error that
+        stopped the writer if there was one
+        """
+        self.flush()
+        self._stop = True
+        self._wake.set()
+        self._writer.join()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self.error is not None:
+            raise self.error
+
+    def _writerLoop(self):
+        while True:
+            woken = self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            with self._lock:
+                if not woken and self._len:
+                    # quiet bus, do not leave frames in memory for long
+                    self._handOver()
+                pending = self._full
+                self._full = []
+
+            for buf, n in pending:
+                if self.error is None:
+                    try:
+                        self._write(memoryview(buf)[:n])
+                    except Exception as e:
+                        self._fail(e)
+                with self._lock:
+                    if self.error is not None:
+                        self.dropped += n // RECORD_SIZE
+                    if self._buf is None:
+                        self._buf = buf
+                    else:
+                        self._free.append(buf)
+
+            if self._stop:
+                with self._lock:
+                    if not self._full:
+                        return
+
+    def _fail(self, error):
+        with self._lock:
+            self.error = error
+            # what is still in the current buffer will not be written either
+            self.dropped += self._len // RECORD_SIZE
+            self._len = 0
+        if self._file is not None:
+            try:
+                self._file.close()
+            except OSError:
+                pass
+            self._file = None
+
+    def _write(self, data):
+        now = time.monotonic()
+        if self._file is not None and (
+                (self.max_bytes is not None and self._fileBytes >= self.max_bytes) or
+                (self.max_seconds is not None and now - self._fileOpened >= self.max_seconds)):
+            self._file.close()
+            self._file = None
+        if self._file is None:
+            self._open(now)
+        self._writeAll(data)
+        self._fileBytes += len(data)
+
+    def _writeAll(self, data):
+        # an unbuffered file may take less than it was given
+        view = memoryview(data)
+        while view:
+            n = self._file.write(view)
+            view = view[n:]
+
+    def _open(self, now):
+        self._fileCount += 1
+        name = "%s-%s-%d.bin" % (self.prefix, time.strftime("%Y%m%d-%H%M%S"), self._fileCount)
+        path = os.path.join(self.directory, name)
+        # unbuffered, the writer already hands over large blocks
+        self._file = open(path, "wb", buffering=0)
+        header = HEADER.pack(MAGIC, VERSION, RECORD_SIZE, time.time_ns() - time.monotonic_ns())
+        self._writeAll(header)
+        self._fileBytes = len(header)
+        self._fileOpened = now
+        self.files.append(path)
+
+
+def readCapture(path):
+    """
+    yields (unix time in ns, can_id, dlc, data) for every record of a capture
+    file
+    """
+    with open(path, "rb") as f:
+        magic, version, recordSize, offset = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC or version != VERSION or recordSize != RECORD_SIZE:
+            raise ValueError("%s is not an MCP251x capture" % path)
+        while True:
+            chunk = f.read(RECORD_SIZE * 4096)
+            if not chunk:
+                return
+            for start in range(0, len(chunk) - RECORD_SIZE + 1, RECORD_SIZE):
+                timestamp, can_id, dlc = RECORD_HEAD.unpack_from(chunk, start)
+                data = chunk[start + DATA_OFFSET:start + DATA_OFFSET + dlc]
+                yield timestamp + offset, can_id, dlc, data
+
+
+def candumpLine(timestamp, can_id, dlc, data, channel="can0"):
+    """
+    one record in candump -L format
+    """
+    if can_id & mcp251x.CAN_EFF_FLAG:
+        id = "%08X" % (can_id & mcp251x.CAN_EFF_MASK)
+    else:
+        id = "%03X" % (can_id & mcp251x.CAN_SFF_MASK)
+    if can_id & mcp251x.CAN_RTR_FLAG:
+        payload = "R"
+    else:
+        payload = data.hex().upper()
+    return "(%d.%06d) %s %s#%s\n" % (timestamp // 1000000000, timestamp % 1000000000 // 1000,
+                                     channel, id, payload)
+
+
+def exportCandump(path, out, channel="can0"):
+    """
+    converts a capture file to candump -L text, returns the number of frames
+    """
+    n = 0
+    with open(out, "w") as f:
+        for record in readCapture(path):
+            f.write(candumpLine(*record, channel=channel))
+            n += 1
+    return n
@@ -0,0 +1,266 @@
+"""
+Periodic transmission from one timer thread.
+
+    cyclic = CyclicScheduler(can)
+    heartbeat = cyclic.add(0x701, b"\\x05", period=0.1)
+    status = cyclic.add(0x18FF0010 | mcp251x.CAN_EFF_FLAG, bytes(8), period=0.02)
+    cyclic.start()
+    ...
+    status.update(payload)
+
+Each job's LOAD TX BUFFER bytes (SIDH, SIDL, EID8, EID0, DLC, data) and its
+arbitration key are built once when it is added, update() only rewrites the
+data bytes in place. Every frame due at a wakeup is queued with one
+MCP251x.queueTxBuffers() and loaded with one serviceTx(), so jobs with the
+same period and offset go out together.
+
+A job whose previous frame is still waiting for a TX buffer is not queued
+again, that is an overrun. A job that is woken a whole period or more late
+skips the periods it missed and stays on its original phase. Both are
+counted per job and reported through onMissed.
+"""
+import heapq
+import threading
+import time
+
+import mcp251x
+
+# how soon the timer looks again while frames it queued still wait in the
+# software TX queue, in case no reader thread calls serviceTx()
+CYCLIC_TX_RECHECK = 0.001
+
+# longest sleep of an idle timer
+CYCLIC_IDLE_WAIT = 1.0
+
+
+class CyclicJob():
+    """
+    one periodic frame of a CyclicScheduler, see CyclicScheduler.add()
+    """
+
+    def __init__(self, scheduler, can_id, data, period, dlc, offset):
+        if dlc is None:
+            dlc = len(data)
+        if period <= 0:
+            raise ValueError("period must be positive")
+        frame = mcp251x.CanFrame(can_id, bytes(data), dlc)
+        txbuf = scheduler.can.prepareTxBuffer(frame)
+        if txbuf is None:
+            raise ValueError("invalid frame %r" % (frame,))
+        self.scheduler = scheduler
+        self.can_id = can_id
+        self.dlc = dlc
+        self.period = period
+        self.offset = offset
+        self.txbuf = txbuf
+        self.key = scheduler.can.arbitrationKey(txbuf)
+        self.entry = (self.key, txbuf, self._done)
+        self.active = True
+        self.due = 0.0
+        self.pending = False
+
+        self.sent = 0
+        self.queued = 0
+        self.missed = 0
+        self.overruns = 0
+        self.dropped = 0
+        self.failed = 0
+        self.max_late = 0.0
+        self.total_late = 0.0
+
+    def update(self, data):
+        """
+        replaces the payload in place, bytes past len(data) become zero.
+        A frame already queued goes out with the new payload.
+        """
+        if self.can_id & mcp251x.CAN_RTR_FLAG:
+            raise ValueError("remote frames have no payload")
+        n = len(data)
+        if n > self.dlc:
+            raise ValueError("payload longer than dlc %d" % self.dlc)
+        start = mcp251x.MCP_DATA
+        if n < self.dlc:
+            data = bytes(data) + bytes(self.dlc - n)
+        self.txbuf[start:start + self.dlc] = data
+
+    def _done(self, rc):
+        # from MCP251x._serviceTx() with the driver lock held
+        self.pending = False
+        if rc == mcp251x.ERROR_OK:
+            self.sent += 1
+        else:
+            self.failed += 1
+
+    def snapshot(self):
+        return {
+            "can_id": self.can_id,
+            "period_ms": self.period * 1000.0,
+            "queued": self.queued,
+            "sent": self.sent,
+            "missed": self.missed,
+            "overruns": self.overruns,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "max_late_us": self.max_late * 1e6,
+            "mean_late_us": (self.total_late / self.queued * 1e6) if self.queued else 0.0,
+        }
+
+
+class CyclicScheduler():
+    """
+    Owns periodic jobs for one MCP251x and sends them from a single timer
+    thread. onMissed, if set, is called as onMissed(job, periods) from that
+    thread for every overrun (periods 0) and every late wakeup that skipped
+    periods. Lateness of every queued frame goes into jitter, a
+    mcp251x_stats.LatencyTrace.
+    """
+
+    def __init__(self, can, jitter_capacity=4096):
+        import mcp251x_stats
+
+        self.can = can
+        self.onMissed = None
+        self.jitter = mcp251x_stats.LatencyTrace(jitter_capacity)
+        self.wakeups = 0
+        self.jobs = []
+        # heap of (due, sequence, job)
+        self._heap = []
+        self._seq = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = False
+        self._thread = None
+        self._recheck = False
+
+    def add(self, can_id, data, period, dlc=None, offset=0.0):
+        """
+        sends can_id with data every period seconds, the first time offset
+        seconds from now. Returns the CyclicJob.
+        """
+        job = CyclicJob(self, can_id, data, period, dlc, offset)
+        with self._lock:
+            job.due = time.monotonic() + offset
+            self.jobs.append(job)
+            self._push(job)
+        self._wake.set()
+        return job
+
+    def remove(self, job):
+        """
+        stops a job, a frame of it already queued still goes out
+        """
+        with self._lock:
+            job.active = False
+            if job in self.jobs:
+                self.jobs.remove(job)
+
+    def _push(self, job):
+        # with self._lock held
+        heapq.heappush(self._heap, (job.due, self._seq, job))
+        self._seq += 1
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop = False
+        self._thread = threading.Thread(target=self._timerLoop,
+                                        name="mcp251x-cyclic", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop = True
+        self._wake.set()
+        self._thread.join()
+        self._thread = None
+
+    def getStats(self):
+        with self._lock:
+            jobs = list(self.jobs)
+        return {
+            "wakeups": self.wakeups,
+            "jitter": self.jitter.snapshot(),
+            "jobs": [job.snapshot() for job in jobs],
+        }
+
+    def _timerLoop(self):
+        while not self._stop:
+            now = time.monotonic()
+            with self._lock:
+                if self._heap:
+                    wait = self._heap[0][0] - now
+                else:
+                    wait = CYCLIC_IDLE_WAIT
+            if wait > 0:
+                if self._recheck:
+                    wait = min(wait, CYCLIC_TX_RECHECK)
+                if self._wake.wait(min(wait, CYCLIC_IDLE_WAIT)):
+                    # jobs changed or stopping
+                    self._wake.clear()
+                    continue
+                if not self._recheck:
+                    continue
+            self.runDue()
+
+    def runDue(self, now=None):
+        """
+        queues and loads every job due by now, returns the number of frames
+        queued. Called by the timer thread, or directly by callers that run
+        their own loop instead of start().
+        """
+        if now is None:
+            now = time.monotonic()
+        due = []
+        missed = []
+        with self._lock:
+            heap = self._heap
+            while heap and heap[0][0] <= now:
+                _, _, job = heapq.heappop(heap)
+                if not job.active:
+                    continue
+                late = now - job.due
+                periods = int(late / job.period)
+                if periods:
+                    job.missed += periods
+                    missed.append((job, periods))
+                job.due += (periods + 1) * job.period
+                self._push(job)
+                due.append((job, late))
+        self.wakeups += 1
+
+        can = self.can
+        entries = []
+        queued = []
+        with can.lock:
+            if self._recheck or any(job.pending for job, _ in due):
+                # retires finished buffers so their jobs are no longer pending
+                can.serviceTx()
+            for job, late in due:
+                if job.pending:
+                    job.overruns += 1
+                    missed.append((job, 0))
+                    continue
+                entries.append(job.entry)
+                queued.append((job, late))
+            if entries:
+                if can.queueTxBuffers(entries) == mcp251x.ERROR_OK:
+                    for job, late in queued:
+                        job.pending = True
+                        job.queued += 1
+                        job.total_late += late
+                        if late > job.max_late:
+                            job.max_late = late
+                        self.jitter.add(int(late * 1e9))
+                else:
+                    for job, _ in queued:
+                        job.dropped += 1
+                    queued = []
+            if entries or self._recheck:
+                can.serviceTx()
+            self._recheck = can.txQueued() > 0
+
+        if self.onMissed is not None:
+            for job, periods in missed:
+                self.onMissed(job, periods)
+        return len(queued)
@@ -0,0 +1,287 @@
+"""
+Signal decoding from a DBC file for frames received by MCP251x.
+
+    db = mcp251x_dbc.load("vehicle.dbc")
+    name, signals = db.decode(frame)             # one frame, low latency
+    columns = db.decodeBatch(batch, 0x0CF00400 | mcp251x.CAN_EFF_FLAG)
+
+Every message is compiled once into a plan of (shift, mask) extractions on
+the payload read as one 64 bit integer, little endian for Intel signals and
+big endian for Motorola ones, so decoding a frame is one int.from_bytes()
+and a shift and mask per signal. decodeArray()/decodeBatch() run the same
+plan over a whole (n, 8) payload array with NumPy, which is needed for those
+two only.
+
+DBC message ids carry bit 31 for extended frames, the same bit as
+CAN_EFF_FLAG, so plans are looked up by can_id directly. Value tables,
+attributes and comments are ignored.
+"""
+import re
+
+import mcp251x
+
+# bits of can_id that pick a message
+KEY_MASK = mcp251x.CAN_EFF_FLAG | mcp251x.CAN_EFF_MASK
+
+MESSAGE_RE = re.compile(r"^BO_\s+(\d+)\s+(\w+)\s*:\s*(\d+)\s+(\w+)")
+SIGNAL_RE = re.compile(
+    r"^\s*SG_\s+(\w+)\s*(M|m\d+)?\s*:\s*(\d+)\|(\d+)@([01])([+-])\s*"
+    r"\(([^,]+),([^)]+)\)\s*\[([^|]*)\|([^\]]*)\]\s*\"([^\"]*)\"")
+
+
+def number(text):
+    value = float(text)
+    if value.is_integer() and "e" not in text.lower() and "." not in text:
+        return int(value)
+    return value
+
+
+class Signal():
+    """
+    One signal and its extraction from the payload integer: raw value is
+    (word >> shift) & mask with word the payload read little endian for
+    Intel signals and big endian for Motorola ones.
+    """
+
+    def __init__(self, name, start, length, little, signed, scale, offset,
+                 minimum=None, maximum=None, unit="", mux=None, multiplexer=False):
+        self.name = name
+        self.start = start
+        self.length = length
+        self.little = little
+        self.signed = signed
+        self.scale = scale
+        self.offset = offset
+        self.minimum = minimum
+        self.maximum = maximum
+        self.unit = unit
+        # value of the message's multiplexer this signal is sent with
+        self.mux = mux
+        self.multiplexer = multiplexer
+
+        if little:
+            self.shift = start
+        else:
+            # DBC numbers Motorola signals by their most significant bit in
+            # the sawtooth order, bit 7 of byte 0 first
+            msb = (start // 8) * 8 + (7 - start % 8)
+            self.shift = 64 - (msb + length)
+        self.mask = (1 << length) - 1
+        self.signbit = (1 << (length - 1)) if signed else 0
+        self.integer = isinstance(scale, int) and isinstance(offset, int)
+        if self.shift < 0:
+            raise ValueError("signal %s does not fit in 8 bytes" % name)
+
+    def physical(self, raw):
+        if self.signbit and raw & self.signbit:
+            raw -= self.mask + 1
+        return raw * self.scale + self.offset
+
+    def __repr__(self):
+        return "<Signal %s %d|%d@%d%s (%s,%s)>" % (
+            self.name, self.start, self.length, 1 if self.little else 0,
+            "-" if self.signed else "+", self.scale, self.offset)
+
+
+class MessagePlan():
+    """
+    A message's signals compiled to flat tuples for decode()
+    """
+
+    def __init__(self, frame_id, name, dlc, signals):
+        self.frame_id = frame_id
+        self.name = name
+        self.dlc = dlc
+        self.signals = signals
+        self.compile()
+
+    def compile(self):
+        self.multiplexer = None
+        for signal in self.signals:
+            if signal.multiplexer:
+                self.multiplexer = signal
+        self.needLittle = any(signal.little for signal in self.signals)
+        self.needBig = any(not signal.little for signal in self.signals)
+        # (name, little, shift, mask, signbit, scale, offset, mux) per
+        # signal, plain ones without scaling get scale None
+        plan = []
+        for signal in self.signals:
+            scale = signal.scale
+            offset = signal.offset
+            if scale == 1 and offset == 0 and signal.integer:
+                scale = None
+            plan.append((signal.name, signal.little, signal.shift, signal.mask,
+                         signal.signbit, scale, offset, signal.mux))
+        self.plan = tuple(plan)
+
+    def decode(self, data):
+        """
+        {signal name: physical value} for a payload
+        """
+        little = big = 0
+        if self.needLittle:
+            little = int.from_bytes(data, "little")
+        if self.needBig:
+            big = int.from_bytes(data, "big") << (8 * (8 - len(data)))
+
+        mux = None
+        if self.multiplexer is not None:
+            signal = self.multiplexer
+            mux = ((little if signal.little else big) >> signal.shift) & signal.mask
+
+        out = {}
+        for name, isLittle, shift, mask, signbit, scale, offset, signalMux in self.plan:
+            if signalMux is not None and signalMux != mux:
+                continue
+            raw = ((little if isLittle else big) >> shift) & mask
+            if signbit and raw & signbit:
+                raw -= mask + 1
+            if scale is None:
+                out[name] = raw
+            else:
+                out[name] = raw * scale + offset
+        return out
+
+    def decodeArray(self, data):
+        """
+        {signal name: column} for an (n, 8) uint8 payload array, multiplexed
+        signals are NaN in rows sent with another multiplexer value. Needs
+        numpy.
+        """
+        import numpy
+
+        data = numpy.ascontiguousarray(data, dtype=numpy.uint8)
+        if data.ndim != 2 or data.shape[1] != mcp251x.CAN_MAX_DLEN:
+            raise ValueError("payloads must be an (n, 8) array")
+        little = big = None
+        if self.needLittle:
+            little = data.view("<u8")[:, 0]
+        if self.needBig:
+            big = data.view(">u8")[:, 0].astype(numpy.uint64)
+
+        def raw(signal):
+            word = little if signal.little else big
+            return (word >> numpy.uint64(signal.shift)) & numpy.uint64(signal.mask)
+
+        mux = None
+        if self.multiplexer is not None:
+            mux = raw(self.multiplexer)
+
+        out = {}
+        for signal in self.signals:
+            values = raw(signal)
+            if signal.signbit:
+                values = values.astype(numpy.int64)
+                values = numpy.where(values & signal.signbit, values - (signal.mask + 1), values)
+            if signal.integer and signal.mux is None:
+                values = values.astype(numpy.int64) * signal.scale + signal.offset
+            else:
+                values = values * float(signal.scale) + float(signal.offset)
+            if signal.mux is not None:
+                values = numpy.where(mux == signal.mux, values, numpy.nan)
+            out[signal.name] = values
+        return out
+
+
+class Database():
+    """
+    MessagePlans by can_id, see load()
+    """
+
+    def __init__(self, messages=()):
+        self.messages = {}
+        self.names = {}
+        for message in messages:
+            self.add(message)
+
+    def add(self, message):
+        self.messages[message.frame_id] = message
+        self.names[message.name] = message
+
+    def plan(self, can_id):
+        return self.messages.get(can_id & KEY_MASK)
+
+    def decode(self, frame):
+        """
+        (message name, {signal: value}) for a CanFrame, None if the DBC has
+        no such message
+        """
+        message = self.messages.get(frame.can_id & KEY_MASK)
+        if message is None:
+            return None
+        return message.name, message.decode(frame.data)
+
+    def decodeData(self, can_id, data):
+        message = self.messages.get(can_id & KEY_MASK)
+        if message is None:
+            return None
+        return message.decode(data)
+
+    def decodeArray(self, can_id, data):
+        """
+        signal columns for an (n, 8) array of payloads of one message
+        """
+        message = self.messages.get(can_id & KEY_MASK)
+        if message is None:
+            return None
+        return message.decodeArray(data)
+
+    def decodeBatch(self, batch, can_id):
+        """
+        signal columns for the frames with can_id in a FrameBatch, taken
+        straight from its buffers. Row i belongs to the i-th such frame, so
+        batch.stamps selected the same way gives the timestamps.
+        """
+        import numpy
+
+        ids, dlcs, data = batch.to_numpy()
+        rows = (ids & numpy.uint32(KEY_MASK)) == (can_id & KEY_MASK)
+        data = data[rows]
+        # bytes past the dlc are left over from earlier frames
+        data[numpy.arange(mcp251x.CAN_MAX_DLEN) >= dlcs[rows][:, None]] = 0
+        return self.decodeArray(can_id, data)
+
+
+def parse(text):
+    """
+    Database from DBC file contents
+    """
+    db = Database()
+    message = None
+    for line in text.splitlines():
+        match = MESSAGE_RE.match(line)
+        if match:
+            frame_id, name, dlc = int(match.group(1)), match.group(2), int(match.group(3))
+            message = MessagePlan(frame_id, name, dlc, [])
+            db.add(message)
+            continue
+        match = SIGNAL_RE.match(line)
+        if match and message is not None:
+            name, muxText, start, length, order, sign = match.group(1, 2, 3, 4, 5, 6)
+            mux = None
+            multiplexer = False
+            if muxText == "M":
+                multiplexer = True
+            elif muxText:
+                mux = int(muxText[1:])
+            minimum = number(match.group(9)) if match.group(9).strip() else None
+            maximum = number(match.group(10)) if match.group(10).strip() else None
+            message.signals.append(Signal(
+                name, int(start), int(length), order == "1", sign == "-",
+                number(match.group(7)), number(match.group(8)), minimum, maximum,
+                match.group(11), mux, multiplexer))
+            continue
+        if not line.startswith(" ") and not line.startswith("\t"):
+            message = None
+
+    for message in db.messages.values():
+        message.compile()
+    return db
+
+
+def load(path, encoding="cp1252"):
+    """
+    Database from a DBC file, which tools commonly write in cp1252
+    """
+    with open(path, encoding=encoding) as f:
+        return parse(f.read())
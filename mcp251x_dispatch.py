@@ -0,0 +1,161 @@
+"""
+Per-id handler dispatch for frames from an MCP251x.
+
+    dispatch = Dispatcher()
+    dispatch.subscribe(0x7E8, onObdReply)
+    dispatch.subscribeMasked(0x18FEF100, 0x00FFFF00, onJ1939, ext=True)
+    dispatch.subscribeClass(onRemote, rtr=True)
+    can.startReader()
+    dispatch.attach(can)
+
+Handlers for a can_id are worked out once, from the exact index, the masked
+table (one dict lookup per distinct mask) and the EFF/RTR classes, and then
+cached, so a frame costs one dict lookup however many subscriptions there
+are.
+"""
+import mcp251x
+
+# bits of can_id an exact or masked subscription looks at
+KEY_MASK = mcp251x.CAN_EFF_FLAG | mcp251x.CAN_EFF_MASK
+
+# resolved can_ids kept before the cache starts over, ids on a real bus are
+# far fewer
+CACHE_SIZE = 4096
+
+NO_HANDLERS = ()
+
+
+def subscriptionKey(id, ext):
+    if ext:
+        return (id & mcp251x.CAN_EFF_MASK) | mcp251x.CAN_EFF_FLAG
+    return id & mcp251x.CAN_SFF_MASK
+
+
+class Dispatcher():
+    """
+    Calls handler(frame) for every subscription a frame matches, once per
+    handler. Frames are CanFrame objects. Handlers attached with attach()
+    run on the driver's reader thread and should not block.
+    """
+
+    def __init__(self):
+        # key -> [handlers]
+        self._exact = {}
+        # mask -> {masked key -> [handlers]}
+        self._masked = {}
+        # (can_id >> 30) & 3, i.e. EFF and RTR flag -> [handlers]
+        self._classes = [[], [], [], []]
+        # can_id -> tuple of handlers
+        self._cache = {}
+
+    def subscribe(self, id, handler, ext=False):
+        """
+        handler gets data and remote frames with exactly this id
+        """
+        self._exact.setdefault(subscriptionKey(id, ext), []).append(handler)
+        self._cache.clear()
+
+    def subscribeMasked(self, id, mask, handler, ext=False):
+        """
+        handler gets frames whose id equals id on the bits set in mask
+        """
+        mask = subscriptionKey(mask, ext) | mcp251x.CAN_EFF_FLAG
+        table = self._masked.setdefault(mask, {})
+        table.setdefault(subscriptionKey(id, ext) & mask, []).append(handler)
+        self._cache.clear()
+
+    def subscribeClass(self, handler, eff=None, rtr=None):
+        """
+        handler gets every frame with the given EFF and RTR flags, None
+        matching either
+        """
+        for cls in range(4):
+            if eff is not None and bool(cls & 2) != eff:
+                continue
+            if rtr is not None and bool(cls & 1) != rtr:
+                continue
+            self._classes[cls].append(handler)
+        self._cache.clear()
+
+    def unsubscribe(self, handler):
+        """
+        removes every subscription of handler
+        """
+        for key, handlers in list(self._exact.items()):
+            self._exact[key] = [h for h in handlers if h is not handler]
+            if not self._exact[key]:
+                del self._exact[key]
+        for mask, table in list(self._masked.items()):
+            for key, handlers in list(table.items()):
+                table[key] = [h for h in handlers if h is not handler]
+                if not table[key]:
+                    del table[key]
+            if not table:
+                del self._masked[mask]
+        for cls in range(4):
+            self._classes[cls] = [h for h in self._classes[cls] if h is not handler]
+        self._cache.clear()
+
+    def handlersFor(self, can_id):
+        handlers = self._cache.get(can_id)
+        if handlers is None:
+            handlers = self._resolve(can_id)
+            if len(self._cache) >= CACHE_SIZE:
+                self._cache.clear()
+            self._cache[can_id] = handlers
+        return handlers
+
+    def _resolve(self, can_id):
+        key = can_id & KEY_MASK
+        found = []
+        found.extend(self._exact.get(key, NO_HANDLERS))
+        for mask, table in self._masked.items():
+            found.extend(table.get(key & mask, NO_HANDLERS))
+        found.extend(self._classes[(can_id >> 30) & 3])
+
+        handlers = []
+        for handler in found:
+            if handler not in handlers:
+                handlers.append(handler)
+        return tuple(handlers)
+
+    def dispatch(self, frame):
+        for handler in self.handlersFor(frame.can_id):
+            handler(frame)
+
+    def dispatchBatch(self, frames):
+        """
+        one pass over frames, returns the number of handler calls
+        """
+        cache = self._cache
+        calls = 0
+        for frame in frames:
+            handlers = cache.get(frame.can_id)
+            if handlers is None:
+                handlers = self.handlersFor(frame.can_id)
+            for handler in handlers:
+                handler(frame)
+            calls += len(handlers)
+        return calls
+
+    def pump(self, ring, batch=64):
+        """
+        dispatches everything waiting in a FrameRing, returns the number of
+        frames
+        """
+        n = 0
+        while True:
+            frames = ring.get_batch(batch)
+            if not frames:
+                return n
+            self.dispatchBatch(frames)
+            n += len(frames)
+
+    def attach(self, can, batch=64):
+        """
+        dispatches from can's reader thread, see MCP251x.startReader()
+        """
+        can.onReceive = lambda: self.pump(can.ring, batch)
+
+    def detach(self, can):
+        can.onReceive = None
@@ -0,0 +1,416 @@
+"""
+Acceptance filter compiler for MCP251x, see MCP251x.setAcceptanceFilters().
+
+The chip has two masks with filters behind each: MASK0 with RXF0-1 for RXB0,
+MASK1 with RXF2-5 for RXB1. A frame passes when, on every bit set in a mask,
+its id equals one of that mask's filters. compileFilters() looks for the
+mask/filter assignment that lets through the fewest ids nobody asked for and
+reports what still gets through, so the driver can drop those in software.
+
+Ids are handled in the 29 bit layout of the mask registers: an extended id
+as is, a standard id in the top 11 bits (SID_BITS). For standard frames the
+chip compares the low 16 mask bits against the first two data bytes, so a
+mask serving a standard filter keeps its EID bits clear.
+"""
+import bisect
+
+import mcp251x
+
+SID_SHIFT = 18
+SID_BITS = mcp251x.CAN_SFF_MASK << SID_SHIFT
+ID_BITS = mcp251x.CAN_EFF_MASK
+
+# filters behind MASK0 and MASK1
+GROUP_FILTERS = [[mcp251x.RXF0, mcp251x.RXF1],
+                 [mcp251x.RXF2, mcp251x.RXF3, mcp251x.RXF4, mcp251x.RXF5]]
+N_FILTERS = 6
+
+# most cubes per frame format whose union compileFilters() counts exactly
+UNION_LIMIT = 12
+
+# while compileFilters() has more clusters than MERGE_EXACT it only tries
+# merging each with the next MERGE_WINDOW in id order, where the ids
+# sharing the longest prefix are, instead of every pair
+MERGE_EXACT = 24
+MERGE_WINDOW = 4
+
+
+def popcount(x):
+    return bin(x).count("1")
+
+
+def cubeSize(ext, care):
+    """
+    number of ids of one frame format matched by a value/care pair
+    """
+    if ext:
+        return 1 << (29 - popcount(care & ID_BITS))
+    return 1 << (11 - popcount(care & SID_BITS))
+
+
+def rangeCubes(lo, hi, bits):
+    """
+    splits lo..hi into aligned power of two blocks, returns (value, care)
+    pairs in the bits wide id space
+    """
+    full = (1 << bits) - 1
+    cubes = []
+    while lo <= hi:
+        size = (lo & -lo) if lo else (1 << bits)
+        while size > hi - lo + 1:
+            size >>= 1
+        cubes.append((lo, full & ~(size - 1)))
+        lo += size
+    return cubes
+
+
+def mergeRanges(ids, limit):
+    """
+    ids holds ids and (first, last) tuples, returns sorted disjoint ranges
+    """
+    ranges = []
+    for item in ids:
+        if isinstance(item, tuple):
+            lo, hi = item
+        else:
+            lo = hi = item
+        if lo > hi or lo < 0 or hi > limit:
+            raise ValueError("bad id or range %r" % (item,))
+        ranges.append((lo, hi))
+    ranges.sort()
+
+    merged = []
+    for lo, hi in ranges:
+        if merged and lo <= merged[-1][1] + 1:
+            if hi > merged[-1][1]:
+                merged[-1][1] = hi
+        else:
+            merged.append([lo, hi])
+    return merged
+
+
+class AcceptSet():
+    """
+    membership test on driver can_id values (CAN_EFF_FLAG set for extended
+    ids, CAN_RTR_FLAG cleared) for the software post-filter
+    """
+
+    def __init__(self, ids, ranges, masked=()):
+        self.ids = frozenset(ids)
+        self.starts = [lo for lo, hi in ranges]
+        self.ends = [hi for lo, hi in ranges]
+        # (value, mask) pairs, mask includes CAN_EFF_FLAG
+        self.masked = list(masked)
+
+    def __contains__(self, key):
+        if key in self.ids:
+            return True
+        i = bisect.bisect_right(self.starts, key) - 1
+        if i >= 0 and key <= self.ends[i]:
+            return True
+        for value, mask in self.masked:
+            if key & mask == value:
+                return True
+        return False
+
+
+class Cluster():
+    """
+    wanted ids of one frame format that end up behind a single filter, kept
+    as the smallest value/care pair covering all of them
+    """
+
+    def __init__(self, ext, value, care):
+        self.ext = ext
+        self.value = value & care
+        self.care = care
+
+    def merged(self, other):
+        care = self.care & other.care & ~(self.value ^ other.value)
+        return Cluster(self.ext, self.value, care)
+
+    def size(self):
+        return cubeSize(self.ext, self.care)
+
+    def order(self):
+        return (self.ext, self.value)
+
+
+class FilterPlan():
+    """
+    Result of compileFilters(). masks holds MASK0 and MASK1 in the 29 bit
+    layout, filters (ext, id) for RXF0-5 as setFilter() takes them.
+    false_accepts counts the ids the hardware passes without being asked
+    for, None if that was too costly to count; accept is the post-filter
+    that removes them, None if there are none.
+    """
+
+    def __init__(self, masks, filters, accepted, wanted, false_accepts, accept):
+        self.masks = masks
+        self.filters = filters
+        self.accepted = accepted
+        self.wanted = wanted
+        self.false_accepts = false_accepts
+        self.accept = accept
+
+    def wants(self, ext, id):
+        key = id | mcp251x.CAN_EFF_FLAG if ext else id
+        return self.accept is None or key in self.accept
+
+    def falseAcceptIds(self, limit=None):
+        """
+        returns up to limit (ext, id) pairs the filters pass but nobody
+        asked for
+        """
+        out = []
+        if self.accept is None:
+            return out
+        seen = set()
+        for ext, value, care in self.accepted:
+            if ext:
+                free = ID_BITS & ~care
+            else:
+                free = (SID_BITS & ~care) >> SID_SHIFT
+                value >>= SID_SHIFT
+            sub = 0
+            while True:
+                id = value | sub
+                if (ext, id) not in seen and not self.wants(ext, id):
+                    seen.add((ext, id))
+                    out.append((ext, id))
+                    if limit is not None and len(out) >= limit:
+                        return out
+                sub = (sub - free) & free
+                if sub == 0:
+                    break
+        return out
+
+    def __repr__(self):
+        return "<FilterPlan masks=%s filters=%s false_accepts=%s>" % (
+            ["%08X" % m for m in self.masks],
+            ["%s%X" % ("x" if ext else "", id) for ext, id in self.filters],
+            self.false_accepts)
+
+
+def unionSize(ext, cubes):
+    """
+    number of ids matched by any of cubes, by inclusion-exclusion
+    """
+    # drop duplicates and cubes inside another one, the rest is at most six
+    kept = []
+    for i, (value, care) in enumerate(cubes):
+        inside = False
+        for j, (v, c) in enumerate(cubes):
+            if i == j or c & ~care:
+                continue
+            if (value ^ v) & c == 0 and (c != care or j < i):
+                inside = True
+                break
+        if not inside:
+            kept.append((value, care))
+
+    total = 0
+    n = len(kept)
+    for subset in range(1, 1 << n):
+        value = 0
+        care = 0
+        empty = False
+        for i in range(n):
+            if subset >> i & 1:
+                v, c = kept[i]
+                if (value ^ v) & care & c:
+                    empty = True
+                    break
+                value |= v & c
+                care |= c
+        if empty:
+            continue
+        if popcount(subset) & 1:
+            total += cubeSize(ext, care)
+        else:
+            total -= cubeSize(ext, care)
+    return total
+
+
+def evaluate(groups, fallback):
+    """
+    masks, filters and accepted cubes for clusters split over the two masks
+    """
+    masks = []
+    filters = [None] * N_FILTERS
+    accepted = []
+    for g, clusters in enumerate(groups):
+        slots = GROUP_FILTERS[g]
+        if not clusters:
+            # every filter needs some value, an exact copy of a wanted id
+            # passes nothing new
+            ext, id = fallback
+            masks.append(ID_BITS if ext else SID_BITS)
+            for slot in slots:
+                filters[slot] = fallback
+            value = id if ext else id << SID_SHIFT
+            accepted.append((ext, value, ID_BITS if ext else SID_BITS))
+            continue
+
+        mask = ID_BITS
+        for cluster in clusters:
+            # a standard cluster's care has no EID bits to begin with
+            mask &= cluster.care
+        masks.append(mask)
+
+        for i, slot in enumerate(slots):
+            cluster = clusters[min(i, len(clusters) - 1)]
+            value = cluster.value & mask
+            if cluster.ext:
+                filters[slot] = (True, value)
+                accepted.append((True, value, mask))
+            else:
+                filters[slot] = (False, value >> SID_SHIFT)
+                accepted.append((False, value, mask & SID_BITS))
+    return masks, filters, accepted
+
+
+def countAccepted(accepted):
+    total = 0
+    for ext in (False, True):
+        cubes = [(v, c) for e, v, c in accepted if e == ext]
+        if cubes:
+            total += unionSize(ext, cubes)
+    return total
+
+
+def splits(n):
+    """
+    ways to put n clusters behind MASK0 (two filters) and MASK1 (four)
+    """
+    for bits in range(1 << n):
+        first = [i for i in range(n) if bits >> i & 1]
+        if len(first) <= 2 and n - len(first) <= 4:
+            yield first, [i for i in range(n) if not bits >> i & 1]
+
+
+def compileFilters(std=(), ext=(), patterns=()):
+    """
+    std and ext hold standard and extended ids, or inclusive (first, last)
+    ranges of them, patterns (ext, id, mask) triples accepting every id equal
+    to id on the bits set in mask. Returns a FilterPlan.
+
+    Clusters start as one per aligned id block or pattern and are merged
+    greedily, always the pair whose covering value/care pair grows least,
+    i.e. mask bits are given up one decision at a time. Above MERGE_EXACT
+    clusters only neighbours in id order are paired. Every partition of
+    six or fewer clusters is tried on every split over the two masks and the
+    one passing the fewest ids wins.
+    """
+    stdRanges = mergeRanges(std, mcp251x.CAN_SFF_MASK)
+    extRanges = mergeRanges(ext, mcp251x.CAN_EFF_MASK)
+    if not stdRanges and not extRanges and not patterns:
+        raise ValueError("no ids to accept")
+
+    clusters = []
+    for lo, hi in stdRanges:
+        for value, care in rangeCubes(lo, hi, 11):
+            clusters.append(Cluster(False, value << SID_SHIFT, care << SID_SHIFT))
+    for lo, hi in extRanges:
+        for value, care in rangeCubes(lo, hi, 29):
+            clusters.append(Cluster(True, value, care))
+    for isExt, id, mask in patterns:
+        if isExt:
+            clusters.append(Cluster(True, id, mask & ID_BITS))
+        else:
+            clusters.append(Cluster(False, id << SID_SHIFT,
+                                    (mask & mcp251x.CAN_SFF_MASK) << SID_SHIFT))
+
+    wanted = wantedSize(clusters, stdRanges, extRanges, patterns)
+
+    first = clusters[0]
+    fallback = (first.ext, first.value if first.ext else first.value >> SID_SHIFT)
+
+    # wanted is the same for every candidate, so fewest passed is fewest
+    # passed unasked
+    best = None
+    while True:
+        if len(clusters) <= N_FILTERS:
+            for a, b in splits(len(clusters)):
+                groups = [[clusters[i] for i in a], [clusters[i] for i in b]]
+                masks, filters, accepted = evaluate(groups, fallback)
+                passed = countAccepted(accepted)
+                if best is None or passed < best[0]:
+                    best = (passed, masks, filters, accepted)
+            if best[0] == wanted:
+                break
+
+        if len(clusters) > MERGE_EXACT:
+            clusters.sort(key=Cluster.order)
+            window = MERGE_WINDOW
+        else:
+            window = len(clusters)
+        pair = None
+        for i in range(len(clusters)):
+            a = clusters[i]
+            for j in range(i + 1, min(i + 1 + window, len(clusters))):
+                b = clusters[j]
+                if a.ext != b.ext:
+                    continue
+                size = cubeSize(a.ext, a.care & b.care & ~(a.value ^ b.value))
+                if pair is None or size < pair[0]:
+                    pair = (size, i, j)
+        if pair is None:
+            break
+        size, i, j = pair
+        clusters[i] = clusters[i].merged(clusters[j])
+        del clusters[j]
+
+    passed, masks, filters, accepted = best
+    falseAccepts = None
+    if wanted is not None:
+        falseAccepts = passed - wanted
+
+    accept = None
+    if falseAccepts != 0:
+        ids = []
+        ranges = []
+        for lo, hi in stdRanges:
+            if lo == hi:
+                ids.append(lo)
+            else:
+                ranges.append((lo, hi))
+        for lo, hi in extRanges:
+            lo |= mcp251x.CAN_EFF_FLAG
+            hi |= mcp251x.CAN_EFF_FLAG
+            if lo == hi:
+                ids.append(lo)
+            else:
+                ranges.append((lo, hi))
+        masked = []
+        for isExt, id, mask in patterns:
+            mask = (mask & ID_BITS if isExt else mask & mcp251x.CAN_SFF_MASK)
+            if isExt:
+                masked.append(((id & mask) | mcp251x.CAN_EFF_FLAG, mask | mcp251x.CAN_EFF_FLAG))
+            else:
+                masked.append((id & mask, mask | mcp251x.CAN_EFF_FLAG))
+        if ranges or masked:
+            accept = AcceptSet(ids, ranges, masked)
+        else:
+            accept = frozenset(ids)
+    return FilterPlan(masks, filters, accepted, wanted, falseAccepts, accept)
+
+
+def wantedSize(clusters, stdRanges, extRanges, patterns):
+    """
+    number of ids asked for, None if patterns make that too costly to count
+    """
+    if not patterns:
+        total = 0
+        for lo, hi in stdRanges + extRanges:
+            total += hi - lo + 1
+        return total
+
+    total = 0
+    for ext in (False, True):
+        cubes = [(c.value, c.care) for c in clusters if c.ext == ext]
+        if len(cubes) > UNION_LIMIT:
+            return None
+        if cubes:
+            total += unionSize(ext, cubes)
+    return total
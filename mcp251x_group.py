@@ -0,0 +1,201 @@
+"""
+Several MCP251x on one SPI bus, served by a single thread.
+
+    group = ControllerGroup([
+        mcp251x.MCP251x(0, 0, int_gpio=mcp251x.GpioInterrupt(25)),
+        mcp251x.MCP251x(0, 1, int_gpio=mcp251x.GpioInterrupt(24)),
+    ], names=["can0", "can1"])
+    rings = group.start()
+
+All controllers share one lock, so SPI sequences of different chips never
+interleave, whichever thread issues them. The service thread visits pending
+controllers round-robin, starting one controller further on each pass, and
+reads at most GROUP_QUANTUM frames from one chip per visit so a busy bus
+cannot starve a quiet one.
+"""
+import select
+import threading
+import time
+
+import mcp251x
+
+# frames read from one controller per visit
+GROUP_QUANTUM = 4
+
+# longest wait for an INT edge before looking at stopping and errors again
+GROUP_WAIT = 0.1
+
+# pause between looks at INT lines that cannot be select()ed, such as
+# mcp251x_sim.SimulatedInterrupt
+GROUP_INT_POLL = 0.0005
+
+
+class GroupMember():
+    """
+    a controller of a ControllerGroup and what the service thread did for it
+    """
+
+    def __init__(self, can, name):
+        self.can = can
+        self.name = name
+        self.ring = None
+        self.frames = 0
+        self.services = 0
+        self.empty_services = 0
+        self.busy = 0.0
+
+    def snapshot(self):
+        can = self.can
+        return {
+            "name": self.name,
+            "frames": self.frames,
+            "services": self.services,
+            "empty_services": self.empty_services,
+            "busy_ms": self.busy * 1000.0,
+            "ring_overflows": self.ring.overflows if self.ring is not None else 0,
+            "tx_pending": can.txPending(),
+            "errors": can.getErrorCounters(),
+            "link": can.getLinkStats(),
+        }
+
+
+class ControllerGroup():
+    """
+    Owns controllers on distinct bus/device pairs. Controllers with an INT
+    line are serviced when it is asserted, the others are polled on a
+    mcp251x.PollScheduler; in a mixed group INT lines are only looked at
+    between polls.
+    """
+
+    def __init__(self, controllers, names=None, poller=None):
+        if names is None:
+            names = ["can%d" % i for i in range(len(controllers))]
+        self.lock = threading.RLock()
+        self.members = []
+        for can, name in zip(controllers, names):
+            if can._reader is not None:
+                raise ValueError("%s already runs its own reader" % name)
+            can.lock = self.lock
+            self.members.append(GroupMember(can, name))
+        self.poller = poller
+        self.passes = 0
+        self._thread = None
+        self._stop = threading.Event()
+
+    def __getitem__(self, i):
+        return self.members[i].can
+
+    def __len__(self):
+        return len(self.members)
+
+    def start(self, capacity=1024):
+        """
+        starts the service thread, returns the FrameRing of every controller
+        in order. Each controller's ring and onReceive work as with
+        MCP251x.startReader().
+        """
+        if self._thread is not None:
+            return [member.ring for member in self.members]
+        for member in self.members:
+            member.ring = mcp251x.FrameRing(capacity, member.can.dict_frames)
+            member.ring.latency = member.can.latency
+            member.can.ring = member.ring
+
+        self._polled = [m for m in self.members if m.can.int_gpio is None]
+        self._interrupts = [m for m in self.members if m.can.int_gpio is not None]
+        self._selectable = all(hasattr(m.can.int_gpio, "fileno") for m in self._interrupts)
+        if self._polled and self.poller is None:
+            self.poller = mcp251x.PollScheduler()
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._serviceLoop,
+                                        name="mcp251x-group", daemon=True)
+        self._thread.start()
+        return [member.ring for member in self.members]
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def getStats(self):
+        out = {
+            "passes": self.passes,
+            "controllers": [member.snapshot() for member in self.members],
+        }
+        if self.poller is not None:
+            out["poll"] = self.poller.snapshot()
+        return out
+
+    def _serviceLoop(self):
+        members = self.members
+        count = len(members)
+        first = 0
+        nextErrorCheck = time.monotonic()
+        while not self._stop.is_set():
+            now = time.monotonic()
+            if now >= nextErrorCheck:
+                for member in members:
+                    member.can.serviceErrors()
+                    member.can.serviceLink(now)
+                nextErrorCheck = now + mcp251x.ERROR_CHECK_INTERVAL
+
+            start = time.perf_counter()
+            frames = 0
+            polledFrames = 0
+            full = 0
+            serviced = False
+            for k in range(count):
+                member = members[(first + k) % count]
+                can = member.can
+                timestamp = None
+                if can.int_gpio is not None:
+                    if not can.int_gpio.asserted():
+                        continue
+                    timestamp = can.interruptTimestamp()
+                n = self._service(member, timestamp)
+                serviced = True
+                frames += n
+                if can.int_gpio is None:
+                    polledFrames += n
+                    full = max(full, can.lastRxFull)
+            first = (first + 1) % count
+            self.passes += 1
+
+            if self._polled:
+                cost = time.perf_counter() - start
+                time.sleep(self.poller.update(polledFrames, full, cost))
+            elif not serviced:
+                self._waitInterrupts()
+
+    def _service(self, member, timestamp):
+        can = member.can
+        start = time.perf_counter()
+        n = can.drainToRing(member.ring, timestamp, GROUP_QUANTUM)
+        if n:
+            if can.onReceive is not None:
+                can.onReceive()
+        elif can.int_gpio is not None and can.int_gpio.asserted():
+            # nothing to read, so an error or TX flag holds INT low
+            can.serviceErrors()
+            can.clearInterruptFlags()
+        member.busy += time.perf_counter() - start
+        member.services += 1
+        member.frames += n
+        if not n:
+            member.empty_services += 1
+        return n
+
+    def _waitInterrupts(self):
+        if not self._selectable:
+            time.sleep(GROUP_INT_POLL)
+            return
+        lines = {}
+        for member in self._interrupts:
+            lines[member.can.int_gpio.fileno()] = member.can.int_gpio
+        readable, _, _ = select.select(list(lines), [], [], GROUP_WAIT)
+        for fd in readable:
+            # takes the queued edges and their timestamp
+            lines[fd].wait(0)
@@ -0,0 +1,464 @@
+"""
+ISO-TP (ISO 15765-2) transport over MCP251x, normal addressing on classic
+CAN frames.
+
+    isotp = IsoTpChannel(can, tx_id=0x7E0, rx_id=0x7E8)
+    rc = isotp.send(b"\\x22\\xF1\\x90")
+    reply = isotp.recv(timeout=1.0)
+
+Received frames reach a channel through feed(). Pass dispatcher= to have a
+mcp251x_dispatch.Dispatcher on the reader thread call it, without a reader
+thread the channel reads the controller itself while it waits, handing
+frames for other ids to onOtherFrame.
+
+Consecutive frames are built straight into LOAD TX BUFFER bytes behind a
+header prepared once per channel. With STmin 0 up to ISOTP_TX_DEPTH of them
+are queued at a time, so whenever one of the three TX buffers frees up the
+next frame is already waiting for it. With a non-zero STmin each frame is
+loaded STmin after the previous one, sleeping most of the gap and spinning
+the last ISOTP_SPIN of it. While frames are in the TX buffers the sender
+looks at the controller with growing pauses, ISOTP_TX_POLL_MIN doubling up
+to ISOTP_TX_POLL_MAX, and starts over whenever one completes. Reassembly
+copies each frame's payload into a
+buffer of max_length bytes allocated with the channel.
+"""
+import collections
+import threading
+import time
+
+import mcp251x
+
+# protocol control information, high nibble of the first byte
+PCI_SF = 0x0
+PCI_FF = 0x1
+PCI_CF = 0x2
+PCI_FC = 0x3
+
+FC_CTS = 0
+FC_WAIT = 1
+FC_OVFLW = 2
+
+# results beyond mcp251x's ERROR_*
+ERROR_TIMEOUT  = 6
+ERROR_OVERFLOW = 7
+ERROR_PROTOCOL = 8
+
+# 12 bit first frame length, longer messages use the 32 bit escape
+FF_SHORT_MAX = 4095
+FF_LONG_MAX = 0xFFFFFFFF
+
+# consecutive frames queued ahead of the TX buffers with STmin 0
+ISOTP_TX_DEPTH = 6
+
+# part of an STmin gap spent spinning rather than sleeping, covers the
+# oversleep of time.sleep()
+ISOTP_SPIN = 0.0003
+
+# pause between looks at the controller while waiting without INT
+ISOTP_POLL = 0.0002
+
+# first and longest pause between serviceTx() calls while queued frames
+# wait for the bus
+ISOTP_TX_POLL_MIN = 0.00005
+ISOTP_TX_POLL_MAX = 0.001
+
+KEY_MASK = mcp251x.CAN_EFF_FLAG | mcp251x.CAN_EFF_MASK
+
+
+def encodeStMin(seconds):
+    """
+    STmin byte for a gap in seconds, rounded up to what can be expressed
+    """
+    us = int(round(seconds * 1e6))
+    if us <= 0:
+        return 0
+    if us <= 900:
+        return 0xF0 + (us + 99) // 100
+    return min(0x7F, (us + 999) // 1000)
+
+
+def decodeStMin(value):
+    """
+    gap in seconds for an STmin byte, reserved values count as the longest
+    gap as ISO 15765-2 asks
+    """
+    if value <= 0x7F:
+        return value / 1000.0
+    if 0xF1 <= value <= 0xF9:
+        return (value - 0xF0) / 10000.0
+    return 0.127
+
+
+class IsoTpChannel():
+    """
+    One ISO-TP connection: sends on tx_id and receives on rx_id, both can_id
+    values with CAN_EFF_FLAG for 29 bit ids. block_size and st_min (seconds)
+    are what this side asks of a sender. Frames are padded to 8 bytes with
+    padding unless it is None. timeout is N_Bs/N_Cr, how long either side
+    waits for the other's next frame.
+
+    Complete messages go to onMessage(view) when set, view being a
+    memoryview on the reassembly buffer that is only valid during the call,
+    otherwise they are kept for recv().
+    """
+
+    def __init__(self, can, tx_id, rx_id, block_size=0, st_min=0.0, padding=0xCC,
+                 max_length=FF_SHORT_MAX, timeout=1.0, max_wait_frames=10,
+                 dispatcher=None):
+        self.can = can
+        self.tx_id = tx_id
+        self.rx_id = rx_id
+        self.block_size = block_size
+        self.st_min = encodeStMin(st_min)
+        self.padding = padding
+        self.max_length = max_length
+        self.timeout = timeout
+        self.max_wait_frames = max_wait_frames
+        self.onMessage = None
+        self.onOtherFrame = None
+
+        self.tx_messages = 0
+        self.rx_messages = 0
+        self.rx_errors = 0
+        self.rx_overflows = 0
+        self.tx_errors = 0
+
+        # SIDH, SIDL, EID8, EID0 of tx_id and the arbitration key every
+        # frame of this channel shares
+        header = can.prepareTxBuffer(mcp251x.CanFrame(tx_id & KEY_MASK, b"", 0))
+        self._id = header[:mcp251x.MCP_DLC]
+        self._key = can.arbitrationKey(header)
+        self._pad = b"" if padding is None else bytes([padding] * mcp251x.CAN_MAX_DLEN)
+
+        self._rxKey = rx_id & KEY_MASK
+        self._rxBuf = bytearray(max_length)
+        self._rxView = memoryview(self._rxBuf)
+        self._rxLength = 0
+        self._rxOffset = 0
+        self._rxSn = 0
+        self._rxBlock = 0
+        self._rxActive = False
+        self._rxLast = 0.0
+        self._messages = collections.deque()
+
+        self._cond = threading.Condition()
+        self._fc = None
+        self._txDone = 0
+        self._txFailed = 0
+
+        self.dispatcher = dispatcher
+        if dispatcher is not None:
+            ext = (rx_id & mcp251x.CAN_EFF_FLAG) != 0
+            dispatcher.subscribe(rx_id, self.feed, ext=ext)
+        # without a reader thread nothing else reads the controller
+        self.polling = dispatcher is None and can.ring is None
+
+    def close(self):
+        if self.dispatcher is not None:
+            self.dispatcher.unsubscribe(self.feed)
+
+    def _txbuf(self, payload):
+        n = len(payload)
+        txbuf = self._id + bytes((n if self.padding is None else mcp251x.CAN_MAX_DLEN,))
+        txbuf.extend(payload)
+        txbuf += self._pad[n:]
+        return txbuf
+
+    def _txComplete(self, rc):
+        # from MCP251x._serviceTx() with the driver lock held
+        self._txDone += 1
+        if rc != mcp251x.ERROR_OK:
+            self._txFailed += 1
+        with self._cond:
+            self._cond.notify_all()
+
+    # sending
+
+    def send(self, data, timeout=None):
+        """
+        sends one message, blocking until its last frame is in a TX buffer
+        or sent. timeout overrides the channel's N_Bs. Returns ERROR_OK,
+        ERROR_TIMEOUT when the receiver's flow control does not come,
+        ERROR_OVERFLOW when it cannot take the message or ERROR_FAILTX.
+        An empty message, which no receiver accepts, or one longer than a
+        first frame can announce returns ERROR_FAIL without sending.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        n = len(data)
+        if n == 0 or n > FF_LONG_MAX:
+            self.tx_errors += 1
+            return mcp251x.ERROR_FAIL
+        data = memoryview(bytes(data))
+
+        with self._cond:
+            self._fc = None
+        self._txDone = 0
+        self._txFailed = 0
+
+        if n <= 7:
+            first = [(PCI_SF << 4) | n] + list(data)
+            offset = n
+        elif n <= FF_SHORT_MAX:
+            first = [(PCI_FF << 4) | (n >> 8), n & 0xFF] + list(data[:6])
+            offset = 6
+        else:
+            first = [PCI_FF << 4, 0] + list(n.to_bytes(4, "big")) + list(data[:2])
+            offset = 2
+        rc = self._sendFrames([self._txbuf(first)], 0.0, timeout)
+
+        sn = 1
+        while rc == mcp251x.ERROR_OK and offset < n:
+            rc, block_size, gap = self._waitFlowControl(timeout)
+            if rc != mcp251x.ERROR_OK:
+                break
+            count = -(-(n - offset) // 7)
+            if block_size:
+                count = min(count, block_size)
+            txbufs = []
+            for _ in range(count):
+                chunk = data[offset:offset + 7]
+                txbufs.append(self._txbuf([(PCI_CF << 4) | sn] + list(chunk)))
+                offset += len(chunk)
+                sn = (sn + 1) & 0x0F
+            with self._cond:
+                self._fc = None
+            rc = self._sendFrames(txbufs, gap, timeout)
+
+        if rc == mcp251x.ERROR_OK:
+            self.tx_messages += 1
+        else:
+            self.tx_errors += 1
+        return rc
+
+    def _waitFlowControl(self, timeout):
+        waits = 0
+        deadline = time.monotonic() + timeout
+        while True:
+            if not self._wait(lambda: self._fc is not None, deadline):
+                return ERROR_TIMEOUT, 0, 0.0
+            with self._cond:
+                status, block_size, st_min = self._fc
+                self._fc = None
+            if status == FC_CTS:
+                return mcp251x.ERROR_OK, block_size, decodeStMin(st_min)
+            if status == FC_OVFLW:
+                return ERROR_OVERFLOW, 0, 0.0
+            if status != FC_WAIT:
+                return ERROR_PROTOCOL, 0, 0.0
+            waits += 1
+            if waits > self.max_wait_frames:
+                return ERROR_TIMEOUT, 0, 0.0
+            deadline = time.monotonic() + timeout
+
+    def _sendFrames(self, txbufs, gap, timeout):
+        """
+        queues txbufs in order and drives serviceTx() until all of them left
+        or timeout passes without progress
+        """
+        can = self.can
+        total = len(txbufs)
+        start = self._txDone
+        queued = 0
+        depth = ISOTP_TX_DEPTH if gap == 0 else 1
+        nextLoad = time.perf_counter()
+        deadline = time.monotonic() + timeout
+        lastDone = start
+        delay = ISOTP_TX_POLL_MIN
+        while self._txDone - start < total:
+            if queued < total and queued - (self._txDone - start) < depth:
+                if gap:
+                    self._sleepUntil(nextLoad)
+                k = min(total - queued, depth - (queued - (self._txDone - start)))
+                entries = [(self._key, txbuf, self._txComplete)
+                           for txbuf in txbufs[queued:queued + k]]
+                with can.lock:
+                    rc = can.queueTxBuffers(entries)
+                    if rc == mcp251x.ERROR_OK:
+                        queued += k
+                    can.serviceTx()
+                nextLoad = time.perf_counter() + gap
+            else:
+                can.serviceTx()
+                if self.polling:
+                    self.poll()
+                if self._txDone == lastDone:
+                    # nothing left a TX buffer, back off instead of asking
+                    # for READ STATUS back to back. A completion seen by
+                    # another thread's serviceTx() ends the pause early
+                    with self._cond:
+                        if self._txDone == lastDone:
+                            self._cond.wait(delay)
+                    delay = min(delay * 2, ISOTP_TX_POLL_MAX)
+
+            if self._txDone != lastDone:
+                lastDone = self._txDone
+                deadline = time.monotonic() + timeout
+                delay = ISOTP_TX_POLL_MIN
+            elif time.monotonic() > deadline:
+                return ERROR_TIMEOUT
+        if self._txFailed:
+            return mcp251x.ERROR_FAILTX
+        return mcp251x.ERROR_OK
+
+    def _sleepUntil(self, t):
+        remaining = t - time.perf_counter()
+        if remaining > ISOTP_SPIN:
+            time.sleep(remaining - ISOTP_SPIN)
+        while time.perf_counter() < t:
+            pass
+
+    def _sendFlowControl(self, status):
+        txbuf = self._txbuf([(PCI_FC << 4) | status, self.block_size, self.st_min])
+        with self.can.lock:
+            self.can.queueTxBuffers([(self._key, txbuf, None)])
+            self.can.serviceTx()
+
+    # receiving
+
+    def recv(self, timeout=None):
+        """
+        next complete message as bytes, None if none arrives within timeout
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        if not self._wait(lambda: self._messages, deadline):
+            return None
+        with self._cond:
+            return self._messages.popleft()
+
+    def poll(self):
+        """
+        reads whatever the controller holds and feeds it, for channels
+        without a reader thread
+        """
+        rc, frames = self.can.readMessages()
+        for frame in frames:
+            if (frame.can_id & KEY_MASK) == self._rxKey:
+                self.feed(frame)
+            elif self.onOtherFrame is not None:
+                self.onOtherFrame(frame)
+
+    def _wait(self, ready, deadline):
+        while True:
+            with self._cond:
+                if ready():
+                    return True
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                if not self.polling:
+                    self._cond.wait(remaining)
+                    continue
+            self.poll()
+            with self._cond:
+                if ready():
+                    return True
+            time.sleep(ISOTP_POLL)
+
+    def feed(self, frame):
+        """
+        handles one received CanFrame of this channel
+        """
+        data = frame.data
+        if not data:
+            return
+        pci = data[0] >> 4
+
+        if pci == PCI_FC:
+            if len(data) < 3:
+                return
+            with self._cond:
+                self._fc = (data[0] & 0x0F, data[1], data[2])
+                self._cond.notify_all()
+            return
+
+        now = time.monotonic()
+        if self._rxActive and now - self._rxLast > self.timeout:
+            # N_Cr expired, the sender gave up on this message
+            self._rxActive = False
+            self.rx_errors += 1
+
+        if pci == PCI_SF:
+            n = data[0] & 0x0F
+            if n == 0 or n > len(data) - 1:
+                self.rx_errors += 1
+                return
+            if self._rxActive:
+                self._rxActive = False
+                self.rx_errors += 1
+            self._deliver(memoryview(data)[1:1 + n])
+
+        elif pci == PCI_FF:
+            if len(data) < mcp251x.CAN_MAX_DLEN:
+                self.rx_errors += 1
+                return
+            n = ((data[0] & 0x0F) << 8) | data[1]
+            start = 2
+            if n == 0:
+                n = int.from_bytes(data[2:6], "big")
+                start = 6
+                if n <= FF_SHORT_MAX:
+                    # the escape is only for lengths 12 bits cannot hold
+                    self.rx_errors += 1
+                    return
+            elif n < mcp251x.CAN_MAX_DLEN:
+                # fits a single frame, a sender must not segment it
+                self.rx_errors += 1
+                return
+            if self._rxActive:
+                self.rx_errors += 1
+            self._rxActive = False
+            if n > self.max_length:
+                self.rx_overflows += 1
+                self._sendFlowControl(FC_OVFLW)
+                return
+            chunk = mcp251x.CAN_MAX_DLEN - start
+            self._rxBuf[:chunk] = data[start:]
+            self._rxLength = n
+            self._rxOffset = chunk
+            self._rxSn = 1
+            self._rxBlock = 0
+            self._rxActive = True
+            self._rxLast = now
+            self._sendFlowControl(FC_CTS)
+
+        elif pci == PCI_CF:
+            if not self._rxActive:
+                return
+            if data[0] & 0x0F != self._rxSn:
+                self._rxActive = False
+                self.rx_errors += 1
+                return
+            offset = self._rxOffset
+            chunk = min(7, self._rxLength - offset, len(data) - 1)
+            self._rxBuf[offset:offset + chunk] = data[1:1 + chunk]
+            offset += chunk
+            self._rxOffset = offset
+            self._rxSn = (self._rxSn + 1) & 0x0F
+            self._rxLast = now
+            if offset >= self._rxLength:
+                self._rxActive = False
+                self._deliver(self._rxView[:offset])
+            elif self.block_size:
+                self._rxBlock += 1
+                if self._rxBlock == self.block_size:
+                    self._rxBlock = 0
+                    self._sendFlowControl(FC_CTS)
+
+    def _deliver(self, view):
+        self.rx_messages += 1
+        if self.onMessage is not None:
+            self.onMessage(view)
+            return
+        with self._cond:
+            self._messages.append(bytes(view))
+            self._cond.notify_all()
+
+    def getStats(self):
+        return {
+            "tx_messages": self.tx_messages,
+            "tx_errors": self.tx_errors,
+            "rx_messages": self.rx_messages,
+            "rx_errors": self.rx_errors,
+            "rx_overflows": self.rx_overflows,
+        }
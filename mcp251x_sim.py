@@ -0,0 +1,523 @@
+"""
+Software stand-in for spidev.SpiDev talking to an MCP2515.
+
+Models the register map, address auto-increment, the SPI instruction set,
+operating mode transitions, acceptance filtering, TX buffer scheduling and
+RX buffer overflow closely enough to exercise MCP251x without hardware:
+
+    sim = SimulatedSpiDev()
+    can = mcp251x.MCP251x(0, 0, spi=sim)
+    sim.injectFrame(0x123, b"\\x01\\x02")
+"""
+import threading
+import time
+
+import mcp251x as m
+
+
+# only writable in configuration mode
+CONFIG_REGISTERS = m.CONFIG_ONLY_REGISTERS | frozenset([m.MCP_TXRTSCTRL])
+
+TXBnCTRL_TXREQ = 0x08
+TXBnCTRL_TXP = 0x03
+RXBnCTRL_RXM_OFF = 0x60
+
+FILTER_REGISTERS = [
+    m.MCP_RXF0SIDH, m.MCP_RXF1SIDH, m.MCP_RXF2SIDH,
+    m.MCP_RXF3SIDH, m.MCP_RXF4SIDH, m.MCP_RXF5SIDH,
+]
+MASK_REGISTERS = [m.MCP_RXM0SIDH, m.MCP_RXM1SIDH]
+
+TX_CTRL = [m.MCP_TXB0CTRL, m.MCP_TXB1CTRL, m.MCP_TXB2CTRL]
+TX_IF = [m.CANINTF_TX0IF, m.CANINTF_TX1IF, m.CANINTF_TX2IF]
+
+
+class SimulatedSpiDev():
+
+    def __init__(self, mode_delay=0, hold_tx=False, corrupt_above=None, corrupt_every=50):
+        # number of CANSTAT reads before a requested mode takes effect
+        self.mode_delay = mode_delay
+        # leave TXREQ set until completeTx() is called
+        self.hold_tx = hold_tx
+        # above corrupt_above Hz every corrupt_every-th byte after the
+        # instruction and address gets a bit flipped, bit 0 of what the
+        # driver sends and bit 7 of what it receives, like a marginal cable
+        self.corrupt_above = corrupt_above
+        self.corrupt_every = corrupt_every
+        self._corruptCount = 0
+
+        self.max_speed_hz = 0
+        self.mode = 0
+        self.bits_per_word = 8
+
+        self.lock = threading.RLock()
+        self.interrupt = threading.Condition(self.lock)
+        # time.monotonic_ns() when INT last went low, like a GPIO edge event
+        self.int_edge_ns = None
+        self._intLevel = False
+
+        self.transmitted = []
+        self.dropped = 0
+        self.transactions = 0
+        self.bytes_clocked = 0
+        self.instructions = {}
+        # modelled time on the SPI wire, in seconds, at max_speed_hz
+        self.spi_time = 0.0
+
+        self.resetChip()
+
+    def open(self, bus, device):
+        self.bus = bus
+        self.device = device
+
+    def close(self):
+        pass
+
+    def resetChip(self):
+        with self.lock:
+            self.regs = bytearray(0x80)
+            self.regs[m.MCP_CANCTRL] = 0x87
+            self.regs[m.MCP_CANSTAT] = m.CANCTRL_REQOP_CONFIG
+            self._pendingMode = None
+            self._modeCountdown = 0
+            self._notify()
+
+    def resetCounters(self):
+        self.transactions = 0
+        self.bytes_clocked = 0
+        self.instructions = {}
+        self.spi_time = 0.0
+
+    # spidev interface
+
+    def xfer2(self, data, *args):
+        with self.lock:
+            command = list(data)
+            self.transactions += 1
+            self.bytes_clocked += len(command)
+            if self.max_speed_hz:
+                self.spi_time += len(command) * 8.0 / self.max_speed_hz
+            if not command:
+                return []
+            name = m.instructionName(command[0])
+            self.instructions[name] = self.instructions.get(name, 0) + 1
+            corrupt = self.corrupt_above is not None and self.max_speed_hz > self.corrupt_above
+            if corrupt:
+                self._corrupt(command, 0x01)
+            out = self._execute(command)
+            if corrupt:
+                self._corrupt(out, 0x80)
+            self._notify()
+            if isinstance(data, list):
+                # like spidev, the response replaces the contents of a list
+                # argument, which is returned
+                data[:] = out
+                return data
+            return out
+
+    xfer = xfer2
+    xfer3 = xfer2
+
+    def writebytes(self, data):
+        self.xfer2(data)
+
+    writebytes2 = writebytes
+
+    def readbytes(self, n):
+        return self.xfer2([0] * n)
+
+    # test helpers
+
+    def intAsserted(self):
+        return (self.regs[m.MCP_CANINTF] & self.regs[m.MCP_CANINTE]) != 0
+
+    def opMode(self):
+        return self.regs[m.MCP_CANSTAT] & m.CANSTAT_OPMOD
+
+    def injectFrame(self, can_id, data=b"", ext=None, rtr=False, dlc=None):
+        """
+        Put a frame on the simulated bus, returns the RX buffer number it
+        landed in, or None if it was filtered out or dropped.
+        """
+        with self.lock:
+            if ext is None:
+                ext = can_id > 0x7FF
+            if dlc is None:
+                dlc = len(data)
+            rxbn = self._receive(can_id, bytes(data), ext, rtr, dlc)
+            self._notify()
+            return rxbn
+
+    def completeTx(self):
+        """
+        Transmit every buffer with TXREQ set, in chip priority order.
+        """
+        with self.lock:
+            self._transmit()
+            self._notify()
+
+    def setErrorCounters(self, tec, rec):
+        with self.lock:
+            self.regs[m.MCP_TEC] = min(tec, 255)
+            self.regs[m.MCP_REC] = min(rec, 255)
+            eflg = self.regs[m.MCP_EFLG] & (m.EFLG_RX0OVR | m.EFLG_RX1OVR)
+            if tec >= 96 or rec >= 96:
+                eflg |= m.EFLG_EWARN
+            if tec >= 96:
+                eflg |= m.EFLG_TXWAR
+            if rec >= 96:
+                eflg |= m.EFLG_RXWAR
+            if tec >= 128:
+                eflg |= m.EFLG_TXEP
+            if rec >= 128:
+                eflg |= m.EFLG_RXEP
+            if tec >= 256:
+                eflg |= m.EFLG_TXBO
+            if eflg != self.regs[m.MCP_EFLG]:
+                self.regs[m.MCP_CANINTF] |= m.CANINTF_ERRIF
+            self.regs[m.MCP_EFLG] = eflg
+            self._notify()
+
+    # internals
+
+    def _corrupt(self, data, bit):
+        for i in range(2, len(data)):
+            self._corruptCount += 1
+            if self._corruptCount % self.corrupt_every == 0:
+                data[i] ^= bit
+
+    def _notify(self):
+        asserted = self.intAsserted()
+        if asserted and not self._intLevel:
+            self.int_edge_ns = time.monotonic_ns()
+        self._intLevel = asserted
+        if asserted:
+            self.interrupt.notify_all()
+
+    def _execute(self, data):
+        instruction = data[0]
+        n = len(data)
+
+        if instruction == m.INSTRUCTION_RESET:
+            self.resetChip()
+            return [0] * n
+
+        if instruction == m.INSTRUCTION_READ:
+            out = [0, 0]
+            addr = data[1] if n > 1 else 0
+            for _ in range(n - 2):
+                out.append(self._readReg(addr))
+                addr = (addr + 1) & 0x7F
+            return out[:n]
+
+        if instruction == m.INSTRUCTION_WRITE:
+            addr = data[1] if n > 1 else 0
+            for value in data[2:]:
+                self._writeReg(addr, 0xFF, value)
+                addr = (addr + 1) & 0x7F
+            return [0] * n
+
+        if instruction == m.INSTRUCTION_BITMOD:
+            if n >= 4:
+                mask = data[2] if data[1] in m.BITMOD_REGISTERS else 0xFF
+                self._writeReg(data[1], mask, data[3])
+            return [0] * n
+
+        if instruction == m.INSTRUCTION_READ_STATUS:
+            return [0] + [self._status()] * (n - 1)
+
+        if instruction == m.INSTRUCTION_RX_STATUS:
+            return [0] + [self._rxStatus()] * (n - 1)
+
+        if instruction & 0xF9 == 0x90:
+            rxbn = (instruction >> 2) & 0x01
+            addr = m.RXB[rxbn][m.SIDH] if not instruction & 0x02 else m.RXB[rxbn][m.DATA]
+            out = [0]
+            for _ in range(n - 1):
+                out.append(self.regs[addr])
+                addr = (addr + 1) & 0x7F
+            if n > 1:
+                self.regs[m.MCP_CANINTF] &= ~m.RXB[rxbn][m.CANINTF_RXnIF] & 0xFF
+            return out
+
+        if instruction & 0xF8 == 0x40:
+            abc = instruction & 0x07
+            if abc < 6:
+                txbn = abc >> 1
+                addr = m.TXB[txbn][m.SIDH] if not abc & 0x01 else m.TXB[txbn][m.DATA]
+                for value in data[1:]:
+                    self.regs[addr] = value
+                    addr = (addr + 1) & 0x7F
+            return [0] * n
+
+        if instruction & 0xF8 == 0x80:
+            # all requested buffers first, the chip then sends them by TXP
+            # and, among equal TXP, highest buffer first
+            for txbn in range(3):
+                if instruction & (1 << txbn):
+                    self.regs[TX_CTRL[txbn]] |= TXBnCTRL_TXREQ
+            if not self.hold_tx:
+                self._transmit()
+            return [0] * n
+
+        return [0] * n
+
+    def _readReg(self, addr):
+        if addr == m.MCP_CANSTAT and self._pendingMode is not None:
+            self._modeCountdown -= 1
+            if self._modeCountdown < 0:
+                self._enterMode(self._pendingMode)
+        return self.regs[addr]
+
+    def _writeReg(self, addr, mask, value):
+        old = self.regs[addr]
+        new = (old & ~mask | value & mask) & 0xFF
+
+        if addr in (m.MCP_CANSTAT, 0x1E, 0x2E, 0x3E, 0x4E, 0x5E, 0x6E, 0x7E,
+                    m.MCP_TEC, m.MCP_REC):
+            return
+        if addr in CONFIG_REGISTERS and self.opMode() != m.CANCTRL_REQOP_CONFIG:
+            return
+
+        if addr in (0x0F, 0x1F, 0x2F, 0x3F, 0x4F, 0x5F, 0x6F, 0x7F):
+            # CANCTRL is mirrored at every xFh address
+            self.regs[m.MCP_CANCTRL] = new
+            if (old ^ new) & m.CANCTRL_REQOP or self._pendingMode is not None:
+                self._requestMode(new & m.CANCTRL_REQOP)
+            return
+
+        if addr == m.MCP_EFLG:
+            # only the overflow bits can be cleared from outside
+            keep = ~(m.EFLG_RX0OVR | m.EFLG_RX1OVR) & 0xFF
+            self.regs[addr] = old & keep | new & ~keep & old
+            return
+
+        if addr in (m.MCP_RXB0CTRL, m.MCP_RXB1CTRL):
+            # RXRTR, FILHIT (and BUKT1 on RXB0) are read only
+            readonly = 0x0B if addr == m.MCP_RXB0CTRL else 0x0F
+            self.regs[addr] = old & readonly | new & ~readonly & 0xFF
+            return
+
+        if addr in TX_CTRL:
+            # ABTF, MLOA and TXERR are read only
+            self.regs[addr] = old & 0x70 | new & 0x0B
+            if new & TXBnCTRL_TXREQ and not self.hold_tx:
+                self._transmit()
+            return
+
+        self.regs[addr] = new
+
+    def _requestMode(self, mode):
+        if self.mode_delay:
+            self._pendingMode = mode
+            self._modeCountdown = self.mode_delay
+        else:
+            self._enterMode(mode)
+
+    def _enterMode(self, mode):
+        self._pendingMode = None
+        if mode == m.CANCTRL_REQOP_POWERUP:
+            mode = m.CANCTRL_REQOP_CONFIG
+        if mode == m.CANCTRL_REQOP_CONFIG:
+            self.regs[m.MCP_TEC] = 0
+            self.regs[m.MCP_REC] = 0
+            self.regs[m.MCP_EFLG] &= m.EFLG_RX0OVR | m.EFLG_RX1OVR
+        stat = self.regs[m.MCP_CANSTAT]
+        self.regs[m.MCP_CANSTAT] = stat & ~m.CANSTAT_OPMOD & 0xFF | mode
+        if not self.hold_tx:
+            self._transmit()
+
+    def _status(self):
+        intf = self.regs[m.MCP_CANINTF]
+        stat = intf & (m.CANINTF_RX0IF | m.CANINTF_RX1IF)
+        for txbn in range(3):
+            if self.regs[TX_CTRL[txbn]] & TXBnCTRL_TXREQ:
+                stat |= 0x04 << (2 * txbn)
+            if intf & TX_IF[txbn]:
+                stat |= 0x08 << (2 * txbn)
+        return stat
+
+    def _rxStatus(self):
+        intf = self.regs[m.MCP_CANINTF]
+        full = intf & (m.CANINTF_RX0IF | m.CANINTF_RX1IF)
+        if not full:
+            return 0
+        rxbn = m.RXB0 if full & m.CANINTF_RX0IF else m.RXB1
+        sidl = self.regs[m.RXB[rxbn][m.SIDH] + 1]
+        dlc = self.regs[m.RXB[rxbn][m.SIDH] + 4]
+        if sidl & m.TXB_EXIDE_MASK:
+            kind = 0x10 | (0x08 if dlc & m.RTR_MASK else 0)
+        else:
+            kind = 0x08 if sidl & m.SIDL_SRR else 0
+        ctrl = self.regs[m.RXB[rxbn][m.CTRL]]
+        filhit = ctrl & (m.RXB0CTRL_FILHIT_MASK if rxbn == m.RXB0 else m.RXB1CTRL_FILHIT_MASK)
+        if rxbn == m.RXB0:
+            filhit &= 0x01
+        elif filhit <= 1:
+            # RXF0/RXF1 in RXB1 means the frame rolled over from RXB0,
+            # which RX STATUS reports as 6/7
+            filhit += 6
+        return (full << 6) | kind | filhit
+
+    def _transmit(self):
+        mode = self.opMode()
+        if mode not in (m.CANCTRL_REQOP_NORMAL, m.CANCTRL_REQOP_LOOPBACK):
+            return
+        if self.regs[m.MCP_EFLG] & m.EFLG_TXBO:
+            return
+        while True:
+            best = None
+            for txbn in range(3):
+                ctrl = self.regs[TX_CTRL[txbn]]
+                if not ctrl & TXBnCTRL_TXREQ:
+                    continue
+                key = (ctrl & TXBnCTRL_TXP, txbn)
+                if best is None or key > best[0]:
+                    best = (key, txbn)
+            if best is None:
+                return
+            txbn = best[1]
+            base = m.TXB[txbn][m.SIDH]
+            header = self.regs[base:base + 5]
+            ext = bool(header[m.MCP_SIDL] & m.TXB_EXIDE_MASK)
+            can_id = (header[m.MCP_SIDH] << 3) | (header[m.MCP_SIDL] >> 5)
+            if ext:
+                can_id = (can_id << 18) | ((header[m.MCP_SIDL] & 0x03) << 16) | \
+                    (header[m.MCP_EID8] << 8) | header[m.MCP_EID0]
+            rtr = bool(header[m.MCP_DLC] & m.RTR_MASK)
+            dlc = header[m.MCP_DLC] & m.DLC_MASK
+            data = bytes(self.regs[base + 5:base + 5 + min(dlc, 8)])
+            if rtr:
+                data = b""
+            self.regs[TX_CTRL[txbn]] &= ~TXBnCTRL_TXREQ & 0xFF
+            self.regs[m.MCP_CANINTF] |= TX_IF[txbn]
+            self.transmitted.append((can_id, ext, rtr, dlc, data))
+            if mode == m.CANCTRL_REQOP_LOOPBACK:
+                self._receive(can_id, data, ext, rtr, dlc)
+
+    def _filterMatch(self, num, maskreg, can_id, data, ext):
+        f = self.regs[FILTER_REGISTERS[num]:FILTER_REGISTERS[num] + 4]
+        k = self.regs[maskreg:maskreg + 4]
+        if bool(f[m.MCP_SIDL] & m.TXB_EXIDE_MASK) != ext:
+            return False
+        if ext:
+            fid = (f[0] << 21) | ((f[1] >> 5) << 18) | ((f[1] & 0x03) << 16) | (f[2] << 8) | f[3]
+            kid = (k[0] << 21) | ((k[1] >> 5) << 18) | ((k[1] & 0x03) << 16) | (k[2] << 8) | k[3]
+            return (can_id ^ fid) & kid == 0
+        fid = (f[0] << 3) | (f[1] >> 5)
+        kid = (k[0] << 3) | (k[1] >> 5)
+        if (can_id ^ fid) & kid:
+            return False
+        # standard frames are also compared against the EID bits on the
+        # first two data bytes
+        d0 = data[0] if len(data) > 0 else 0
+        d1 = data[1] if len(data) > 1 else 0
+        return (d0 ^ f[2]) & k[2] == 0 and (d1 ^ f[3]) & k[3] == 0
+
+    def _receive(self, can_id, data, ext, rtr, dlc):
+        mode = self.opMode()
+        if mode not in (m.CANCTRL_REQOP_NORMAL, m.CANCTRL_REQOP_LOOPBACK,
+                        m.CANCTRL_REQOP_LISTENONLY):
+            self.dropped += 1
+            return None
+
+        ctrl0 = self.regs[m.MCP_RXB0CTRL]
+        ctrl1 = self.regs[m.MCP_RXB1CTRL]
+        intf = self.regs[m.MCP_CANINTF]
+
+        hit0 = None
+        if ctrl0 & RXBnCTRL_RXM_OFF == RXBnCTRL_RXM_OFF:
+            hit0 = 0
+        else:
+            for num in (0, 1):
+                if self._filterMatch(num, m.MCP_RXM0SIDH, can_id, data, ext):
+                    hit0 = num
+                    break
+
+        target = None
+        filhit = None
+        if hit0 is not None:
+            if not intf & m.CANINTF_RX0IF:
+                target, filhit = m.RXB0, hit0
+            elif ctrl0 & m.RXB0CTRL_BUKT:
+                # rollover into RXB1, FILHIT reports RXF0/RXF1 as 0/1
+                target, filhit = m.RXB1, hit0
+            else:
+                self._overflow(m.RXB0)
+                return None
+        else:
+            if ctrl1 & RXBnCTRL_RXM_OFF == RXBnCTRL_RXM_OFF:
+                target, filhit = m.RXB1, 2
+            else:
+                for num in (2, 3, 4, 5):
+                    if self._filterMatch(num, m.MCP_RXM1SIDH, can_id, data, ext):
+                        target, filhit = m.RXB1, num
+                        break
+            if target is None:
+                self.dropped += 1
+                return None
+
+        if target == m.RXB1 and intf & m.CANINTF_RX1IF:
+            self._overflow(m.RXB1)
+            return None
+
+        base = m.RXB[target][m.SIDH]
+        if ext:
+            sid = can_id >> 18
+            self.regs[base] = sid >> 3
+            self.regs[base + 1] = ((sid & 0x07) << 5) | m.TXB_EXIDE_MASK | ((can_id >> 16) & 0x03)
+            self.regs[base + 2] = (can_id >> 8) & 0xFF
+            self.regs[base + 3] = can_id & 0xFF
+            self.regs[base + 4] = (dlc & 0x0F) | (m.RTR_MASK if rtr else 0)
+        else:
+            self.regs[base] = (can_id >> 3) & 0xFF
+            self.regs[base + 1] = ((can_id & 0x07) << 5) | (m.SIDL_SRR if rtr else 0)
+            self.regs[base + 2] = 0
+            self.regs[base + 3] = 0
+            self.regs[base + 4] = dlc & 0x0F
+        for i in range(8):
+            self.regs[base + 5 + i] = data[i] if i < len(data) else 0
+
+        ctrl = m.RXB[target][m.CTRL]
+        if target == m.RXB0:
+            self.regs[ctrl] = ctrl0 & ~0x0B & 0xFF | (m.RXBnCTRL_RTR if rtr else 0) | filhit
+        else:
+            self.regs[ctrl] = ctrl1 & ~0x0F & 0xFF | (m.RXBnCTRL_RTR if rtr else 0) | filhit
+        self.regs[m.MCP_CANINTF] |= m.RXB[target][m.CANINTF_RXnIF]
+        return target
+
+    def _overflow(self, rxbn):
+        self.dropped += 1
+        self.regs[m.MCP_EFLG] |= m.EFLG_RX0OVR if rxbn == m.RXB0 else m.EFLG_RX1OVR
+        self.regs[m.MCP_CANINTF] |= m.CANINTF_ERRIF
+
+
+class SimulatedInterrupt():
+    """
+    INT line of a SimulatedSpiDev, usable wherever MCP251x takes an int_gpio
+    """
+
+    def __init__(self, sim):
+        self.sim = sim
+        self._edge = None
+
+    def asserted(self):
+        return self.sim.intAsserted()
+
+    def wait(self, timeout=None):
+        with self.sim.interrupt:
+            if self.sim.intAsserted():
+                return True
+            self.sim.interrupt.wait(timeout)
+            if self.sim.intAsserted():
+                self._edge = self.sim.int_edge_ns
+                return True
+            return False
+
+    def edgeTimestamp(self):
+        edge = self._edge
+        self._edge = None
+        return edge
+
+    def close(self):
+        pass
@@ -0,0 +1,203 @@
+"""
+Opt-in instrumentation for MCP251x, see MCP251x.enableInstrumentation().
+
+Nothing in here is on the hot path unless instrumentation is enabled: the
+driver's spi object is swapped for an InstrumentedSpi and the timed methods
+are shadowed by instance attributes, both undone by disableInstrumentation().
+"""
+import array
+import time
+
+import mcp251x
+
+TIMED_METHODS = [
+    "readMessage", "readMessages", "sendMessages", "serviceTx",
+    "setMode", "reset", "setBitrate", "setFilter", "setFilterMask",
+]
+
+
+class LatencyHistogram():
+    """
+    log2 buckets of nanoseconds, bucket i holds samples below 2**i ns
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.buckets = [0] * 64
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def add(self, ns):
+        self.buckets[min(ns.bit_length(), 63)] += 1
+        self.count += 1
+        self.total += ns
+        if self.min is None or ns < self.min:
+            self.min = ns
+        if ns > self.max:
+            self.max = ns
+
+    def percentile(self, p):
+        """
+        upper bound of the bucket holding the p-th percentile, in ns
+        """
+        if not self.count:
+            return 0
+        rank = self.count * p / 100.0
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank and n:
+                return min(1 << i, self.max)
+        return self.max
+
+    def snapshot(self):
+        if not self.count:
+            return {"count": 0}
+        return {
+            "count": self.count,
+            "mean_us": self.total / self.count / 1000.0,
+            "min_us": self.min / 1000.0,
+            "max_us": self.max / 1000.0,
+            "p50_us": self.percentile(50) / 1000.0,
+            "p99_us": self.percentile(99) / 1000.0,
+        }
+
+
+class LatencyTrace():
+    """
+    Receive latency, from a frame's timestamp until it reaches the consumer.
+    The last capacity samples are kept as they are for exact percentiles,
+    the histogram covers every sample since the last reset().
+    """
+
+    def __init__(self, capacity=65536):
+        self.capacity = capacity
+        self.samples = array.array("Q", bytes(8 * capacity))
+        self.histogram = LatencyHistogram()
+        self.count = 0
+
+    def add(self, ns):
+        if ns < 0:
+            ns = 0
+        self.samples[self.count % self.capacity] = ns
+        self.count += 1
+        self.histogram.add(ns)
+
+    def reset(self):
+        self.count = 0
+        self.histogram.reset()
+
+    def percentiles(self, percentiles=(50, 90, 99, 99.9)):
+        """
+        exact percentiles over the kept samples, in ns
+        """
+        n = min(self.count, self.capacity)
+        if not n:
+            return {}
+        window = sorted(self.samples[:n])
+        out = {}
+        for p in percentiles:
+            out[p] = window[min(n - 1, int(n * p / 100.0))]
+        return out
+
+    def snapshot(self, percentiles=None):
+        out = self.histogram.snapshot()
+        if not self.count:
+            return out
+        out["window"] = min(self.count, self.capacity)
+        for p, ns in self.percentiles(percentiles or (50, 90, 99, 99.9)).items():
+            out["p%s_us" % p] = ns / 1000.0
+        return out
+
+
+class InstrumentedSpi():
+    """
+    Wraps a spidev.SpiDev like object and counts transactions and bytes per
+    instruction. Attributes other than the transfer calls pass through.
+    """
+
+    def __init__(self, spi):
+        self.__dict__["spi"] = spi
+        self.__dict__["counts"] = {}
+
+    def __getattr__(self, name):
+        return getattr(self.spi, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.spi, name, value)
+
+    def _count(self, data):
+        if not len(data):
+            return
+        name = mcp251x.instructionName(data[0])
+        entry = self.counts.get(name)
+        if entry is None:
+            entry = self.counts[name] = [0, 0]
+        entry[0] += 1
+        entry[1] += len(data)
+
+    def xfer2(self, data, *args):
+        self._count(data)
+        return self.spi.xfer2(data, *args)
+
+    def writebytes2(self, data):
+        self._count(data)
+        return self.spi.writebytes2(data)
+
+    def reset(self):
+        self.counts.clear()
+
+    def snapshot(self):
+        out = {}
+        for name, (transactions, nbytes) in self.counts.items():
+            out[name] = {"transactions": transactions, "bytes": nbytes}
+        return out
+
+
+def timedMethod(histogram, method):
+    perf_counter_ns = time.perf_counter_ns
+
+    def timed(*args, **kwargs):
+        start = perf_counter_ns()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            histogram.add(perf_counter_ns() - start)
+    timed.__name__ = method.__name__
+    timed.__doc__ = method.__doc__
+    return timed
+
+
+class Instrumentation():
+
+    def __init__(self, can, methods=None):
+        self.can = can
+        self.spi = InstrumentedSpi(can.spi)
+        self.methods = {}
+        for name in (methods if methods is not None else TIMED_METHODS):
+            self.methods[name] = LatencyHistogram()
+
+    def install(self):
+        self.can.spi = self.spi
+        for name, histogram in self.methods.items():
+            setattr(self.can, name, timedMethod(histogram, getattr(type(self.can), name).__get__(self.can)))
+
+    def uninstall(self):
+        self.can.spi = self.spi.spi
+        for name in self.methods:
+            self.can.__dict__.pop(name, None)
+
+    def reset(self):
+        self.spi.reset()
+        for histogram in self.methods.values():
+            histogram.reset()
+
+    def snapshot(self):
+        methods = {}
+        for name, histogram in self.methods.items():
+            methods[name] = histogram.snapshot()
+        return {"spi": self.spi.snapshot(), "methods": methods}
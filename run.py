@@ -3,9 +3,15 @@ import mcp251x
 
 BUS = 0 # We only have SPI bus 0 available to us on the Pi
 DEVICE = 0 # Device is the chip select pin. Set to 0 or 1, depending on the connections
+INT_PIN = None # GPIO line the chip's INT pin is wired to, None to poll instead
+CAPTURE_DIR = None # directory to record frames to instead of printing them, see mcp251x_capture
+CALIBRATE_SPI = True # look for the fastest SPI clock the wiring carries, see MCP251x.calibrateSpi()
 
 def main():
-    can = mcp251x.MCP251x(BUS, DEVICE)
+    int_gpio = None
+    if INT_PIN is not None:
+        int_gpio = mcp251x.GpioInterrupt(INT_PIN)
+    can = mcp251x.MCP251x(BUS, DEVICE, int_gpio=int_gpio)
 
     print("resetting chip")
     if can.reset() != mcp251x.ERROR_OK:
@@ -17,25 +23,67 @@ def main():
         print("error setting bitrate")
         exit(1)
 
+    if CALIBRATE_SPI:
+        print("calibrating SPI clock")
+        error, clock = can.calibrateSpi()
+        if error != mcp251x.ERROR_OK:
+            print("SPI link unreliable even at the slowest clock")
+            exit(1)
+        print("using SPI clock", clock / 1e6, "MHz")
+        # watch the link and slow down if it starts corrupting, the reader
+        # thread does it by itself, the loops below call serviceLink()
+        can.enableLinkCheck()
+
     print("setting CAN normal mode")
     if can.setNormalMode() != mcp251x.ERROR_OK:
         print("error setting normal mode")
         exit(1)
     time.sleep(0.025)
 
+    if CAPTURE_DIR is not None:
+        capture(can)
+
     print("starting to read messages if available...")
     n_frames = 0
+    while int_gpio is not None:
+        error, can_msgs = can.waitMessages(0.1)
+        can.serviceLink(time.monotonic())
+        for can_msg in can_msgs:
+            n_frames += 1
+            print("got a can message", hex(can_msg.can_id), ", ", n_frames, "total CAN frames")
+            print(can_msg)
+
+    # no INT line, poll as often as the traffic needs
+    poller = mcp251x.PollScheduler()
     while True:
-        error, can_msg = can.readMessage()
-        if error == mcp251x.ERROR_OK:
+        start = time.perf_counter()
+        error, can_msgs = can.readMessages()
+        can.serviceLink(time.monotonic())
+        for can_msg in can_msgs:
             n_frames += 1
-            print("got a can message", hex(can_msg["can_id"]), ", ", n_frames, "total CAN frames")
+            print("got a can message", hex(can_msg.can_id), ", ", n_frames, "total CAN frames")
             print(can_msg)
-            # print(hex(can_msg["can_id"]))
-        else:
-            # print("didnt get a can message")
-            time.sleep(0.010)
+            # print(hex(can_msg.can_id))
+        time.sleep(poller.update(len(can_msgs), can.lastRxFull, time.perf_counter() - start))
+
+
+def capture(can):
+    import mcp251x_capture
 
+    capture = mcp251x_capture.CaptureWriter(CAPTURE_DIR)
+    can.startReader()
+    capture.attach(can)
+    print("capturing to", CAPTURE_DIR)
+    try:
+        while True:
+            time.sleep(10)
+            print(capture.records, "frames captured,", capture.dropped, "dropped,",
+                  can.ring.overflows, "ring overflows")
+    except KeyboardInterrupt:
+        pass
+    can.stopReader()
+    capture.close()
+    exit(0)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,179 @@
+"""
+Regression tests for the MCP251x hot paths against mcp251x_sim:
+
+    python -m pytest -q test_mcp251x_sim.py
+"""
+import pytest
+
+import mcp251x
+from mcp251x_sim import SimulatedSpiDev
+
+
+def setup(fast_rx=True, **kwargs):
+    sim = SimulatedSpiDev(**kwargs)
+    can = mcp251x.MCP251x(0, 0, spi=sim, fast_rx=fast_rx)
+    assert can.reset() == mcp251x.ERROR_OK
+    assert can.setBitrate(mcp251x.CAN_500KBPS, mcp251x.MCP_16MHZ) == mcp251x.ERROR_OK
+    assert can.setNormalMode() == mcp251x.ERROR_OK
+    return sim, can
+
+
+def ids(frames):
+    return [frame.can_id for frame in frames]
+
+
+def drained(ring):
+    return [ring.get().can_id for _ in range(len(ring))]
+
+
+# RX order across both buffers
+
+def test_rx_rollover_order():
+    sim, can = setup()
+    sim.injectFrame(0x10, b"a")
+    sim.injectFrame(0x11, b"b")
+    rc, frames = can.readMessages()
+    assert rc == mcp251x.ERROR_OK
+    assert ids(frames) == [0x10, 0x11]
+
+
+@pytest.mark.parametrize("fast_rx", [True, False])
+@pytest.mark.parametrize("partial", ["readMessages", "readMessage"])
+def test_rx_order_after_partial_drain(partial, fast_rx):
+    sim, can = setup(fast_rx=fast_rx)
+    sim.injectFrame(0x10, b"a")
+    sim.injectFrame(0x11, b"b")
+    if partial == "readMessages":
+        rc, frames = can.readMessages(max_frames=1)
+        assert ids(frames) == [0x10]
+    else:
+        rc, frame = can.readMessage()
+        assert frame.can_id == 0x10
+    # RXB1 still holds the older frame when the next one lands in RXB0
+    sim.injectFrame(0x12, b"c")
+    rc, frames = can.readMessages()
+    assert ids(frames) == [0x11, 0x12]
+
+
+def test_drain_to_ring_order_after_partial_drain():
+    sim, can = setup()
+    ring = mcp251x.FrameRing(16)
+    sim.injectFrame(0x10, b"a")
+    sim.injectFrame(0x11, b"b")
+    rc, frames = can.readMessages(max_frames=1)
+    assert ids(frames) == [0x10]
+    sim.injectFrame(0x12, b"c")
+    assert can.drainToRing(ring) == 2
+    assert drained(ring) == [0x11, 0x12]
+
+
+def test_rx_filter_hit():
+    sim, can = setup()
+    sim.injectFrame(0x10, b"a")
+    sim.injectFrame(0x12345, b"b", ext=True)
+    rc, frames = can.readMessages()
+    assert [frame.filter for frame in frames] == [0, None]
+    rc, frame = can.readMessage()
+    assert frame is None
+    # a frame rolled over into RXB1 reports RXF0 through RX STATUS code 6
+    sim.injectFrame(0x10, b"a")
+    sim.injectFrame(0x11, b"b")
+    can.readMessages(max_frames=1)
+    rc, frames = can.readMessages()
+    assert ids(frames) == [0x11]
+    assert frames[0].filter == 0
+
+
+# TX priority across the three buffers
+
+def sent(sim):
+    return [(can_id, data) for can_id, ext, rtr, dlc, data in sim.transmitted]
+
+
+def test_tx_arbitration_order():
+    sim, can = setup(hold_tx=True)
+    # loaded one by one, so the lowest ID ends up in the last buffer
+    for can_id in (0x300, 0x200, 0x100):
+        assert can.sendMessage(mcp251x.CanFrame(can_id, b"x")) == mcp251x.ERROR_OK
+    frames = [mcp251x.CanFrame(0x400, b"x"), mcp251x.CanFrame(0x050, b"x")]
+    assert can.sendMessages(frames) == mcp251x.ERROR_OK
+    while can.txPending():
+        sim.completeTx()
+        can.serviceTx()
+    expected = [0x100, 0x200, 0x300, 0x050, 0x400]
+    assert [can_id for can_id, _ in sent(sim)] == expected
+
+
+def test_tx_same_id_keeps_queue_order():
+    sim, can = setup()
+    frames = [mcp251x.CanFrame(0x100, bytes([i])) for i in range(7)]
+    assert can.sendMessages(frames) == mcp251x.ERROR_OK
+    while can.txPending():
+        can.serviceTx()
+    assert sent(sim) == [(0x100, bytes([i])) for i in range(7)]
+
+
+def test_tx_one_rts_for_several_buffers():
+    sim, can = setup()
+    # one frame first so the next batch starts at TXB1 and buffer order
+    # no longer matches arbitration order, TXP has to sort it out
+    assert can.sendMessage(mcp251x.CanFrame(0x700, b"x")) == mcp251x.ERROR_OK
+    can.serviceTx()
+    frames = [mcp251x.CanFrame(can_id, b"x") for can_id in (0x300, 0x100, 0x200)]
+    assert can.sendMessages(frames) == mcp251x.ERROR_OK
+    expected = [0x700, 0x100, 0x200, 0x300]
+    assert [can_id for can_id, _ in sent(sim)] == expected
+
+
+def test_reset_fails_pending_tx():
+    sim, can = setup(hold_tx=True)
+    results = []
+    for i in range(5):
+        can.sendMessage(mcp251x.CanFrame(0x100 + i, b"x"), callback=results.append)
+    assert can.reset() == mcp251x.ERROR_OK
+    assert results == [mcp251x.ERROR_FAILTX] * 5
+    assert can.txPending() == 0
+
+
+# software post-filter
+
+# more IDs than the six filters can hold exactly
+WANTED = [0x100, 0x103, 0x105, 0x300, 0x307, 0x400, 0x555]
+
+
+def test_rx_accept_drops_false_accepts():
+    sim, can = setup()
+    rc, plan = can.setAcceptanceFilters(std=WANTED)
+    assert rc == mcp251x.ERROR_OK
+    assert plan.false_accepts
+    assert can.setNormalMode() == mcp251x.ERROR_OK
+    for ext, can_id in plan.falseAcceptIds(4):
+        sim.injectFrame(can_id, b"x", ext=ext)
+        rc, frames = can.readMessages()
+        assert frames == []
+    for can_id in (0x100, 0x555):
+        sim.injectFrame(can_id, b"x")
+        rc, frames = can.readMessages()
+        assert ids(frames) == [can_id]
+
+
+@pytest.mark.parametrize("change", ["setFilter", "setFilterMask"])
+def test_manual_filters_clear_rx_accept(change):
+    sim, can = setup()
+    can.setAcceptanceFilters(std=WANTED)
+    assert can.rxAccept is not None
+    if change == "setFilter":
+        assert can.setFilter(mcp251x.RXF0, False, 0x7FF) == mcp251x.ERROR_OK
+    else:
+        assert can.setFilterMask(mcp251x.MASK0, False, 0) == mcp251x.ERROR_OK
+    assert can.rxAccept is None
+
+
+def test_clear_filters_accepts_everything():
+    sim, can = setup()
+    can.setAcceptanceFilters(std=[0x100])
+    assert can.clearFilters() == mcp251x.ERROR_OK
+    assert can.setNormalMode() == mcp251x.ERROR_OK
+    sim.injectFrame(0x7FF, b"x")
+    rc, frames = can.readMessages()
+    assert ids(frames) == [0x7FF]